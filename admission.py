@@ -0,0 +1,144 @@
+import random
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+import orjson
+from caches import LRUCache
+from dispatchers import TokenBucket
+from metrics import ADMISSION_DECISIONS, ADMISSION_SCALE, DB_WRITE_STAGE
+
+## the admission control of /webhook decides, event by event, whether
+## the workers get it now or later. Every user has a token bucket, an
+## event over the user's rate is journaled with the delay until its
+## token, so a flooding user waits for their own events and not the
+## others. When more jobs than max_ready are due or running, every new
+## event is deferred by shed_delay_seconds. The mean database write of
+## the last interval steers the user rates: over the target they are
+## halved, under half of it they grow back step by step. A deferred
+## event is never dropped, it is processed when it is due and its
+## reply goes out as a push once the reply token expired
+class AdmissionController:
+    def __init__(
+            self,
+            user_rate: Optional[float] = 5.0,
+            user_burst: float = 20.0,
+            max_ready: Optional[int] = 1000,
+            write_latency_target_ms: Optional[float] = 50.0,
+            shed_delay_seconds: float = 2.0,
+            max_delay_seconds: float = 600.0,
+            min_scale: float = 0.1,
+            interval_seconds: float = 1.0,
+            ready: Callable[[], Awaitable[int]] = None
+            ) -> None:
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.max_ready = max_ready
+        self.write_latency_target = None if write_latency_target_ms is None else write_latency_target_ms / 1000
+        self.shed_delay_seconds = shed_delay_seconds
+        self.max_delay_seconds = max_delay_seconds
+        self.min_scale = min_scale
+        self.interval_seconds = interval_seconds
+        self.ready = ready
+        self.buckets = LRUCache(maxsize=65536)
+        ## the share of the user rate admitted now
+        self.scale = 1.0
+        self.checked_at = time.monotonic()
+        self.counted_at = 0.0
+        self.writes_seen = (0, 0.0)
+        self.ready_jobs = 0
+        self.admitted = 0
+        self.deferred = 0
+    ## count the jobs due once an interval, ready reads the journal off
+    ## the event loop and plan decides on the last count
+    async def refresh(self) -> None:
+        now = time.monotonic()
+        if self.ready is None or self.max_ready is None or now - self.counted_at < self.interval_seconds:
+            return
+        self.counted_at = now
+        self.ready_jobs = await self.ready()
+    ## follow the database writes of the last interval
+    def __adjust(self) -> None:
+        now = time.monotonic()
+        if now - self.checked_at < self.interval_seconds:
+            return
+        self.checked_at = now
+        if self.write_latency_target is None:
+            return
+        with DB_WRITE_STAGE.lock:
+            count, total = DB_WRITE_STAGE.count, DB_WRITE_STAGE.sum
+        writes, seconds = count - self.writes_seen[0], total - self.writes_seen[1]
+        self.writes_seen = (count, total)
+        if writes > 0 and seconds / writes > self.write_latency_target:
+            self.scale = max(self.min_scale, self.scale / 2)
+        elif writes == 0 or seconds / writes < self.write_latency_target / 2:
+            self.scale = min(1.0, self.scale + 0.1)
+        ADMISSION_SCALE.set(self.scale)
+    ## the seconds to defer an event of line_user_id by, 0 admits it now
+    def admit(self, line_user_id: Optional[str]) -> float:
+        self.__adjust()
+        if self.max_ready is not None and self.ready_jobs >= self.max_ready:
+            ADMISSION_DECISIONS.labels(decision="overload").inc()
+            self.deferred += 1
+            return self.shed_delay_seconds * random.uniform(1.0, 2.0)
+        if self.user_rate is None or line_user_id is None:
+            ADMISSION_DECISIONS.labels(decision="admitted").inc()
+            self.admitted += 1
+            return 0.0
+        bucket = self.buckets.get(line_user_id)
+        if bucket is None:
+            bucket = TokenBucket(self.user_rate, self.user_burst)
+            self.buckets.put(line_user_id, bucket)
+        ## a lower scale makes every event cost more of the bucket
+        delay = bucket.reserve(min(1.0 / self.scale, self.user_burst), self.max_delay_seconds)
+        if delay <= 0:
+            ADMISSION_DECISIONS.labels(decision="admitted").inc()
+            self.admitted += 1
+            return 0.0
+        ADMISSION_DECISIONS.labels(decision="user_rate").inc()
+        self.deferred += 1
+        ## a bucket deep in debt spreads its events instead of piling
+        ## them up at max_delay_seconds
+        if delay >= self.max_delay_seconds:
+            delay *= random.uniform(1.0, 1.5)
+        return delay
+    ## split a verified webhook body into the jobs to journal, as
+    ## (body, delay_seconds, dead). A body whose events are all admitted
+    ## is journaled as it came, every deferred event becomes a job of its
+    ## own. A body that is no webhook payload would fail every attempt:
+    ## it is journaled dead as it came, kept to look at but never
+    ## processed. So is a body with events that are no objects, its
+    ## other events are planned like the ones of any body
+    def plan(self, body: bytes) -> List[Tuple[bytes, float, bool]]:
+        try:
+            payload = orjson.loads(body)
+        except orjson.JSONDecodeError:
+            return [(body, 0.0, True)]
+        if not isinstance(payload, dict) or not isinstance(payload.get("events") or [], list):
+            return [(body, 0.0, True)]
+        events = payload.get("events") or []
+        malformed = [(body, 0.0, True)] if any(not isinstance(event, dict) for event in events) else []
+        if len(malformed) > 0:
+            events = [event for event in events if isinstance(event, dict)]
+            if len(events) == 0:
+                return malformed
+            payload = {**payload, "events": events}
+        admitted: List[Any] = []
+        jobs: List[Tuple[bytes, float, bool]] = []
+        for event in events:
+            source = event.get("source")
+            delay = self.admit(source.get("userId") if isinstance(source, dict) else None)
+            if delay <= 0:
+                admitted.append(event)
+            else:
+                jobs.append((orjson.dumps({**payload, "events": [event]}), delay, False))
+        if len(jobs) == 0:
+            return malformed + [(body if len(malformed) == 0 else orjson.dumps(payload), 0.0, False)]
+        if len(admitted) > 0:
+            jobs.insert(0, (orjson.dumps({**payload, "events": admitted}), 0.0, False))
+        return malformed + jobs
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "scale": self.scale,
+            "ready_jobs": self.ready_jobs,
+            "admitted": self.admitted,
+            "deferred": self.deferred,
+        }
@@ -0,0 +1,126 @@
+import gzip
+import hashlib
+import os
+import re
+import zlib
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import orjson
+from caches import LRUCache
+
+## the note archive keeps the notes moved out of message_records as
+## gzip-compressed json lines, one file per user and month at
+## root/<lineUserId>/<YYYY-MM>.jsonl.gz. Every archived chunk is
+## appended as a gzip member of its own and synced before its rows are
+## deleted; a chunk archived twice after a crash is read once, notes
+## are unique by id
+class NoteArchive:
+    USER_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,64}")
+    def __init__(self, root: str = "./archive") -> None:
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        ## decoded months, keyed by path, mtime and size so an append
+        ## reads the file again
+        self.months_cache = LRUCache(maxsize=256)
+    def user_dir(self, line_user_id: str) -> str:
+        name = line_user_id
+        if self.USER_PATTERN.fullmatch(name) is None:
+            name = hashlib.sha256(name.encode()).hexdigest()
+        return os.path.join(self.root, name)
+    def path_for(self, line_user_id: str, month: str) -> str:
+        return os.path.join(self.user_dir(line_user_id), f"{month}.jsonl.gz")
+    ## append the notes of one user and month, durable once this returns
+    def append(self, line_user_id: str, month: str, notes: List[Dict[str, Any]]) -> None:
+        path = self.path_for(line_user_id, month)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = b"".join(orjson.dumps(note) + b"\n" for note in notes)
+        with open(path, "ab") as file:
+            file.write(gzip.compress(data))
+            file.flush()
+            os.fsync(file.fileno())
+    ## the archived months of a user, newest first
+    def months(self, line_user_id: str) -> List[str]:
+        try:
+            names = os.listdir(self.user_dir(line_user_id))
+        except FileNotFoundError:
+            return []
+        return sorted((name[:-len(".jsonl.gz")] for name in names if name.endswith(".jsonl.gz")),
+                      reverse=True)
+    ## the notes of a month newest-first, a member still being written
+    ## by the archiver is left out until it is complete
+    def read_month(self, line_user_id: str, month: str) -> List[Dict[str, Any]]:
+        path = self.path_for(line_user_id, month)
+        try:
+            status = os.stat(path)
+        except FileNotFoundError:
+            return []
+        key = (path, status.st_mtime_ns, status.st_size)
+        notes = self.months_cache.get(key)
+        if notes is not None:
+            return notes
+        by_id: Dict[int, Dict[str, Any]] = {}
+        try:
+            with gzip.open(path, "rb") as file:
+                for line in file:
+                    note = orjson.loads(line)
+                    note["timestamp"] = datetime.fromisoformat(note["timestamp"])
+                    by_id[note["id"]] = note
+        except (EOFError, gzip.BadGzipFile, zlib.error, orjson.JSONDecodeError):
+            pass
+        notes = sorted(by_id.values(), key=lambda note: (note["timestamp"], note["id"]), reverse=True)
+        self.months_cache.put(key, notes)
+        return notes
+    ## the notes of a month in the order they were archived, oldest
+    ## first, read as they stream out of the file and not cached
+    def iter_month(self, line_user_id: str, month: str) -> Iterator[Dict[str, Any]]:
+        seen = set()
+        try:
+            with gzip.open(self.path_for(line_user_id, month), "rb") as file:
+                for line in file:
+                    note = orjson.loads(line)
+                    if note["id"] not in seen:
+                        seen.add(note["id"])
+                        yield note
+        except (FileNotFoundError, EOFError, gzip.BadGzipFile, zlib.error, orjson.JSONDecodeError):
+            return
+    ## the end of the newest archived month, the notes after it are all
+    ## in message_records
+    def horizon(self, line_user_id: str) -> Optional[datetime]:
+        months = self.months(line_user_id)
+        if len(months) == 0:
+            return None
+        year, month = (int(part) for part in months[0].split("-"))
+        return datetime(year + month // 12, month % 12 + 1, 1)
+    ## the archived notes of a user newest-first, read like a page of
+    ## the note history: before (timestamp, id), since and until bound it
+    def history(
+            self,
+            line_user_id: str,
+            before: Optional[Tuple[datetime, int]] = None,
+            since: Optional[datetime] = None,
+            until: Optional[datetime] = None,
+            limit: int = 20
+            ) -> List[Dict[str, Any]]:
+        found: List[Dict[str, Any]] = []
+        for month in self.months(line_user_id):
+            year, number = (int(part) for part in month.split("-"))
+            start = datetime(year, number, 1)
+            end = datetime(year + number // 12, number % 12 + 1, 1)
+            if since is not None and end <= since:
+                break
+            if until is not None and start >= until:
+                continue
+            if before is not None and start > before[0]:
+                continue
+            for note in self.read_month(line_user_id, month):
+                key = (note["timestamp"], note["id"])
+                if before is not None and key >= before:
+                    continue
+                if until is not None and note["timestamp"] >= until:
+                    continue
+                if since is not None and note["timestamp"] < since:
+                    break
+                found.append(note)
+                if len(found) >= limit:
+                    return found
+        return found
@@ -0,0 +1,141 @@
+import mmap
+import os
+import struct
+import wave
+from typing import Any, Dict, Optional
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+## the post-processing of one stored attachment, run in a worker process
+## of the post processor. It gets the path of the blob and the directory
+## for its variants, never the content, and the file is mapped instead
+## of read. Images get their size, a thumbnail and a downscaled preview
+## with Pillow; without Pillow only the format is known. Audio gets its
+## duration from the container headers
+IMAGE_FORMATS = {"jpeg", "png", "gif", "webp"}
+
+def sniff_format(header: bytes) -> str:
+    if header.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    if header.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if header[:6] in (b"GIF87a", b"GIF89a"):
+        return "gif"
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "webp"
+    if header[:4] == b"RIFF" and header[8:12] == b"WAVE":
+        return "wav"
+    if header[4:8] == b"ftyp":
+        return "m4a" if header[8:11] in (b"M4A", b"M4B") else "mp4"
+    if header.startswith(b"ID3") or (len(header) > 1 and header[0] == 0xFF and header[1] & 0xE0 == 0xE0):
+        return "mp3"
+    if header.startswith(b"OggS"):
+        return "ogg"
+    if header.startswith(b"%PDF"):
+        return "pdf"
+    if header.startswith(b"PK\x03\x04"):
+        return "zip"
+    return "unknown"
+
+## the duration of an mp4/m4a file from the mvhd box inside moov, the
+## movie header box of ISO/IEC 14496-12
+def mp4_duration(view: mmap.mmap, start: int = 0, end: Optional[int] = None) -> Optional[float]:
+    end = len(view) if end is None else end
+    offset = start
+    while offset + 8 <= end:
+        size, kind = struct.unpack_from(">I4s", view, offset)
+        header = 8
+        if size == 1:
+            if offset + 16 > end:
+                return None
+            size = struct.unpack_from(">Q", view, offset + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - offset
+        if size < header:
+            return None
+        if kind == b"moov":
+            return mp4_duration(view, offset + header, min(offset + size, end))
+        if kind == b"mvhd" and offset + header + 32 <= end:
+            version = view[offset + header]
+            if version == 1:
+                timescale, duration = struct.unpack_from(">IQ", view, offset + header + 20)
+            else:
+                timescale, duration = struct.unpack_from(">II", view, offset + header + 12)
+            return duration / timescale if timescale > 0 else None
+        offset += size
+    return None
+
+## the duration of an mp3 from the first frame header, exact for a
+## constant bitrate and an estimate otherwise
+MP3_BITRATES = (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 0)
+def mp3_duration(view: mmap.mmap) -> Optional[float]:
+    offset = 0
+    if view[:3] == b"ID3" and len(view) >= 10:
+        size = view[6] << 21 | view[7] << 14 | view[8] << 7 | view[9]
+        offset = 10 + size
+    if offset + 4 > len(view) or view[offset] != 0xFF or view[offset + 1] & 0xE0 != 0xE0:
+        return None
+    bitrate = MP3_BITRATES[view[offset + 2] >> 4]
+    if bitrate == 0:
+        return None
+    return (len(view) - offset) * 8 / (bitrate * 1000)
+
+def wav_duration(path: str) -> Optional[float]:
+    with wave.open(path, "rb") as audio:
+        return audio.getnframes() / audio.getframerate()
+
+## write a variant next to the others, renamed in place once complete
+def _save_variant(image: "Image.Image", directory: str, name: str) -> str:
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, name)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    image.save(tmp_path, "JPEG", quality=80, optimize=True)
+    os.replace(tmp_path, path)
+    return path
+
+def _inspect_image(path: str, variants_dir: str, thumbnail_size: int, preview_size: int) -> Dict[str, Any]:
+    result: Dict[str, Any] = {"info": {}, "thumbnail_path": None, "preview_path": None}
+    if Image is None:
+        return result
+    with Image.open(path) as image:
+        width, height = image.size
+        ## orientations 5 to 8 are turned by a quarter
+        if image.getexif().get(0x0112) in (5, 6, 7, 8):
+            width, height = height, width
+        result["info"]["width"], result["info"]["height"] = width, height
+        ## the draft lets a jpeg decode at a fraction of its size
+        image.draft("RGB", (preview_size, preview_size))
+        image = ImageOps.exif_transpose(image)
+        image = image.convert("RGB")
+        if max(image.size) > preview_size:
+            image.thumbnail((preview_size, preview_size))
+            result["preview_path"] = _save_variant(image, variants_dir, "preview.jpg")
+        image.thumbnail((thumbnail_size, thumbnail_size))
+        result["thumbnail_path"] = _save_variant(image, variants_dir, "thumbnail.jpg")
+    return result
+
+def inspect_attachment(
+        path: str,
+        variants_dir: str,
+        thumbnail_size: int = 256,
+        preview_size: int = 1280
+        ) -> Dict[str, Any]:
+    size = os.path.getsize(path)
+    if size == 0:
+        return {"info": {"format": "empty", "size": 0}, "thumbnail_path": None, "preview_path": None}
+    with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as view:
+        format = sniff_format(view[:16])
+        result: Dict[str, Any] = {"info": {}, "thumbnail_path": None, "preview_path": None}
+        if format in IMAGE_FORMATS:
+            result = _inspect_image(path, variants_dir, thumbnail_size, preview_size)
+        elif format in ("m4a", "mp4"):
+            result["info"]["duration"] = mp4_duration(view)
+        elif format == "mp3":
+            result["info"]["duration"] = mp3_duration(view)
+        elif format == "wav":
+            result["info"]["duration"] = wav_duration(path)
+    result["info"].update(format=format, size=size)
+    return result
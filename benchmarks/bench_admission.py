@@ -0,0 +1,117 @@
+## measure the admission control under a flood: one user posts batches
+## of text events as fast as the app takes them while well-behaved users
+## post one event every few seconds each. Reported per run, with the
+## admission control off and on: the p50/p95/p99 from a well-behaved
+## user's post to its reply reaching the stub, the same for the flooding
+## user's replies sent during the run, and the acknowledgement p99.
+## run from the repository root:
+##   python -m benchmarks.bench_admission [flood_events] [seconds]
+import asyncio
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List
+import httpx
+import orjson
+from benchmarks.harness import SECRET, app_config, percentiles
+from benchmarks.payloads import make_event, make_payload, sign
+from benchmarks.stub_line import StubLineServer
+
+GOOD_USERS = 40
+GOOD_INTERVAL_SECONDS = 2.0
+FLOOD_BATCH = 10
+
+def text_event(line_user_id: str, index: int) -> Dict[str, Any]:
+    return make_event(line_user_id, index, {"type": "text", "text": f"note {index}"},
+                      reply_token=f"{line_user_id}-{index}")
+
+def run_in_process(config: Dict[str, Any], flood_events: int, seconds: float, results) -> None:
+    os.environ["APP_CONFIG"] = orjson.dumps(config).decode()
+    async def run() -> Dict[str, Any]:
+        import main
+        sent_at: Dict[str, float] = {}
+        acks: List[float] = []
+        async with main.lifespan(main.app):
+            transport = httpx.ASGITransport(app=main.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as client:
+                async def post(events: List[Dict[str, Any]]) -> None:
+                    body = make_payload(events)
+                    now = time.time()
+                    for event in events:
+                        sent_at[event["replyToken"]] = now
+                    start = time.perf_counter()
+                    await client.post("/webhook", content=body, headers={
+                        "Content-Type": "application/json", "X-Line-Signature": sign(body, SECRET)})
+                    acks.append(time.perf_counter() - start)
+                async def flood() -> None:
+                    for start in range(0, flood_events, FLOOD_BATCH):
+                        await post([text_event("Uflood", index)
+                                    for index in range(start, min(flood_events, start + FLOOD_BATCH))])
+                async def good(user: int) -> None:
+                    await asyncio.sleep(GOOD_INTERVAL_SECONDS * user / GOOD_USERS)
+                    for index in range(int(seconds / GOOD_INTERVAL_SECONDS)):
+                        due = time.perf_counter() + GOOD_INTERVAL_SECONDS
+                        await post([text_event(f"Ugood{user:03d}", index)])
+                        await asyncio.sleep(max(0.0, due - time.perf_counter()))
+                await asyncio.gather(flood(),
+                                     *[good(user) for user in range(GOOD_USERS)])
+                ## the replies of the last posts
+                await asyncio.sleep(3)
+                stats = (await client.get("/stats")).json()
+        return {"sent_at": sent_at, "ack": percentiles(acks), "queue": stats["queue"],
+                "admission": stats["admission"]}
+    results.put(asyncio.run(run()))
+
+async def run_once(stub: StubLineServer, admission: bool, flood_events: int, seconds: float) -> Dict[str, Any]:
+    directory = tempfile.mkdtemp(prefix="bench_admission_")
+    config = {**app_config(directory, {
+        "reply": stub.reply_endpoint, "push": stub.push_endpoint, "content": stub.content_endpoint})}
+    if admission:
+        config.update(ADMISSION_USER_RATE=5.0, ADMISSION_USER_BURST=20)
+    else:
+        config.update(ADMISSION_USER_RATE=None, ADMISSION_MAX_READY=None,
+                      ADMISSION_WRITE_LATENCY_TARGET_MS=None)
+    stub.calls.clear()
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=run_in_process, args=(config, flood_events, seconds, results))
+    process.start()
+    try:
+        result = await asyncio.to_thread(results.get)
+        await asyncio.to_thread(process.join)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    sent_at = result.pop("sent_at")
+    latencies: Dict[str, List[float]] = {"good": [], "flood": []}
+    for call in stub.calls:
+        if call["path"].endswith("/reply") and call["body"]["replyToken"] in sent_at:
+            token = call["body"]["replyToken"]
+            latencies["flood" if token.startswith("Uflood") else "good"].append(call["at"] - sent_at[token])
+    return {"latencies": latencies, **result}
+
+async def main() -> None:
+    flood_events = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 20
+    stub = StubLineServer()
+    await stub.start()
+    try:
+        print(f"1 user flooding {flood_events} events, {GOOD_USERS} users posting every "
+              f"{GOOD_INTERVAL_SECONDS:.0f} s for {seconds:.0f} s, {os.cpu_count()} cpus")
+        for admission in (False, True):
+            result = await run_once(stub, admission, flood_events, seconds)
+            good, flood = result["latencies"]["good"], result["latencies"]["flood"]
+            numbers = percentiles(good)
+            flooded = percentiles(flood)
+            print(f"admission {'on ' if admission else 'off'}  good users reply "
+                  f"p50/95/99 {numbers['p50_ms']}/{numbers['p95_ms']}/{numbers['p99_ms']} ms "
+                  f"({len(good)} replies)  flood replies {len(flood)} "
+                  f"p99 {flooded['p99_ms']} ms  ack p99 {result['ack']['p99_ms']} ms  "
+                  f"deferred {result['queue']['deferred']} jobs")
+    finally:
+        await stub.stop()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,53 @@
+## measure events/second of the batch ingestion path against the 
+## previous one-commit-per-event path, for batch sizes from 1 to 100.
+## run from the repository root: python -m benchmarks.bench_batch_ingest
+import asyncio
+import time
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from rules import Base
+from database import DatabaseExecutor
+from executors import SeniorOfficerBot, ManagerBot, ClerkBot, StorageBot
+from handlers import MessageRecordHandler
+from benchmarks.payloads import make_text_event, make_payload
+
+BATCH_SIZES = [1, 5, 10, 25, 50, 100]
+ROUNDS = 20
+
+def setup_executor(path: str) -> DatabaseExecutor:
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    return DatabaseExecutor(
+        session_factory = sessionmaker(autocommit=False, autoflush=False, bind=engine),
+        max_workers = 1
+    )
+
+def store_one_by_one(db, messages) -> None:
+    for msg in messages:
+        MessageRecordHandler(db = db, message = msg)
+
+async def run(batch_size: int, batched: bool) -> float:
+    executor = setup_executor("./bench_batch.db")
+    senior = SeniorOfficerBot({"CHANNEL_SECRET": "bench", "CHANNEL_ACCESS_TOKEN": "bench"})
+    payloads = [
+        make_payload([make_text_event(f"U{i % 4}", r * batch_size + i) for i in range(batch_size)])
+        for r in range(ROUNDS)
+    ]
+    start = time.perf_counter()
+    for body in payloads:
+        manager = ManagerBot(senior = senior, DB = executor)
+        manager.body = body
+        messages = [msg for ok, msg in ClerkBot(manager = manager).getMessages() if ok]
+        if batched:
+            await StorageBot(manager = manager, objects_to_store = messages).process_messages()
+        else:
+            await executor.run(store_one_by_one, messages)
+    elapsed = time.perf_counter() - start
+    executor.shutdown()
+    return batch_size * ROUNDS / elapsed
+
+if __name__ == "__main__":
+    print(f"{'batch':>6} {'per-event ev/s':>16} {'batched ev/s':>14}")
+    for size in BATCH_SIZES:
+        print(f"{size:>6} {asyncio.run(run(size, False)):>16.0f} {asyncio.run(run(size, True)):>14.0f}")
@@ -0,0 +1,68 @@
+## measure ingest throughput and disk usage of the content-addressed 
+## blob store on a corpus where many messages carry the same content, 
+## then time a garbage collection pass over it.
+## run from the repository root: 
+## python -m benchmarks.bench_blob_dedup [messages] [distinct] [megabytes]
+import asyncio
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+from sqlalchemy.orm import sessionmaker
+from rules import Base, Blobs, Message, MessageType
+from database import DatabaseExecutor, create_database_engine
+from executors import SeniorOfficerBot, ManagerBot, StorageBot
+from handlers import BlobGarbageHandler
+from benchmarks.stub_line import StubLineServer
+
+def disk_usage_mb(root: str) -> float:
+    total = 0
+    for directory, _, names in os.walk(root):
+        total += sum(os.path.getsize(os.path.join(directory, name)) for name in names)
+    return total / (1024 * 1024)
+
+async def main(messages: int, distinct: int, megabytes: int) -> None:
+    workdir = tempfile.mkdtemp(prefix="bench_blobs_")
+    server = StubLineServer(content_size=megabytes * 1024 * 1024, content_variants=distinct)
+    await server.start()
+    engine = create_database_engine({"URL": f"sqlite:///{workdir}/bench.db"})
+    Base.metadata.create_all(bind=engine)
+    executor = DatabaseExecutor(sessionmaker(autocommit=False, autoflush=False, bind=engine))
+    senior = SeniorOfficerBot({
+        "CHANNEL_SECRET": "bench",
+        "CHANNEL_ACCESS_TOKEN": "bench",
+        "CONTENT_ENDPOINT": server.content_endpoint,
+        "MEDIA_DIR": f"{workdir}/media",
+    })
+    await senior.http_client.start()
+    batch = [Message(msg_id = str(i), msg_type = MessageType.IMAGE, owner_id = f"U{i % 4}")
+             for i in range(messages)]
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        await StorageBot(
+            manager = ManagerBot(senior = senior, DB = executor),
+            objects_to_store = batch
+        ).process_messages()
+    elapsed = time.perf_counter() - start
+    rows = await executor.run(lambda db: db.query(Blobs).count())
+    start = time.perf_counter()
+    report = await executor.run(BlobGarbageHandler, blob_store = senior.blob_store, grace_seconds = 0)
+    gc_elapsed = time.perf_counter() - start
+    print(f"{messages} messages, {distinct} distinct contents of {megabytes} MB")
+    print(f"ingest {messages / elapsed:.0f} messages/s, {messages * megabytes / elapsed:.0f} MB/s")
+    print(f"disk {disk_usage_mb(senior.media_dir):.0f} MB for {messages * megabytes} MB sent, "
+          f"{rows} blob rows")
+    print(f"garbage collection {gc_elapsed * 1000:.1f} ms, {report}")
+    await senior.http_client.close()
+    await server.stop()
+    executor.shutdown()
+    shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    distinct = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    megabytes = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    asyncio.run(main(messages, distinct, megabytes))
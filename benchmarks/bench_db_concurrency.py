@@ -0,0 +1,93 @@
+## measure p50/p99 latency of 50 parallel webhook payloads when the 
+## database work runs inline on the event loop (before) and on the 
+## DatabaseExecutor thread pool (after). Every payload also replies 
+## to a local stub endpoint, which is the work the loop is kept free for.
+## run from the repository root: python -m benchmarks.bench_db_concurrency
+import asyncio
+import contextlib
+import io
+import statistics
+import time
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from rules import Base
+from database import DatabaseExecutor
+from executors import SeniorOfficerBot, ManagerBot
+from benchmarks.payloads import make_event, make_payload
+from benchmarks.stub_line import StubLineServer
+
+PARALLEL = 50
+ROUNDS = 10
+
+## runs fn(db) directly on the event loop, like the handlers did before. 
+## The shards, shard_of and partition the manager bot uses come from 
+## the DatabaseExecutor
+class InlineExecutor(DatabaseExecutor):
+    def __init__(self, session_factory: sessionmaker) -> None:
+        super().__init__(session_factory, max_workers=1)
+    async def run(self, fn, *args, **kwargs):
+        db = self.session_factory()
+        try:
+            return fn(db, *args, **kwargs)
+        finally:
+            db.close()
+
+def setup_session_factory(path: str) -> sessionmaker:
+    engine = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False})
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    return sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+## the longest time the event loop could not run a 1 ms heartbeat
+async def heartbeat(stalls: list) -> None:
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(0.001)
+        stalls.append(time.perf_counter() - start - 0.001)
+
+## every pass posts events of its own: the ids of the pass before are
+## in recent_events, and would be rejected as duplicates
+async def run(senior: SeniorOfficerBot, executor, prefix: str) -> tuple:
+    latencies = []
+    stalls = []
+    beat = asyncio.create_task(heartbeat(stalls))
+    async def webhook(index: int) -> None:
+        event = make_event(f"U{index % 8}", index, {"type": "text", "text": f"quick note number {index}"},
+                           reply_token = f"token{index}", prefix = prefix)
+        manager = ManagerBot(senior = senior, DB = executor)
+        manager.body = make_payload([event])
+        start = time.perf_counter()
+        await manager.process_payload()
+        latencies.append(time.perf_counter() - start)
+    for r in range(ROUNDS):
+        await asyncio.gather(*[webhook(r * PARALLEL + i) for i in range(PARALLEL)])
+    beat.cancel()
+    executor.shutdown()
+    return latencies, stalls
+
+def report(name: str, result: tuple) -> None:
+    latencies, stalls = result
+    cuts = statistics.quantiles(latencies, n=100)
+    print(f"{name:<10} p50 {cuts[49] * 1000:8.2f} ms   p99 {cuts[98] * 1000:8.2f} ms"
+          f"   max loop stall {max(stalls) * 1000:8.2f} ms")
+
+async def main() -> None:
+    server = StubLineServer()
+    await server.start()
+    senior = SeniorOfficerBot({
+        "CHANNEL_SECRET": "bench",
+        "CHANNEL_ACCESS_TOKEN": "bench",
+        "REPLY_ENDPOINT": server.reply_endpoint,
+        "HTTP_POOL_SIZE": PARALLEL,
+    })
+    await senior.http_client.start()
+    with contextlib.redirect_stdout(io.StringIO()):
+        inline = await run(senior, InlineExecutor(setup_session_factory("./bench_db.db")), "01INLINE")
+        pooled = await run(senior, DatabaseExecutor(setup_session_factory("./bench_db.db"), max_workers=4), "01POOLED")
+    await senior.http_client.close()
+    await server.stop()
+    report("inline", inline)
+    report("executor", pooled)
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,130 @@
+## measure the note export: one user with a long history, a third of it
+## archived, and a few attachments. Every format is exported through
+## DatabaseExecutor.stream like /export serves it; reported are the
+## time to the first chunk, the throughput and the peak of python
+## allocations, against loading every row of the user first.
+## run from the repository root: python -m benchmarks.bench_export
+import asyncio
+import io
+import os
+import random
+import shutil
+import time
+import tracemalloc
+import zipfile
+from datetime import datetime, timedelta
+import orjson
+from sqlalchemy import insert, select
+from sqlalchemy.orm import sessionmaker
+from rules import Base, UserInfo, MessageRecords
+from database import DatabaseExecutor, create_database_engine
+from archive import NoteArchive
+from blobstore import BlobStore
+from handlers import ArchiveNotesHandler, ExportNotesHandler
+
+NOTES = 200_000
+NOTE_SIZE = 400
+ATTACHMENTS = 40
+ATTACHMENT_SIZE = 1024 * 1024
+DAYS = 730
+ARCHIVED_DAYS = 480
+PATH = "./bench_export.db"
+ARCHIVE_DIR = "./bench_export_archive"
+MEDIA_DIR = "./bench_export_media"
+
+def remove_files() -> None:
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(PATH + suffix):
+            os.remove(PATH + suffix)
+    shutil.rmtree(ARCHIVE_DIR, ignore_errors=True)
+    shutil.rmtree(MEDIA_DIR, ignore_errors=True)
+
+def populate(Session, archive: NoteArchive) -> None:
+    random.seed(7)
+    store = BlobStore(MEDIA_DIR)
+    paths = []
+    for index in range(ATTACHMENTS):
+        writer = store.open_writer()
+        writer.write(os.urandom(ATTACHMENT_SIZE))
+        paths.append(writer.commit()[2])
+    now = datetime.now()
+    with Session() as db:
+        db.execute(insert(UserInfo), [{"lineUserId": "U0001"}])
+        for start in range(0, NOTES, 20_000):
+            db.execute(insert(MessageRecords), [
+                {"userInfo_id": 1, "lineUserId": "U0001",
+                 "message": f"note {n} " + "x" * NOTE_SIZE,
+                 "filename": f"file{n}.bin" if n < ATTACHMENTS else None,
+                 "filepath": paths[n] if n < ATTACHMENTS else None,
+                 "timestamp": now - timedelta(seconds=random.randrange(DAYS * 86400))}
+                for n in range(start, min(NOTES, start + 20_000))
+            ])
+        db.commit()
+    older_than = now - timedelta(days=ARCHIVED_DAYS)
+    while True:
+        with Session() as db:
+            if ArchiveNotesHandler(db, archive, older_than, chunk_size=5000)["archived"] < 5000:
+                break
+
+async def export(executor: DatabaseExecutor, archive: NoteArchive, format: str, check: bool):
+    start = time.perf_counter()
+    first = None
+    size = 0
+    sample = io.BytesIO() if check and format == "zip" else None
+    async for chunk in executor.stream(ExportNotesHandler, line_user_id="U0001",
+                                       archive=archive, format=format):
+        if first is None:
+            first = time.perf_counter() - start
+        size += len(chunk)
+        if sample is not None:
+            sample.write(chunk)
+    total = time.perf_counter() - start
+    if sample is not None:
+        with zipfile.ZipFile(sample) as bundle:
+            assert bundle.testzip() is None
+            notes = sum(1 for _ in bundle.open("notes.ndjson"))
+            assert notes == NOTES, notes
+            assert len(bundle.namelist()) == ATTACHMENTS + 1
+    return first, total, size
+
+def load_everything(Session) -> bytes:
+    with Session() as db:
+        rows = db.execute(
+            select(MessageRecords.id, MessageRecords.message, MessageRecords.filename,
+                   MessageRecords.timestamp)
+            .where(MessageRecords.userInfo_id == 1)
+            .order_by(MessageRecords.timestamp, MessageRecords.id)).all()
+    return b"".join(orjson.dumps(row._asdict()) + b"\n" for row in rows)
+
+def peak_mb(fn) -> float:
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 1e6
+
+def main() -> None:
+    remove_files()
+    engine = create_database_engine({"URL": f"sqlite:///{PATH}"})
+    Base.metadata.create_all(bind=engine)
+    Session = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    archive = NoteArchive(ARCHIVE_DIR)
+    populate(Session, archive)
+    executor = DatabaseExecutor(Session, max_workers=4)
+    for format in ("ndjson", "zip"):
+        first, total, size = asyncio.run(export(executor, archive, format, True))
+        peak = peak_mb(lambda: asyncio.run(export(executor, archive, format, False)))
+        print(f"{format:7s} first chunk {first * 1e3:7.1f} ms  {size / 1e6:7.1f} MB in "
+              f"{total:5.1f} s ({size / 1e6 / total:6.1f} MB/s)  peak {peak:6.1f} MB")
+    start = time.perf_counter()
+    size = len(load_everything(Session))
+    total = time.perf_counter() - start
+    peak = peak_mb(lambda: load_everything(Session))
+    print(f"{'loaded':7s} first chunk {total * 1e3:7.1f} ms  {size / 1e6:7.1f} MB in "
+          f"{total:5.1f} s ({size / 1e6 / total:6.1f} MB/s)  peak {peak:6.1f} MB  (archive left out)")
+    executor.shutdown()
+    engine.dispose()
+    remove_files()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+## measure sustained notes/second when concurrent requests each commit 
+## their own note (before) and when the GroupCommitWriter coalesces 
+## them into one commit per batch (after).
+## run from the repository root: python -m benchmarks.bench_group_commit
+import asyncio
+import os
+import time
+from rules import Base, Message, MessageType
+from database import DatabaseExecutor, create_database_engine
+from handlers import MessageRecordsBatchHandler
+from writers import GroupCommitWriter
+from sqlalchemy.orm import sessionmaker
+
+NOTES = 5000
+CONCURRENCY = 200
+
+def setup_executor(path: str) -> DatabaseExecutor:
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    engine = create_database_engine({"URL": f"sqlite:///{path}"})
+    Base.metadata.create_all(bind=engine)
+    return DatabaseExecutor(
+        session_factory = sessionmaker(autocommit=False, autoflush=False, bind=engine),
+        max_workers = 1
+    )
+
+async def run(grouped: bool) -> float:
+    executor = setup_executor("./bench_group.db")
+    writer = GroupCommitWriter(executor = executor)
+    writer.start()
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+    async def request(index: int) -> None:
+        messages = [Message(msg_id = str(index), msg_type = MessageType.TEXT,
+                            msg_text = f"note {index}", owner_id = f"U{index % 16}")]
+        async with semaphore:
+            if grouped:
+                await writer.submit(messages)
+            else:
+                await executor.run(MessageRecordsBatchHandler, messages = messages)
+    start = time.perf_counter()
+    await asyncio.gather(*[request(i) for i in range(NOTES)])
+    elapsed = time.perf_counter() - start
+    await writer.stop()
+    executor.shutdown()
+    if grouped:
+        print(f"  {writer.batches} commits, {writer.rows / writer.batches:.1f} notes per commit")
+    return NOTES / elapsed
+
+if __name__ == "__main__":
+    before = asyncio.run(run(False))
+    after = asyncio.run(run(True))
+    print(f"commit per request: {before:8.0f} notes/s")
+    print(f"group commit:       {after:8.0f} notes/s")
@@ -0,0 +1,59 @@
+## measure peak RSS while parallel image messages are downloaded from 
+## a local stub content endpoint and streamed to disk.
+## run from the repository root: 
+## python -m benchmarks.bench_media_fetch [uploads] [megabytes]
+import asyncio
+import contextlib
+import io
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from executors import SeniorOfficerBot, ManagerBot, StorageBot
+from rules import HandleStatus, Message, MessageType, ProcessMessage
+from benchmarks.stub_line import StubLineServer
+
+## stores nothing, the benchmark only looks at the download path
+class NullExecutor:
+    async def run(self, fn, *args, **kwargs) -> HandleStatus:
+        return HandleStatus(True, ProcessMessage.ALL_OK)
+    def partition(self, messages: list) -> list:
+        return [messages]
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+async def main(uploads: int, megabytes: int) -> None:
+    server = StubLineServer(content_size=megabytes * 1024 * 1024)
+    await server.start()
+    media_dir = tempfile.mkdtemp(prefix="bench_media_")
+    senior = SeniorOfficerBot({
+        "CHANNEL_SECRET": "bench",
+        "CHANNEL_ACCESS_TOKEN": "bench",
+        "CONTENT_ENDPOINT": server.content_endpoint,
+        "MEDIA_DIR": media_dir,
+        "FETCH_CONCURRENCY": uploads,
+        "HTTP_POOL_SIZE": uploads,
+    })
+    await senior.http_client.start()
+    manager = ManagerBot(senior = senior, DB = NullExecutor())
+    messages = [Message(msg_id = str(i), msg_type = MessageType.IMAGE, owner_id = "Ubench")
+                for i in range(uploads)]
+    baseline = peak_rss_mb()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        await StorageBot(manager = manager, objects_to_store = messages).process_messages()
+    elapsed = time.perf_counter() - start
+    stored = sum(1 for msg in messages if msg.msg_filepath is not None)
+    await senior.http_client.close()
+    await server.stop()
+    shutil.rmtree(media_dir)
+    print(f"{stored}/{uploads} files of {megabytes} MB in {elapsed:.2f} s, "
+          f"{uploads * megabytes / elapsed:.0f} MB/s")
+    print(f"peak RSS {baseline:.0f} MB before, {peak_rss_mb():.0f} MB after")
+
+if __name__ == "__main__":
+    uploads = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    megabytes = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    asyncio.run(main(uploads, megabytes))
@@ -0,0 +1,47 @@
+## measure Message construction (objects/second) and size (bytes per 
+## message) of the slotted dataclass against the previous dict-backed 
+## class, and the message type lookup against MessageType[x.upper()].
+## run from the repository root: python -m benchmarks.bench_message
+import sys
+import time
+from datetime import datetime
+from rules import Message, MessageType, MESSAGE_TYPES
+
+ROUNDS = 200000
+
+## the dict-backed Message this module replaced, kept for comparison
+class DictMessage:
+    def __init__(self, msg_id=None, msg_type=MessageType.NULL, msg_text=None,
+                 msg_filename=None, msg_reply_token="", msg_timestamp=None,
+                 owner_id=None, error_description=None) -> None:
+        self.msg_id = msg_id
+        self.msg_type = msg_type
+        self.msg_text = "this is a file message" if msg_text is None else msg_text
+        self.msg_filename = "this is a text message" if msg_filename is None else msg_filename
+        self.msg_reply_token = msg_reply_token
+        self.msg_timestamp = msg_timestamp
+        self.owner_id = owner_id
+        self.error_description = "" if error_description is None else error_description
+
+def size_of(obj) -> int:
+    size = sys.getsizeof(obj)
+    if hasattr(obj, "__dict__"):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+def rate(fn) -> float:
+    start = time.perf_counter()
+    for i in range(ROUNDS):
+        fn(i)
+    return ROUNDS / (time.perf_counter() - start)
+
+if __name__ == "__main__":
+    now = datetime.now()
+    build_dict = lambda i: DictMessage(msg_id="1", msg_type=MessageType.TEXT, msg_text="note",
+                                       msg_reply_token="token", msg_timestamp=now, owner_id="U1")
+    build_slots = lambda i: Message(msg_id="1", msg_type=MessageType.TEXT, msg_text="note",
+                                    msg_reply_token="token", msg_timestamp=now, owner_id="U1")
+    print(f"dict-backed  {rate(build_dict):>10.0f} objects/s  {size_of(build_dict(0)):>4} bytes/message")
+    print(f"slotted      {rate(build_slots):>10.0f} objects/s  {size_of(build_slots(0)):>4} bytes/message")
+    print(f"MessageType[x.upper()]  {rate(lambda i: MessageType['image'.upper()]):>10.0f} lookups/s")
+    print(f"MESSAGE_TYPES.get(x)    {rate(lambda i: MESSAGE_TYPES.get('image')):>10.0f} lookups/s")
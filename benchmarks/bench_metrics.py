@@ -0,0 +1,55 @@
+## measure what the instrumentation adds to the hot path: a counter 
+## increment, a gauge up and down, a histogram observation, a timed 
+## block, a labels() lookup, and a record through the queued logger.
+## run from the repository root: python -m benchmarks.bench_metrics
+import logging
+import time
+from metrics import Counter, Gauge, Histogram, render
+from logs import start_logging, stop_logging
+
+CALLS = 200_000
+
+def per_call_us(fn) -> float:
+    start = time.perf_counter()
+    for _ in range(CALLS):
+        fn()
+    return (time.perf_counter() - start) / CALLS * 1e6
+
+def main() -> None:
+    counter = Counter("bench_counter_total", "bench", ("outcome",))
+    gauge = Gauge("bench_gauge", "bench")
+    histogram = Histogram("bench_stage_seconds", "bench", ("stage",))
+    counter_child = counter.labels(outcome="ALL_OK")
+    stage = histogram.labels(stage="parse")
+    def gauge_up_down() -> None:
+        gauge.inc()
+        gauge.dec()
+    def timed() -> None:
+        with stage.time():
+            pass
+    empty = per_call_us(lambda: None)
+    results = [
+        ("counter.inc", per_call_us(counter_child.inc)),
+        ("counter.labels().inc", per_call_us(lambda: counter.labels(outcome="ALL_OK").inc())),
+        ("gauge inc + dec", per_call_us(gauge_up_down)),
+        ("histogram.observe", per_call_us(lambda: stage.observe(0.003))),
+        ("with histogram.time()", per_call_us(timed)),
+    ]
+    start_logging("INFO")
+    logger = logging.getLogger("bench")
+    results.append(("logger.info, queued", per_call_us(
+        lambda: logger.info("bench", extra={"error": "none"}))))
+    results.append(("logger.debug, filtered", per_call_us(
+        lambda: logger.debug("bench", extra={"error": "none"}))))
+    start = time.perf_counter()
+    stop_logging()
+    drained = time.perf_counter() - start
+    render_start = time.perf_counter()
+    render()
+    rendered = (time.perf_counter() - render_start) * 1e3
+    for name, value in results:
+        print(f"{name:24s} {value - empty:6.2f} us/call")
+    print(f"listener drained {CALLS} records in {drained:.2f} s, /metrics rendered in {rendered:.2f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+## measure note history page latency on page 1 and on page 10,000, 
+## keyset pagination along the composite index against OFFSET.
+## run from the repository root: python -m benchmarks.bench_notes_history
+import os
+import statistics
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import insert, select
+from sqlalchemy.orm import sessionmaker
+from rules import Base, MessageRecords, UserInfo
+from database import create_database_engine
+from handlers import NotesHistoryHandler, encode_notes_cursor
+
+PAGE_SIZE = 20
+DEEP_PAGE = 10000
+NOTES = (DEEP_PAGE + 10) * PAGE_SIZE
+REPEAT = 20
+
+def median_ms(fn) -> float:
+    samples = []
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+## the OFFSET query the keyset pagination replaces
+def offset_page(db, user_id: int, page: int) -> list:
+    return db.execute(
+        select(MessageRecords.id, MessageRecords.message, MessageRecords.timestamp)
+        .where(MessageRecords.userInfo_id == user_id)
+        .order_by(MessageRecords.timestamp.desc(), MessageRecords.id.desc())
+        .limit(PAGE_SIZE).offset((page - 1) * PAGE_SIZE)).all()
+
+if __name__ == "__main__":
+    path = "./bench_history.db"
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    engine = create_database_engine({"URL": f"sqlite:///{path}"})
+    Base.metadata.create_all(bind=engine)
+    db = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+    db.execute(insert(UserInfo), [{"lineUserId": "Uheavy"}, {"lineUserId": "Uother"}])
+    start = datetime(2020, 1, 1)
+    db.execute(insert(MessageRecords), [
+        {"userInfo_id": 1 + i % 2, "lineUserId": "Uheavy" if i % 2 == 0 else "Uother",
+         "message": f"note {i}", "timestamp": start + timedelta(minutes=i)}
+        for i in range(NOTES * 2)
+    ])
+    db.commit()
+    ## the cursor a client holds after reading DEEP_PAGE - 1 pages
+    last = offset_page(db, 1, DEEP_PAGE - 1)[-1]
+    deep_cursor = encode_notes_cursor(last.timestamp, last.id)
+    first = median_ms(lambda: NotesHistoryHandler(db, "Uheavy", limit=PAGE_SIZE))
+    deep = median_ms(lambda: NotesHistoryHandler(db, "Uheavy", cursor=deep_cursor, limit=PAGE_SIZE))
+    offset_first = median_ms(lambda: offset_page(db, 1, 1))
+    offset_deep = median_ms(lambda: offset_page(db, 1, DEEP_PAGE))
+    print(f"{NOTES} notes for the user, {PAGE_SIZE} per page")
+    print(f"keyset  page 1 {first:7.2f} ms   page {DEEP_PAGE} {deep:7.2f} ms")
+    print(f"offset  page 1 {offset_first:7.2f} ms   page {DEEP_PAGE} {offset_deep:7.2f} ms")
+    db.close()
+    engine.dispose()
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
@@ -0,0 +1,90 @@
+## measure the calls the reply dispatcher makes against the stub line 
+## server: every user sends a burst of texts, answered one reply call 
+## per text (before) and through the dispatcher (after). The dispatcher 
+## is then run with stale tokens, tokens line rejects, and a run of 500s 
+## to show the push fallback and the retries; every text must arrive.
+## run from the repository root: python -m benchmarks.bench_outbound
+import asyncio
+import contextlib
+import io
+import time
+from typing import List
+from dispatchers import ReplyDispatcher
+from handlers import LineApiClient, ReplyMessageHandler
+from rules import OutboundMessage
+from benchmarks.stub_line import StubLineServer
+
+USERS = 200
+TEXTS_PER_USER = 7
+
+def make_messages(run: str, age_seconds: float = 0.0) -> List[OutboundMessage]:
+    received_at = time.time() - age_seconds
+    return [
+        OutboundMessage(
+            text = f"reply {t} to U{u}",
+            line_user_id = f"U{u:04d}",
+            reply_token = f"{run}-{u}-{t}",
+            received_at = received_at)
+        for u in range(USERS) for t in range(TEXTS_PER_USER)
+    ]
+
+def summary(server: StubLineServer, elapsed: float) -> str:
+    replies = [call for call in server.calls if call["path"].endswith("/reply")]
+    pushes = [call for call in server.calls if call["path"].endswith("/push")]
+    delivered = sum(len(call["body"]["messages"]) for call in server.calls if call["status"] == 200)
+    failed = sum(1 for call in server.calls if call["status"] != 200)
+    return (f"{len(replies):5d} reply + {len(pushes):5d} push calls, {failed:4d} failed, "
+            f"{delivered:5d}/{USERS * TEXTS_PER_USER} texts delivered in {elapsed * 1e3:7.1f} ms")
+
+async def one_call_per_text(server: StubLineServer, client: LineApiClient) -> str:
+    server.calls.clear()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        await asyncio.gather(*[
+            ReplyMessageHandler(server.reply_endpoint, "bench", message.reply_token, message.text, client=client)
+            for message in make_messages("before")
+        ])
+    return summary(server, time.perf_counter() - start)
+
+async def dispatched(server: StubLineServer, client: LineApiClient, run: str,
+                     age_seconds: float = 0.0, invalid: bool = False, fail_next: int = 0) -> str:
+    server.calls.clear()
+    messages = make_messages(run, age_seconds)
+    if invalid:
+        server.invalid_reply_tokens.update(message.reply_token for message in messages)
+    server.fail_next = fail_next
+    dispatcher = ReplyDispatcher(
+        client = client,
+        reply_endpoint = server.reply_endpoint,
+        push_endpoint = server.push_endpoint,
+        channel_access_token = "bench",
+        user_rate = 1000,
+        backoff_seconds = 0.05,
+        concurrency = 50)
+    dispatcher.start()
+    start = time.perf_counter()
+    for message in messages:
+        dispatcher.submit(message)
+    await dispatcher.queue.join()
+    while len(dispatcher.sending) > 0 or len(dispatcher.scheduled) > 0:
+        await asyncio.sleep(0.005)
+    elapsed = time.perf_counter() - start
+    await dispatcher.stop()
+    return summary(server, elapsed)
+
+async def main() -> None:
+    server = StubLineServer()
+    await server.start()
+    client = LineApiClient(limit_per_host=50, max_retries=0)
+    await client.start()
+    print(f"{USERS} users x {TEXTS_PER_USER} texts")
+    print(f"one reply per text:   {await one_call_per_text(server, client)}")
+    print(f"dispatcher:           {await dispatched(server, client, 'fresh')}")
+    print(f"stale tokens:         {await dispatched(server, client, 'stale', age_seconds=120)}")
+    print(f"rejected tokens:      {await dispatched(server, client, 'invalid', invalid=True)}")
+    print(f"50 failures, retried: {await dispatched(server, client, 'failing', fail_next=50)}")
+    await client.close()
+    await server.stop()
+
+if __name__ == "__main__":
+    asyncio.run(main())
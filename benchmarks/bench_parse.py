@@ -0,0 +1,67 @@
+## measure signature validation and payload parsing for payloads from 
+## 1 KB to 1 MB: the previous str round-trip, hmac.new per request and 
+## json.loads against the bytes path with a copied hmac key, 
+## compare_digest and orjson into WebhookEvent structures.
+## run from the repository root: python -m benchmarks.bench_parse
+import base64
+import hashlib
+import hmac
+import json
+import time
+import orjson
+from rules import WebhookEvent
+from benchmarks.payloads import make_text_event, make_payload
+
+SECRET = "bench-channel-secret"
+SIZES = [1024, 16 * 1024, 128 * 1024, 1024 * 1024]
+
+def make_body(size: int) -> bytes:
+    events = []
+    body = make_payload(events)
+    while len(body) < size:
+        events.append(make_text_event(f"U{len(events) % 8}", len(events), "note " * 20))
+        body = make_payload(events)
+    return body
+
+def sign_before(body_bytes: bytes, signature: str) -> None:
+    body = body_bytes.decode('utf-8')
+    digest = hmac.new(SECRET.encode('utf-8'), body.encode('utf-8'), hashlib.sha256).digest()
+    if signature != base64.b64encode(digest).decode():
+        raise ValueError
+
+KEY = hmac.new(SECRET.encode('utf-8'), digestmod=hashlib.sha256)
+def sign_after(body: bytes, signature: str) -> None:
+    mac = KEY.copy()
+    mac.update(body)
+    if not hmac.compare_digest(base64.b64encode(mac.digest()), signature.encode()):
+        raise ValueError
+
+def parse_before(body: bytes, signature: str) -> list:
+    return json.loads(body.decode('utf-8'))["events"]
+
+def parse_after(body: bytes, signature: str) -> list:
+    return orjson.loads(body)["events"]
+
+def parse_events(body: bytes, signature: str) -> list:
+    return [WebhookEvent.from_dict(event) for event in orjson.loads(body)["events"]]
+
+def per_call_us(fn, body: bytes, signature: str) -> float:
+    rounds = max(20, 2_000_000 // len(body))
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fn(body, signature)
+    return (time.perf_counter() - start) / rounds * 1e6
+
+if __name__ == "__main__":
+    print("microseconds per payload")
+    print(f"{'payload':>9} {'events':>7} {'hmac before':>12} {'hmac after':>11} "
+          f"{'json':>9} {'orjson':>9} {'+events':>9}")
+    for size in SIZES:
+        body = make_body(size)
+        signature = base64.b64encode(hmac.new(SECRET.encode(), body, hashlib.sha256).digest()).decode()
+        print(f"{len(body) // 1024:>7}KB {len(parse_after(body, signature)):>7} "
+              f"{per_call_us(sign_before, body, signature):>12.1f} "
+              f"{per_call_us(sign_after, body, signature):>11.1f} "
+              f"{per_call_us(parse_before, body, signature):>9.1f} "
+              f"{per_call_us(parse_after, body, signature):>9.1f} "
+              f"{per_call_us(parse_events, body, signature):>9.1f}")
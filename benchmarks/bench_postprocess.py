@@ -0,0 +1,136 @@
+## measure the webhook acknowledgement latency while attachments are
+## post-processed: text webhooks are posted to the app over the asgi
+## transport at a fixed rate with the post processor idle, with its
+## pool busy on large photos, and with the same photos processed on the
+## event loop instead, the way it would be without the pool. A latency
+## is counted from the time the webhook was due, so a blocked loop
+## shows up even though the client shares it. Needs Pillow.
+## run from the repository root:
+##   python -m benchmarks.bench_postprocess [photos] [rate]
+import asyncio
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+from sqlalchemy import func, select
+from typing import Any, Dict, List
+import httpx
+import orjson
+from PIL import Image
+from benchmarks.harness import SECRET, app_config, percentiles
+from benchmarks.payloads import make_payload, make_text_event, sign
+from benchmarks.stub_line import StubLineServer
+from blobstore import BlobStore
+
+WIDTH, HEIGHT = 4032, 3024
+
+def make_photos(store: BlobStore, count: int) -> List[str]:
+    paths = []
+    for index in range(count):
+        ## a gradient with noise, about the size of a phone photo
+        image = Image.merge("RGB", (
+            Image.linear_gradient("L").resize((WIDTH, HEIGHT)),
+            Image.effect_noise((WIDTH, HEIGHT), 40 + index),
+            Image.linear_gradient("L").rotate(90).resize((WIDTH, HEIGHT)),
+        ))
+        path = os.path.join(store.tmp_dir, f"photo{index}.jpg")
+        image.save(path, "JPEG", quality=90)
+        writer = store.open_writer()
+        with open(path, "rb") as file:
+            writer.write(file.read())
+        os.remove(path)
+        paths.append(writer.commit()[2])
+    return paths
+
+## post a text webhook every 1/rate seconds for seconds, returns the
+## latencies from the time each one was due to its acknowledgement
+async def post_at_rate(client: httpx.AsyncClient, rate: float, seconds: float, offset: int) -> List[float]:
+    latencies: List[float] = []
+    async def post(body: bytes, due: float) -> None:
+        await client.post("/webhook", content=body, headers={
+            "Content-Type": "application/json", "X-Line-Signature": sign(body, SECRET)})
+        latencies.append(time.perf_counter() - due)
+    start = time.perf_counter()
+    tasks = []
+    for index in range(int(rate * seconds)):
+        due = start + index / rate
+        await asyncio.sleep(max(0.0, due - time.perf_counter()))
+        body = make_payload([make_text_event(f"U{index % 20:04d}", offset + index)])
+        tasks.append(asyncio.create_task(post(body, due)))
+    await asyncio.gather(*tasks)
+    return latencies
+
+def run_in_process(config: Dict[str, Any], photos: int, rate: float, results) -> None:
+    os.environ["APP_CONFIG"] = orjson.dumps(config).decode()
+    async def run() -> Dict[str, Any]:
+        import main
+        from attachments import inspect_attachment
+        from rules import MessageRecords
+        from database import db_session
+        report = {}
+        async with main.lifespan(main.app):
+            paths = await asyncio.to_thread(make_photos, main.seniorBot.blob_store, photos)
+            transport = httpx.ASGITransport(app=main.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as client:
+                report["idle"] = percentiles(await post_at_rate(client, rate, 3, 0))
+                ## the photos are stored notes waiting for the pool
+                with db_session() as db:
+                    db.add_all([MessageRecords(userInfo_id=None, lineUserId="Uphotos", message=None,
+                                               filepath=path, timestamp=datetime.now(),
+                                               media_status="pending") for path in paths])
+                    db.commit()
+                start = time.perf_counter()
+                main.postProcessor.notify()
+                latencies = []
+                while main.postProcessor.processed + main.postProcessor.failed < photos:
+                    latencies.extend(await post_at_rate(client, rate, 1, 100_000 + len(latencies)))
+                report["pool busy"] = percentiles(latencies)
+                report["pool busy"]["photos_per_second"] = round(photos / (time.perf_counter() - start), 2)
+                with db_session() as db:
+                    report["pool busy"]["thumbnails"] = db.execute(
+                        select(func.count()).where(MessageRecords.thumbnail_path.is_not(None))).scalar()
+                ## the same work on the event loop
+                async def inline() -> None:
+                    for path in paths:
+                        inspect_attachment(path, tempfile.mkdtemp(), 256, 1280)
+                        await asyncio.sleep(0)
+                start = time.perf_counter()
+                work = asyncio.create_task(inline())
+                latencies = []
+                while not work.done():
+                    latencies.extend(await post_at_rate(client, rate, 1, 200_000 + len(latencies)))
+                report["inline"] = percentiles(latencies)
+                report["inline"]["photos_per_second"] = round(photos / (time.perf_counter() - start), 2)
+        return report
+    results.put(asyncio.run(run()))
+
+async def main() -> None:
+    photos = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    rate = float(sys.argv[2]) if len(sys.argv) > 2 else 100
+    stub = StubLineServer()
+    await stub.start()
+    directory = tempfile.mkdtemp(prefix="bench_postprocess_")
+    config = {**app_config(directory, {
+        "reply": stub.reply_endpoint, "push": stub.push_endpoint, "content": stub.content_endpoint}),
+        "POSTPROCESS_WORKERS": 2}
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=run_in_process, args=(config, photos, rate, results))
+    process.start()
+    try:
+        report = await asyncio.to_thread(results.get)
+        await asyncio.to_thread(process.join)
+    finally:
+        await stub.stop()
+        shutil.rmtree(directory, ignore_errors=True)
+    print(f"{photos} photos of {WIDTH}x{HEIGHT}, {rate:.0f} text webhooks a second, {os.cpu_count()} cpus")
+    for phase, numbers in report.items():
+        extra = "".join(f"  {key} {value}" for key, value in numbers.items() if not key.endswith("_ms"))
+        print(f"{phase:10s} ack p50 {numbers['p50_ms']:8.2f} ms  p95 {numbers['p95_ms']:8.2f} ms  "
+              f"p99 {numbers['p99_ms']:8.2f} ms{extra}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,58 @@
+## measure the cost of rejecting replayed webhook events: fresh events 
+## are processed once, then the same payloads are replayed with the 
+## recent-id set warm (memory rejection) and cold (database rejection).
+## run from the repository root: python -m benchmarks.bench_replay
+import asyncio
+import contextlib
+import io
+import os
+import time
+from sqlalchemy.orm import sessionmaker
+from rules import Base
+from caches import recent_events
+from database import DatabaseExecutor, create_database_engine
+from executors import SeniorOfficerBot, ManagerBot
+from benchmarks.payloads import make_text_event, make_payload
+
+PAYLOADS = 500
+EVENTS_PER_PAYLOAD = 4
+
+async def replay(senior: SeniorOfficerBot, executor: DatabaseExecutor, payloads: list) -> float:
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for body in payloads:
+            manager = ManagerBot(senior = senior, DB = executor)
+            manager.body = body
+            await manager.process_payload()
+    return (time.perf_counter() - start) / (len(payloads) * EVENTS_PER_PAYLOAD) * 1e6
+
+async def main() -> None:
+    path = "./bench_replay.db"
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    engine = create_database_engine({"URL": f"sqlite:///{path}"})
+    Base.metadata.create_all(bind=engine)
+    executor = DatabaseExecutor(sessionmaker(autocommit=False, autoflush=False, bind=engine), max_workers=1)
+    senior = SeniorOfficerBot({"CHANNEL_SECRET": "bench", "CHANNEL_ACCESS_TOKEN": "bench"})
+    payloads = [
+        make_payload([make_text_event(f"U{p % 8}", p * EVENTS_PER_PAYLOAD + i)
+                      for i in range(EVENTS_PER_PAYLOAD)])
+        for p in range(PAYLOADS)
+    ]
+    recent_events.clear()
+    fresh = await replay(senior, executor, payloads)
+    warm = await replay(senior, executor, payloads)
+    recent_events.clear()
+    cold = await replay(senior, executor, payloads)
+    executor.shutdown()
+    engine.dispose()
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    print(f"first delivery             {fresh:7.1f} us/event")
+    print(f"replay, rejected in memory {warm:7.1f} us/event")
+    print(f"replay, rejected by table  {cold:7.1f} us/event")
+
+if __name__ == "__main__":
+    asyncio.run(main())
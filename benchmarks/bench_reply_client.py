@@ -0,0 +1,39 @@
+## measure replies/second against a local stub reply endpoint, with a 
+## new aiohttp session per reply (before) and with the pooled 
+## LineApiClient (after).
+## run from the repository root: python -m benchmarks.bench_reply_client
+import asyncio
+import contextlib
+import io
+import time
+from handlers import LineApiClient, ReplyMessageHandler
+from benchmarks.stub_line import StubLineServer
+
+REPLIES = 2000
+CONCURRENCY = 50
+
+async def run(endpoint: str, client: LineApiClient) -> float:
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+    async def reply(index: int) -> None:
+        async with semaphore:
+            await ReplyMessageHandler(endpoint, "bench", f"token{index}", "ok", client=client)
+    start = time.perf_counter()
+    ## silence the per-reply print of the handler
+    with contextlib.redirect_stdout(io.StringIO()):
+        await asyncio.gather(*[reply(i) for i in range(REPLIES)])
+    return REPLIES / (time.perf_counter() - start)
+
+async def main() -> None:
+    server = StubLineServer()
+    await server.start()
+    before = await run(server.reply_endpoint, None)
+    client = LineApiClient(limit_per_host=CONCURRENCY)
+    await client.start()
+    after = await run(server.reply_endpoint, client)
+    await client.close()
+    await server.stop()
+    print(f"session per reply: {before:8.0f} replies/s")
+    print(f"pooled client:     {after:8.0f} replies/s")
+
+if __name__ == "__main__":
+    asyncio.run(main())
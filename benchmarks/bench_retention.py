@@ -0,0 +1,109 @@
+## measure the retention: a data.db with two years of notes is archived 
+## down to the last 90 days and compacted. Reported before and after: 
+## the file size, the rows in message_records, the first page of the 
+## note history, a search, and a page of last year's notes, which is 
+## read from the archive afterwards. The longest archive chunk is how 
+## long a writer may wait behind the retention.
+## run from the repository root: python -m benchmarks.bench_retention
+import os
+import random
+import shutil
+import statistics
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import func, insert, select
+from sqlalchemy.orm import sessionmaker
+from rules import Base, UserInfo, MessageRecords
+from database import create_database_engine
+from search import init_search_index
+from archive import NoteArchive
+from handlers import ArchiveNotesHandler, CompactDatabaseHandler, NotesHistoryHandler, SearchNotesHandler
+
+USERS = 100
+NOTES = 300_000
+DAYS = 730
+RETENTION_DAYS = 90
+CHUNK_SIZE = 500
+PATH = "./bench_retention.db"
+ARCHIVE_DIR = "./bench_retention_archive"
+
+def remove_files() -> None:
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(PATH + suffix):
+            os.remove(PATH + suffix)
+    shutil.rmtree(ARCHIVE_DIR, ignore_errors=True)
+
+def file_mb() -> float:
+    return sum(os.path.getsize(PATH + suffix) for suffix in ("", "-wal")
+               if os.path.exists(PATH + suffix)) / 1e6
+
+def p50_ms(fn, runs: int = 200) -> float:
+    samples = []
+    for index in range(runs):
+        start = time.perf_counter()
+        fn(index)
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples) * 1e3
+
+def measure(Session, archive: NoteArchive, label: str) -> None:
+    year_ago = datetime.now() - timedelta(days=365)
+    with Session() as db:
+        rows = db.execute(select(func.count()).select_from(MessageRecords)).scalar()
+        first = p50_ms(lambda i: NotesHistoryHandler(db, f"U{i % USERS:04d}", limit=20, archive=archive))
+        search = p50_ms(lambda i: SearchNotesHandler(db, f"U{i % USERS:04d}", "groceries", page_size=10))
+        old = p50_ms(lambda i: NotesHistoryHandler(
+            db, f"U{i % USERS:04d}", until=year_ago, limit=20, archive=archive))
+        page = NotesHistoryHandler(db, "U0001", until=year_ago, limit=20, archive=archive)
+    archived = sum(1 for note in page["notes"] if note["archived"])
+    print(f"{label:7s} {file_mb():8.1f} MB {rows:9d} rows  first page {first:6.2f} ms  "
+          f"search {search:6.2f} ms  last year's page {old:6.2f} ms ({archived}/20 archived)")
+
+def main() -> None:
+    remove_files()
+    engine = create_database_engine({"URL": f"sqlite:///{PATH}"})
+    Base.metadata.create_all(bind=engine)
+    init_search_index(engine)
+    Session = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    archive = NoteArchive(ARCHIVE_DIR)
+    random.seed(7)
+    words = ["groceries", "meeting", "idea", "book", "call", "travel", "recipe", "gift"]
+    now = datetime.now()
+    with Session() as db:
+        db.execute(insert(UserInfo), [{"lineUserId": f"U{u:04d}"} for u in range(USERS)])
+        for start in range(0, NOTES, 20_000):
+            db.execute(insert(MessageRecords), [
+                {"userInfo_id": n % USERS + 1, "lineUserId": f"U{n % USERS:04d}",
+                 "message": f"{random.choice(words)} note {n} {random.choice(words)}",
+                 "timestamp": now - timedelta(seconds=random.randrange(DAYS * 86400))}
+                for n in range(start, min(NOTES, start + 20_000))
+            ])
+        db.commit()
+    with engine.connect() as connection:
+        connection.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+    measure(Session, archive, "before")
+    older_than = now - timedelta(days=RETENTION_DAYS)
+    chunks = []
+    start = time.perf_counter()
+    while True:
+        chunk_start = time.perf_counter()
+        with Session() as db:
+            report = ArchiveNotesHandler(db, archive, older_than, chunk_size=CHUNK_SIZE)
+        chunks.append(time.perf_counter() - chunk_start)
+        if report["archived"] < CHUNK_SIZE:
+            break
+    archived_in = time.perf_counter() - start
+    start = time.perf_counter()
+    with Session() as db:
+        compaction = CompactDatabaseHandler(db)
+    compacted_in = time.perf_counter() - start
+    archive_mb = sum(os.path.getsize(os.path.join(directory, name))
+                     for directory, _, names in os.walk(ARCHIVE_DIR) for name in names) / 1e6
+    print(f"archived in {archived_in:.1f} s, {len(chunks)} chunks, longest {max(chunks) * 1e3:.1f} ms, "
+          f"archive {archive_mb:.1f} MB; compacted in {compacted_in:.1f} s, "
+          f"{compaction['freed_pages']} pages freed")
+    measure(Session, archive, "after")
+    engine.dispose()
+    remove_files()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+## measure per-user note search latency over a large message_records 
+## table, FTS5 index against a LIKE '%...%' scan. A quarter of the notes
+## are chinese, written without spaces: their queries take the LIKE path
+## of the handler, the hits the unicode61 index alone finds are shown
+## to tell why.
+## run from the repository root: python -m benchmarks.bench_search [notes]
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime
+from sqlalchemy import insert, select, text
+from sqlalchemy.orm import sessionmaker
+from rules import Base, MessageRecords, UserInfo
+from database import create_database_engine
+from handlers import SearchNotesHandler
+from search import FTS_TABLE, build_match_query, init_search_index
+
+USERS = 100
+QUERIES = 50
+VOCABULARY = 20000
+CJK_VOCABULARY = 2000
+
+def make_words(rng: random.Random) -> list:
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    return ["".join(rng.choice(letters) for _ in range(rng.randint(4, 9)))
+            for _ in range(VOCABULARY)]
+
+## two-character words out of the common han block
+def make_cjk_words(rng: random.Random) -> list:
+    return ["".join(chr(rng.randrange(0x4e00, 0x6000)) for _ in range(2))
+            for _ in range(CJK_VOCABULARY)]
+
+def make_note(rng: random.Random, index: int, words: list, cjk_words: list) -> str:
+    ## every user gets a quarter of their notes in chinese
+    if index // USERS % 4 == 3:
+        return "".join(rng.choice(cjk_words) for _ in range(8))
+    return " ".join(rng.choice(words) for _ in range(8))
+
+## what the unicode61 index finds on its own
+def fts_hits(db, line_user_id: str, query: str) -> int:
+    return db.execute(text(f"SELECT COUNT(*) FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH :match"),
+                      {"match": build_match_query(line_user_id, query)}).scalar()
+
+## the LIKE scan the search replaces, newest matches first
+def like_search(db, line_user_id: str, query: str, page_size: int = 10) -> list:
+    return db.execute(
+        select(MessageRecords.id, MessageRecords.message)
+        .where(MessageRecords.lineUserId == line_user_id,
+               MessageRecords.message.like(f"%{query}%"))
+        .order_by(MessageRecords.timestamp.desc())
+        .limit(page_size + 1)).all()
+
+def build(path: str, notes: int, words: list, cjk_words: list):
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    engine = create_database_engine({"URL": f"sqlite:///{path}"})
+    Base.metadata.create_all(bind=engine)
+    init_search_index(engine)
+    session_factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    db = session_factory()
+    db.execute(insert(UserInfo), [{"lineUserId": f"U{u:04d}"} for u in range(USERS)])
+    rng = random.Random(7)
+    now = datetime.now()
+    for start in range(0, notes, 50000):
+        db.execute(insert(MessageRecords), [
+            {"userInfo_id": i % USERS + 1, "lineUserId": f"U{i % USERS:04d}",
+             "message": make_note(rng, i, words, cjk_words),
+             "timestamp": now}
+            for i in range(start, min(start + 50000, notes))
+        ])
+        db.commit()
+    return engine, db
+
+def timed(fn) -> float:
+    start = time.perf_counter()
+    fn()
+    return (time.perf_counter() - start) * 1000
+
+if __name__ == "__main__":
+    notes = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    path = "./bench_search.db"
+    words = make_words(random.Random(3))
+    cjk_words = make_cjk_words(random.Random(5))
+    engine, db = build(path, notes, words, cjk_words)
+    rng = random.Random(11)
+    cases = [(f"U{rng.randrange(USERS):04d}", rng.choice(words)) for _ in range(QUERIES)]
+    cjk_cases = [(f"U{rng.randrange(USERS):04d}", rng.choice(cjk_words)) for _ in range(QUERIES)]
+    fts = [timed(lambda: SearchNotesHandler(db, user, word)) for user, word in cases]
+    like = [timed(lambda: like_search(db, user, word)) for user, word in cases]
+    cjk = [timed(lambda: SearchNotesHandler(db, user, word)) for user, word in cjk_cases]
+    cjk_found = sum(len(SearchNotesHandler(db, user, word)["results"]) > 0 for user, word in cjk_cases)
+    cjk_fts_found = sum(fts_hits(db, user, word) > 0 for user, word in cjk_cases)
+    print(f"{notes} notes, {USERS} users")
+    print(f"fts5 index  median {statistics.median(fts):8.2f} ms   max {max(fts):8.2f} ms")
+    print(f"like scan   median {statistics.median(like):8.2f} ms   max {max(like):8.2f} ms")
+    print(f"chinese     median {statistics.median(cjk):8.2f} ms   max {max(cjk):8.2f} ms   "
+          f"found {cjk_found}/{QUERIES} queries, unicode61 alone {cjk_fts_found}/{QUERIES}")
+    db.close()
+    engine.dispose()
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
@@ -0,0 +1,99 @@
+## measure the write throughput of the notes against the number of
+## shards: worker processes like the ones of python main.py --workers
+## each run a group commit writer over the shards, and every one of
+## their concurrent requests writes one note of a random user. Reported
+## are the notes committed per second by all of them, with the default
+## synchronous=NORMAL and with synchronous=FULL, where every commit
+## waits for its fsync.
+## All shards are files of one temporary directory on this host, so
+## they share its cpus and its disk. The numbers show what sharding
+## costs on such a host, not how it scales: that needs the shards on
+## separate disks of a host with at least as many cpus as shards.
+## run from the repository root:
+##   python -m benchmarks.bench_shards [processes] [seconds]
+import asyncio
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from typing import Any, Dict
+from sqlalchemy.orm import sessionmaker
+from rules import Message, MessageType
+from sharding import ShardedDatabaseExecutor, prepare_shard, shard_urls
+from database import DatabaseExecutor, create_database_engine
+from writers import GroupCommitWriter
+
+USERS = 10000
+CONCURRENCY = 64
+SHARD_COUNTS = (1, 2, 4, 8)
+
+def make_executor(database_config: Dict[str, Any]):
+    engines = [create_database_engine({**database_config, "URL": url})
+               for url in shard_urls(database_config)]
+    factories = [sessionmaker(autocommit=False, autoflush=False, bind=engine) for engine in engines]
+    if len(factories) == 1:
+        return DatabaseExecutor(factories[0], max_workers=4)
+    return ShardedDatabaseExecutor(factories, max_workers=4)
+
+def write_in_process(database_config: Dict[str, Any], seed: int, start_at: float, seconds: float, results) -> None:
+    async def run() -> int:
+        executor = make_executor(database_config)
+        writer = GroupCommitWriter(executor = executor)
+        writer.start()
+        rng = random.Random(seed)
+        written = 0
+        await asyncio.sleep(max(0.0, start_at - time.time()))
+        deadline = time.perf_counter() + seconds
+        async def request() -> None:
+            nonlocal written
+            while time.perf_counter() < deadline:
+                status = await writer.submit([Message(
+                    msg_id = "0", msg_type = MessageType.TEXT, msg_text = "a note #bench",
+                    owner_id = f"U{rng.randrange(USERS):05d}")])
+                written += status.success
+        await asyncio.gather(*[request() for _ in range(CONCURRENCY)])
+        await writer.stop()
+        executor.shutdown()
+        return written
+    results.put(asyncio.run(run()))
+
+def measure(directory: str, shards: int, synchronous: str, processes: int, seconds: float) -> float:
+    database_config = {"URL": f"sqlite:///{directory}/data.db", "SHARDS": shards,
+                       "SHARD_URL": f"sqlite:///{directory}/data-{{shard}}.db",
+                       "SYNCHRONOUS": synchronous}
+    for url in shard_urls(database_config):
+        engine = create_database_engine({**database_config, "URL": url})
+        prepare_shard(engine)
+        engine.dispose()
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    ## the processes start writing together once all of them imported
+    start_at = time.time() + 3
+    workers = [context.Process(target=write_in_process,
+                               args=(database_config, seed, start_at, seconds, results))
+               for seed in range(processes)]
+    for worker in workers:
+        worker.start()
+    written = sum(results.get() for _ in workers)
+    for worker in workers:
+        worker.join()
+    return written / seconds
+
+if __name__ == "__main__":
+    processes = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+    print(f"{processes} processes writing for {seconds:.0f} s, {os.cpu_count()} cpus")
+    for synchronous in ("NORMAL", "FULL"):
+        for shards in SHARD_COUNTS:
+            directory = tempfile.mkdtemp(prefix="bench_shards_")
+            try:
+                rate = measure(directory, shards, synchronous, processes, seconds)
+            finally:
+                shutil.rmtree(directory, ignore_errors=True)
+            print(f"synchronous={synchronous:6s} {shards} shards  {rate:8.0f} notes/s")
+    if (os.cpu_count() or 1) < max(SHARD_COUNTS):
+        print(f"the shards share {os.cpu_count()} cpus and one disk: "
+              "this measures the overhead of sharding, not its scaling")
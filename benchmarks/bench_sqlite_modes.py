@@ -0,0 +1,45 @@
+## measure single-row commits/second for sqlite journal settings, the 
+## default rollback journal against the WAL configuration of database.py.
+## run from the repository root: python -m benchmarks.bench_sqlite_modes
+import os
+import time
+from datetime import datetime
+from sqlalchemy.orm import sessionmaker
+from rules import Base, UserInfo, MessageRecords
+from database import create_database_engine
+
+COMMITS = 1000
+MODES = [
+    ("DELETE / FULL", {"JOURNAL_MODE": "DELETE", "SYNCHRONOUS": "FULL"}),
+    ("WAL / FULL", {"JOURNAL_MODE": "WAL", "SYNCHRONOUS": "FULL"}),
+    ("WAL / NORMAL", {"JOURNAL_MODE": "WAL", "SYNCHRONOUS": "NORMAL"}),
+]
+
+def remove_database(path: str) -> None:
+    for suffix in ("", "-wal", "-shm", "-journal"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+def run(mode_config: dict) -> float:
+    path = "./bench_modes.db"
+    remove_database(path)
+    engine = create_database_engine({"URL": f"sqlite:///{path}", **mode_config})
+    Base.metadata.create_all(bind=engine)
+    db = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+    user = UserInfo(lineUserId="Ubench")
+    db.add(user)
+    db.commit()
+    start = time.perf_counter()
+    for i in range(COMMITS):
+        db.add(MessageRecords(userInfo_id=user.id, lineUserId="Ubench",
+                              message=f"note {i}", timestamp=datetime.now()))
+        db.commit()
+    elapsed = time.perf_counter() - start
+    db.close()
+    engine.dispose()
+    remove_database(path)
+    return COMMITS / elapsed
+
+if __name__ == "__main__":
+    for name, mode_config in MODES:
+        print(f"{name:<16} {run(mode_config):8.0f} commits/s")
@@ -0,0 +1,110 @@
+## measure the tag index for a user with many notes: the tag list read
+## from the counts in user_tags against a GROUP BY over note_tags and
+## against extracting the tags from every note again, the latest notes
+## of a tag from note_tags against a LIKE scan, and the cost the index
+## adds to a batch write.
+## run from the repository root: python -m benchmarks.bench_tags [notes]
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import func, select
+from sqlalchemy.orm import sessionmaker
+from rules import Base, MessageRecords, MessageType, Message, NoteTags, Tags, UserInfo
+from database import create_database_engine
+from handlers import MessageRecordsBatchHandler, TagNotesHandler, UserTagsHandler
+from tags import extract_tags
+
+TAGS = 300
+QUERIES = 50
+BATCH = 100
+USER = "Uheavy"
+
+def note_text(rng: random.Random, tagged: bool) -> str:
+    words = " ".join(rng.choice(("milk", "call", "read", "plan", "fix", "buy")) for _ in range(6))
+    if not tagged:
+        return words
+    ## a few tags are used a lot, most of them rarely
+    tags = {f"tag{min(int(rng.paretovariate(1.2)) - 1, TAGS - 1)}" for _ in range(rng.randint(1, 3))}
+    return words + " " + " ".join(f"#{tag}" for tag in tags)
+
+def build(path: str, notes: int):
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    engine = create_database_engine({"URL": f"sqlite:///{path}"})
+    Base.metadata.create_all(bind=engine)
+    session_factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    db = session_factory()
+    rng = random.Random(7)
+    start = datetime.now() - timedelta(days=365)
+    ## written through the batch handler, so the index is built the way
+    ## the app builds it
+    for offset in range(0, notes, 5000):
+        MessageRecordsBatchHandler(db, [
+            Message(msg_id=str(index), msg_type=MessageType.TEXT, owner_id=USER,
+                    msg_text=note_text(rng, index % 2 == 0),
+                    msg_timestamp=start + timedelta(minutes=index))
+            for index in range(offset, min(offset + 5000, notes))
+        ])
+    return engine, db
+
+def timed(fn) -> float:
+    start = time.perf_counter()
+    fn()
+    return (time.perf_counter() - start) * 1000
+
+def group_by_tags(db) -> list:
+    return db.execute(
+        select(Tags.name, func.count())
+        .select_from(NoteTags)
+        .join(Tags, Tags.id == NoteTags.tag_id)
+        .join(UserInfo, UserInfo.id == NoteTags.userInfo_id)
+        .where(UserInfo.lineUserId == USER)
+        .group_by(Tags.name).order_by(func.count().desc()).limit(100)).all()
+
+def recount_tags(db) -> dict:
+    counts = {}
+    for message in db.execute(select(MessageRecords.message)
+                              .where(MessageRecords.lineUserId == USER)).scalars():
+        for tag in extract_tags(message):
+            counts[tag] = counts.get(tag, 0) + 1
+    return counts
+
+def like_tag_notes(db, tag: str) -> list:
+    return db.execute(
+        select(MessageRecords.id, MessageRecords.message)
+        .where(MessageRecords.lineUserId == USER, MessageRecords.message.like(f"%#{tag}%"))
+        .order_by(MessageRecords.timestamp.desc()).limit(5)).all()
+
+def write_batches(db, rng: random.Random, tagged: bool) -> list:
+    batches = [[Message(msg_id="0", msg_type=MessageType.TEXT, owner_id=f"U{index % 50:03d}",
+                        msg_text=note_text(rng, tagged)) for index in range(BATCH)]
+               for _ in range(20)]
+    return [timed(lambda: MessageRecordsBatchHandler(db, batch)) for batch in batches]
+
+def report(name: str, samples: list) -> None:
+    print(f"{name:28s} median {statistics.median(samples):8.2f} ms   max {max(samples):8.2f} ms")
+
+if __name__ == "__main__":
+    notes = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    path = "./bench_tags.db"
+    engine, db = build(path, notes)
+    rng = random.Random(11)
+    cases = [f"tag{min(int(rng.paretovariate(1.2)) - 1, TAGS - 1)}" for _ in range(QUERIES)]
+    assert UserTagsHandler(db, USER)["tags"][0]["count"] == group_by_tags(db)[0][1]
+    print(f"{notes} notes of one user, half of them tagged, {TAGS} tags")
+    report("tag list from user_tags", [timed(lambda: UserTagsHandler(db, USER)) for _ in range(QUERIES)])
+    report("tag list by group by", [timed(lambda: group_by_tags(db)) for _ in range(5)])
+    report("tag list by re-extracting", [timed(lambda: recount_tags(db)) for _ in range(3)])
+    report("tag notes from note_tags", [timed(lambda: TagNotesHandler(db, USER, tag, 5)) for tag in cases])
+    report("tag notes by like scan", [timed(lambda: like_tag_notes(db, tag)) for tag in cases[:10]])
+    report(f"write {BATCH} untagged notes", write_batches(db, rng, False))
+    report(f"write {BATCH} tagged notes", write_batches(db, rng, True))
+    db.close()
+    engine.dispose()
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
@@ -0,0 +1,115 @@
+## load test the multi-worker launcher: python main.py --workers N is 
+## started for each N against the stub line server, signed webhooks 
+## are posted concurrently, and the acknowledged and fully processed 
+## events per second are reported. Scaling needs N free cores, on a 
+## smaller machine the workers only share the ones there are.
+## run from the repository root: python -m benchmarks.bench_workers
+import asyncio
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import httpx
+import yaml
+from benchmarks.payloads import make_text_event, make_payload, sign
+from benchmarks.stub_line import StubLineServer
+
+WORKER_COUNTS = (1, 2, 4)
+REQUESTS = 2000
+EVENTS_PER_REQUEST = 4
+CONCURRENCY = 64
+USERS = 64
+SECRET = "bench"
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+async def wait_until_up(client: httpx.AsyncClient, base: str, timeout: float = 30.0) -> None:
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            if (await client.get(f"{base}/stats")).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError("server did not start")
+
+async def post_all(client: httpx.AsyncClient, base: str, bodies: list) -> None:
+    pending = iter(bodies)
+    async def sender() -> None:
+        for body in pending:
+            response = await client.post(
+                f"{base}/webhook",
+                content=body,
+                headers={"Content-Type": "application/json", "X-Line-Signature": sign(body, SECRET)})
+            response.raise_for_status()
+    await asyncio.gather(*[sender() for _ in range(CONCURRENCY)])
+
+async def wait_until_drained(client: httpx.AsyncClient, base: str) -> None:
+    while True:
+        queue = (await client.get(f"{base}/stats")).json()["queue"]
+        if queue["depth"] == 0 and queue["running"] == 0:
+            return
+        await asyncio.sleep(0.05)
+
+async def run(workers: int, stub: StubLineServer, run_id: int) -> tuple:
+    directory = tempfile.mkdtemp(prefix="bench_workers_")
+    port = free_port()
+    config = {
+        "CHANNEL_SECRET": SECRET,
+        "CHANNEL_ACCESS_TOKEN": "bench",
+        "REPLY_ENDPOINT": stub.reply_endpoint,
+        "CONTENT_ENDPOINT": stub.content_endpoint,
+        "DATABASE": {"URL": f"sqlite:///{directory}/data.db"},
+        "QUEUE_PATH": f"{directory}/queue.db",
+        "MEDIA_DIR": f"{directory}/media",
+        "LOCK_DIR": f"{directory}/locks",
+    }
+    config_path = os.path.join(directory, "config.yaml")
+    with open(config_path, "w") as file:
+        yaml.safe_dump(config, file)
+    bodies = [
+        make_payload([make_text_event(f"U{(r * EVENTS_PER_REQUEST + i) % USERS:04d}",
+                                      run_id * 10_000_000 + r * EVENTS_PER_REQUEST + i)
+                      for i in range(EVENTS_PER_REQUEST)])
+        for r in range(REQUESTS)
+    ]
+    server = subprocess.Popen(
+        [sys.executable, "main.py", "--workers", str(workers), "--host", "127.0.0.1", "--port", str(port)],
+        env={**os.environ, "APP_CONFIG_PATH": config_path},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL)
+    base = f"http://127.0.0.1:{port}"
+    try:
+        limits = httpx.Limits(max_connections=CONCURRENCY)
+        async with httpx.AsyncClient(limits=limits, timeout=60) as client:
+            await wait_until_up(client, base)
+            start = time.perf_counter()
+            await post_all(client, base, bodies)
+            acked = time.perf_counter() - start
+            await wait_until_drained(client, base)
+            drained = time.perf_counter() - start
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(directory, ignore_errors=True)
+    return (REQUESTS / acked, REQUESTS * EVENTS_PER_REQUEST / drained)
+
+async def main() -> None:
+    stub = StubLineServer()
+    await stub.start()
+    print(f"{os.cpu_count()} cores, {REQUESTS} requests of {EVENTS_PER_REQUEST} events")
+    print("workers  acknowledged req/s  processed events/s")
+    for run_id, workers in enumerate(WORKER_COUNTS):
+        acked, processed = await run(workers, stub, run_id)
+        print(f"{workers:7d}  {acked:18.0f}  {processed:18.0f}")
+    await stub.stop()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,321 @@
+## the end-to-end benchmark of the webhook pipeline: signed payloads of
+## a scenario's event mix are posted to the real app, in-process over
+## the httpx asgi transport or to python main.py --workers N over
+## uvicorn, with the stub line server answering the reply, push and
+## content calls. Per scenario and mode it reports the webhook
+## acknowledgement throughput and p50/p95/p99, the events processed
+## per second until the queue drained, the p50/p95/p99 from a post to
+## its reply reaching the stub, and the peak memory of the app.
+## run from the repository root:
+##   python -m benchmarks.harness --mode both --output results.json
+##   python -m benchmarks.harness --compare baseline.json results.json
+import argparse
+import asyncio
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+import httpx
+import orjson
+from benchmarks.payloads import make_mixed_payloads, sign
+from benchmarks.stub_line import StubLineServer
+
+SECRET = "bench"
+SCENARIOS: Dict[str, Dict[str, Any]] = {
+    "text_only": {"mix": {"text": 1.0}, "redelivery_ratio": 0.0},
+    "mixed": {"mix": {"text": 0.7, "image": 0.15, "audio": 0.05, "file": 0.1}, "redelivery_ratio": 0.05},
+    "media_heavy": {"mix": {"text": 0.2, "image": 0.5, "audio": 0.1, "file": 0.2}, "redelivery_ratio": 0.0},
+    "redelivery_storm": {"mix": {"text": 0.9, "image": 0.1}, "redelivery_ratio": 0.5},
+}
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    if len(samples) == 0:
+        return {"p50_ms": None, "p95_ms": None, "p99_ms": None}
+    ordered = sorted(samples)
+    def at(q: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1e3, 3)
+    return {"p50_ms": at(0.50), "p95_ms": at(0.95), "p99_ms": at(0.99)}
+
+def app_config(directory: str, stub: Dict[str, str]) -> Dict[str, Any]:
+    return {
+        "CHANNEL_SECRET": SECRET,
+        "CHANNEL_ACCESS_TOKEN": "bench",
+        "REPLY_ENDPOINT": stub["reply"],
+        "PUSH_ENDPOINT": stub["push"],
+        "CONTENT_ENDPOINT": stub["content"],
+        "DATABASE": {"URL": f"sqlite:///{directory}/data.db"},
+        "QUEUE_PATH": f"{directory}/queue.db",
+        "MEDIA_DIR": f"{directory}/media",
+        "LOCK_DIR": f"{directory}/locks",
+        "ARCHIVE_DIR": f"{directory}/archive",
+        "LOG_LEVEL": "WARNING",
+        ## the benchmark users send far above a real user's rate
+        "OUTBOUND_USER_RATE": 1000,
+        "OUTBOUND_USER_BURST": 1000,
+        "ADMISSION_USER_RATE": None,
+    }
+
+## post every body with concurrency senders, returns the send time of
+## each reply token and the acknowledgement latencies
+async def drive(
+        client: httpx.AsyncClient,
+        bodies: List[bytes],
+        concurrency: int
+        ) -> Tuple[Dict[str, float], List[float], int]:
+    pending = iter(bodies)
+    sent_at: Dict[str, float] = {}
+    latencies: List[float] = []
+    errors = 0
+    async def sender() -> None:
+        nonlocal errors
+        for body in pending:
+            headers = {"Content-Type": "application/json", "X-Line-Signature": sign(body, SECRET)}
+            now = time.time()
+            for event in orjson.loads(body)["events"]:
+                if event["replyToken"] != "":
+                    sent_at[event["replyToken"]] = now
+            start = time.perf_counter()
+            response = await client.post("/webhook", content=body, headers=headers)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                errors += 1
+    await asyncio.gather(*[sender() for _ in range(concurrency)])
+    return (sent_at, latencies, errors)
+
+## wait until the queue is empty and the dispatcher sent every reply
+async def wait_drained(client: httpx.AsyncClient, timeout: float = 300.0) -> None:
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        stats = (await client.get("/stats")).json()
+        queue, outbound = stats["queue"], stats.get("outbound", {})
+        if queue["depth"] == 0 and queue["running"] == 0 and \
+                outbound.get("queued", 0) == 0 and outbound.get("sending", 0) == 0 and \
+                outbound.get("scheduled", 0) == 0:
+            return
+        await asyncio.sleep(0.02)
+    raise TimeoutError("the pipeline did not drain")
+
+async def measure(client: httpx.AsyncClient, bodies: List[bytes], concurrency: int) -> Dict[str, Any]:
+    start = time.perf_counter()
+    sent_at, latencies, errors = await drive(client, bodies, concurrency)
+    acked = time.perf_counter() - start
+    await wait_drained(client)
+    drained = time.perf_counter() - start
+    events = sum(len(orjson.loads(body)["events"]) for body in bodies)
+    return {
+        "sent_at": sent_at,
+        "ack": {"throughput_rps": round(len(bodies) / acked, 1), "errors": errors, **percentiles(latencies)},
+        "pipeline": {"events": events, "drain_seconds": round(drained, 3),
+                     "events_per_second": round(events / drained, 1)},
+    }
+
+## the in-process run, in a spawned process of its own so every
+## scenario starts with a fresh app, database and memory peak
+def run_in_process(config: Dict[str, Any], bodies: List[bytes], concurrency: int, results) -> None:
+    os.environ["APP_CONFIG"] = orjson.dumps(config).decode()
+    async def run() -> Dict[str, Any]:
+        import main
+        async with main.lifespan(main.app):
+            rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+            transport = httpx.ASGITransport(app=main.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as client:
+                result = await measure(client, bodies, concurrency)
+        result["memory"] = {
+            "rss_start_mb": round(rss_start, 1),
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        }
+        return result
+    results.put(asyncio.run(run()))
+
+def peak_rss_mb(pid: int) -> float:
+    total = 0.0
+    pids = [pid]
+    while len(pids) > 0:
+        current = pids.pop()
+        try:
+            with open(f"/proc/{current}/status") as status:
+                for line in status:
+                    if line.startswith("VmHWM:"):
+                        total += int(line.split()[1]) / 1024
+            with open(f"/proc/{current}/task/{current}/children") as children:
+                pids.extend(int(child) for child in children.read().split())
+        except (FileNotFoundError, ProcessLookupError):
+            pass
+    return round(total, 1)
+
+async def run_asgi(config: Dict[str, Any], bodies: List[bytes], concurrency: int) -> Dict[str, Any]:
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=run_in_process, args=(config, bodies, concurrency, results))
+    process.start()
+    result = await asyncio.to_thread(results.get)
+    await asyncio.to_thread(process.join)
+    return result
+
+async def run_uvicorn(config: Dict[str, Any], bodies: List[bytes], concurrency: int, workers: int) -> Dict[str, Any]:
+    import socket
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = subprocess.Popen(
+        [sys.executable, "main.py", "--workers", str(workers), "--host", "127.0.0.1", "--port", str(port)],
+        env={**os.environ, "APP_CONFIG": orjson.dumps(config).decode()},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL)
+    try:
+        limits = httpx.Limits(max_connections=concurrency)
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", limits=limits, timeout=60) as client:
+            deadline = time.perf_counter() + 30
+            while True:
+                try:
+                    if (await client.get("/stats")).status_code == 200:
+                        break
+                except httpx.TransportError:
+                    if time.perf_counter() > deadline:
+                        raise
+                await asyncio.sleep(0.2)
+            rss_start = peak_rss_mb(server.pid)
+            result = await measure(client, bodies, concurrency)
+        result["memory"] = {"rss_start_mb": rss_start, "peak_rss_mb": peak_rss_mb(server.pid)}
+    finally:
+        server.terminate()
+        server.wait()
+    return result
+
+async def run_scenario(
+        name: str,
+        mode: str,
+        stub: StubLineServer,
+        args: argparse.Namespace,
+        run_id: int
+        ) -> Dict[str, Any]:
+    scenario = SCENARIOS[name]
+    bodies = make_mixed_payloads(
+        count = args.requests,
+        events_per_payload = args.events_per_request,
+        mix = scenario["mix"],
+        redelivery_ratio = scenario["redelivery_ratio"],
+        users = args.users,
+        seed = args.seed,
+        prefix = f"01H{run_id:04d}"
+    )
+    directory = tempfile.mkdtemp(prefix="bench_harness_")
+    config = app_config(directory, {
+        "reply": stub.reply_endpoint, "push": stub.push_endpoint, "content": stub.content_endpoint})
+    stub.calls.clear()
+    try:
+        if mode == "asgi":
+            result = await run_asgi(config, bodies, args.concurrency)
+        else:
+            result = await run_uvicorn(config, bodies, args.concurrency, args.workers)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    sent_at = result.pop("sent_at")
+    replies = [call for call in stub.calls if call["path"].endswith("/reply")]
+    reply_latencies = [call["at"] - sent_at[call["body"]["replyToken"]]
+                       for call in replies if call["body"]["replyToken"] in sent_at]
+    result["reply"] = {
+        "calls": len(replies),
+        "pushes": sum(1 for call in stub.calls if call["path"].endswith("/push")),
+        "content_fetches": sum(1 for call in stub.calls if call["path"].endswith("/content")),
+        **percentiles(reply_latencies),
+    }
+    return {"scenario": name, "mode": mode, **result}
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_result(result: Dict[str, Any]) -> None:
+    ack, pipeline, reply, memory = result["ack"], result["pipeline"], result["reply"], result["memory"]
+    print(f"{result['scenario']:17s} {result['mode']:7s} "
+          f"ack {ack['throughput_rps']:7.1f} req/s p50/95/99 {ack['p50_ms']}/{ack['p95_ms']}/{ack['p99_ms']} ms  "
+          f"pipeline {pipeline['events_per_second']:7.1f} events/s  "
+          f"reply p50/95/99 {reply['p50_ms']}/{reply['p95_ms']}/{reply['p99_ms']} ms  "
+          f"peak {memory['peak_rss_mb']} MB")
+
+## the differences between two result files, a throughput down or a
+## p95 up by more than threshold is a regression
+def compare(baseline: Dict[str, Any], current: Dict[str, Any], threshold: float) -> List[str]:
+    regressions = []
+    before = {(result["scenario"], result["mode"]): result for result in baseline["results"]}
+    checks = [
+        ("ack", "throughput_rps", -1),
+        ("ack", "p95_ms", 1),
+        ("pipeline", "events_per_second", -1),
+        ("reply", "p95_ms", 1),
+        ("memory", "peak_rss_mb", 1),
+    ]
+    for result in current["results"]:
+        key = (result["scenario"], result["mode"])
+        if key not in before:
+            continue
+        for section, metric, worse in checks:
+            old, new = before[key][section][metric], result[section][metric]
+            if old in (None, 0) or new is None:
+                continue
+            change = (new - old) / old
+            flag = change * worse > threshold
+            print(f"{key[0]:17s} {key[1]:7s} {section}.{metric:18s} {old:10.1f} -> {new:10.1f} "
+                  f"{change * 100:+6.1f}%{'  REGRESSION' if flag else ''}")
+            if flag:
+                regressions.append(f"{key[0]}/{key[1]} {section}.{metric}")
+    return regressions
+
+async def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=("asgi", "uvicorn", "both"), default="asgi")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--events-per-request", type=int, default=4)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--content-size", type=int, default=64 * 1024)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CURRENT"))
+    parser.add_argument("--threshold", type=float, default=0.10)
+    args = parser.parse_args()
+    if args.compare is not None:
+        with open(args.compare[0], "rb") as baseline, open(args.compare[1], "rb") as current:
+            regressions = compare(orjson.loads(baseline.read()), orjson.loads(current.read()), args.threshold)
+        return 1 if len(regressions) > 0 else 0
+    modes = ("asgi", "uvicorn") if args.mode == "both" else (args.mode,)
+    stub = StubLineServer(content_size=args.content_size, content_variants=50)
+    await stub.start()
+    results = []
+    run_id = int(time.time()) % 10000
+    try:
+        for name in args.scenarios.split(","):
+            for mode in modes:
+                result = await run_scenario(name, mode, stub, args, run_id)
+                run_id += 1
+                print_result(result)
+                results.append(result)
+    finally:
+        await stub.stop()
+    report = {
+        "commit": git_commit(),
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "host": {"cpus": os.cpu_count(), "python": platform.python_version(), "platform": platform.platform()},
+        "settings": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "results": results,
+    }
+    if args.output is not None:
+        with open(args.output, "wb") as output:
+            output.write(orjson.dumps(report, option=orjson.OPT_INDENT_2))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
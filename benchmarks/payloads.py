@@ -0,0 +1,105 @@
+import base64
+import hashlib
+import hmac
+import orjson
+import random
+import time
+from typing import Any, Dict, List
+
+## build line webhook payloads for the benchmarks, the shape follows 
+## WebhookEventDocument: https://developers.line.biz/en/reference/
+## messaging-api/#message-event
+def make_event(
+        line_user_id: str,
+        index: int,
+        message: Dict[str, Any],
+        reply_token: str = "",
+        prefix: str = "01BENCH"
+        ) -> Dict[str, Any]:
+    return {
+        "type": "message",
+        "mode": "active",
+        "timestamp": int(time.time() * 1000),
+        "source": {"type": "user", "userId": line_user_id},
+        "webhookEventId": f"{prefix}{line_user_id}{index:08d}",
+        "deliveryContext": {"isRedelivery": False},
+        "replyToken": reply_token,
+        "message": {"id": str(index), **message},
+    }
+
+def make_text_event(line_user_id: str, index: int, text: str = None) -> Dict[str, Any]:
+    if text is None:
+        text = f"quick note number {index}"
+    return make_event(line_user_id, index, {"type": "text", "text": text})
+
+## image, audio and file messages carry no content, the app fetches it 
+## from the content endpoint by message id
+def make_media_event(
+        line_user_id: str,
+        index: int,
+        message_type: str,
+        reply_token: str = "",
+        prefix: str = "01BENCH"
+        ) -> Dict[str, Any]:
+    message: Dict[str, Any] = {"type": message_type}
+    if message_type == "image":
+        message["contentProvider"] = {"type": "line"}
+    elif message_type == "audio":
+        message["contentProvider"] = {"type": "line"}
+        message["duration"] = 4000
+    elif message_type == "file":
+        message["fileName"] = f"document-{index}.pdf"
+        message["fileSize"] = 65536
+    return make_event(line_user_id, index, message, reply_token, prefix)
+
+## line sends an event again with isRedelivery when the first delivery 
+## was not acknowledged, the webhookEventId stays the same
+def make_redelivery(event: Dict[str, Any]) -> Dict[str, Any]:
+    return {**event, "deliveryContext": {"isRedelivery": True}, "replyToken": ""}
+
+## count payloads of events_per_payload events drawn from mix, e.g. 
+## {"text": 0.7, "image": 0.2, "file": 0.1}, from users distinct users. 
+## A share of redelivery_ratio of the events are redeliveries of events 
+## sent before. The same seed builds the same payloads
+def make_mixed_payloads(
+        count: int,
+        events_per_payload: int,
+        mix: Dict[str, float],
+        redelivery_ratio: float = 0.0,
+        users: int = 100,
+        seed: int = 0,
+        prefix: str = "01BENCH"
+        ) -> List[bytes]:
+    rng = random.Random(seed)
+    types, weights = list(mix.keys()), list(mix.values())
+    sent: List[Dict[str, Any]] = []
+    payloads = []
+    index = 0
+    for _ in range(count):
+        events = []
+        for _ in range(events_per_payload):
+            if len(sent) > 0 and rng.random() < redelivery_ratio:
+                events.append(make_redelivery(rng.choice(sent)))
+                continue
+            index += 1
+            line_user_id = f"U{rng.randrange(users):032x}"
+            reply_token = f"{prefix}-{index}"
+            message_type = rng.choices(types, weights)[0]
+            if message_type == "text":
+                words = rng.choices(["groceries", "meeting", "idea", "book", "call", "gift"], k=4)
+                event = make_event(line_user_id, index, {"type": "text", "text": " ".join(words)},
+                                   reply_token, prefix)
+            else:
+                event = make_media_event(line_user_id, index, message_type, reply_token, prefix)
+            sent.append(event)
+            events.append(event)
+        payloads.append(make_payload(events))
+    return payloads
+
+def make_payload(events: List[Dict[str, Any]]) -> bytes:
+    return orjson.dumps({"destination": "Ubenchmark", "events": events})
+
+## the x-line-signature line would send with the body
+def sign(body: bytes, channel_secret: str) -> str:
+    digest = hmac.new(channel_secret.encode('utf-8'), body, hashlib.sha256).digest()
+    return base64.b64encode(digest).decode()
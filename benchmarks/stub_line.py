@@ -0,0 +1,106 @@
+import asyncio
+import time
+from typing import Any, Dict, List, Set
+from aiohttp import web
+
+## a local stand-in for the line messaging api, it answers the reply 
+## and push endpoints like line does and records every call it 
+## receives. The content endpoint streams content_size bytes per 
+## message, messages whose ids are equal modulo content_variants get 
+## the same bytes. A reply token in invalid_reply_tokens, or used 
+## before, is answered 400, and the next fail_next calls get a 500
+class StubLineServer:
+    def __init__(
+            self,
+            host: str = "127.0.0.1",
+            port: int = 0,
+            content_size: int = 1024 * 1024,
+            content_variants: int = 0
+            ) -> None:
+        self.host = host
+        self.port = port
+        self.content_size = content_size
+        self.content_variants = content_variants
+        self.calls: List[Dict[str, Any]] = []
+        self.invalid_reply_tokens: Set[str] = set()
+        self.used_reply_tokens: Set[str] = set()
+        self.push_retry_keys: Set[str] = set()
+        self.fail_next = 0
+        self.runner: web.AppRunner = None
+    def __failing(self) -> bool:
+        if self.fail_next > 0:
+            self.fail_next -= 1
+            return True
+        return False
+    def __answer(self, call: Dict[str, Any], status: int, body: Dict[str, Any]) -> web.Response:
+        call["status"] = status
+        call["at"] = time.time()
+        self.calls.append(call)
+        return web.json_response(body, status=status)
+    async def __reply(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        call = {"path": request.path, "body": body}
+        if self.__failing():
+            return self.__answer(call, 500, {"message": "stub failure"})
+        token = body.get("replyToken")
+        if token in self.invalid_reply_tokens or token in self.used_reply_tokens:
+            return self.__answer(call, 400, {"message": "Invalid reply token"})
+        self.used_reply_tokens.add(token)
+        return self.__answer(call, 200, {})
+    async def __push(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        retry_key = request.headers.get("X-Line-Retry-Key")
+        call = {"path": request.path, "body": body, "retry_key": retry_key}
+        if self.__failing():
+            return self.__answer(call, 500, {"message": "stub failure"})
+        if retry_key is not None:
+            if retry_key in self.push_retry_keys:
+                return self.__answer(call, 409, {"message": "The retry key is already accepted"})
+            self.push_retry_keys.add(retry_key)
+        return self.__answer(call, 200, {"sentMessages": [{"id": "0"} for _ in body.get("messages", [])]})
+    async def __content(self, request: web.Request) -> web.StreamResponse:
+        message_id = request.match_info["messageId"]
+        self.calls.append({"path": request.path, "body": None, "status": 200})
+        seed = message_id
+        if self.content_variants > 0 and message_id.isdigit():
+            seed = str(int(message_id) % self.content_variants)
+        seed = f"<{seed}>".encode()
+        block = (seed * (64 * 1024 // len(seed) + 1))[:64 * 1024]
+        response = web.StreamResponse(headers={"Content-Type": "image/jpeg"})
+        response.content_length = self.content_size
+        await response.prepare(request)
+        remaining = self.content_size
+        while remaining > 0:
+            await response.write(block[:remaining])
+            remaining -= len(block)
+        await response.write_eof()
+        return response
+    @property
+    def reply_endpoint(self) -> str:
+        return f"http://{self.host}:{self.port}/v2/bot/message/reply"
+    @property
+    def push_endpoint(self) -> str:
+        return f"http://{self.host}:{self.port}/v2/bot/message/push"
+    @property
+    def content_endpoint(self) -> str:
+        return f"http://{self.host}:{self.port}/v2/bot/message/{{messageId}}/content"
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_post("/v2/bot/message/reply", self.__reply)
+        app.router.add_post("/v2/bot/message/push", self.__push)
+        app.router.add_get("/v2/bot/message/{messageId}/content", self.__content)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+    async def stop(self) -> None:
+        await self.runner.cleanup()
+
+if __name__ == "__main__":
+    async def serve() -> None:
+        server = StubLineServer(port=8081)
+        await server.start()
+        print(f"stub line server on {server.reply_endpoint}")
+        await asyncio.Event().wait()
+    asyncio.run(serve())
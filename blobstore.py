@@ -0,0 +1,96 @@
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import time
+from typing import Iterator, Optional, Set, Tuple
+
+## the blob store keeps attachments content-addressed: a file lives at
+## root/<sha256[0:2]>/<sha256[2:4]>/<sha256>, the hash is computed while
+## the content streams in, and a duplicate upload only costs a row in
+## the blobs table instead of another copy on disk
+class BlobStore:
+    def __init__(self, root: str = "./media") -> None:
+        self.root = root
+        self.tmp_dir = os.path.join(root, "tmp")
+        os.makedirs(self.tmp_dir, exist_ok=True)
+    def path_for(self, sha256: str) -> str:
+        return os.path.join(self.root, sha256[0:2], sha256[2:4], sha256)
+    ## the directory of the thumbnail and preview of a blob, removed 
+    ## with it. A file stored before the blob store is keyed by the 
+    ## hash of its path
+    def variants_dir(self, path: str) -> str:
+        name = os.path.basename(path)
+        if re.fullmatch(r"[0-9a-f]{64}", name) is None:
+            name = hashlib.sha256(path.encode()).hexdigest()
+        return os.path.join(self.root, "variants", name[0:2], name)
+    ## a path of the store as the clients see it, relative to the root. 
+    ## A path outside the root is not shown at all, the host file 
+    ## system is nothing the clients should know
+    def relative_path(self, path: Optional[str]) -> Optional[str]:
+        if path is None:
+            return None
+        relative = os.path.relpath(os.path.abspath(path), os.path.abspath(self.root))
+        if relative == os.pardir or relative.startswith(os.pardir + os.sep):
+            return None
+        return relative.replace(os.sep, "/")
+    def open_writer(self) -> "BlobWriter":
+        return BlobWriter(self)
+    ## every blob file on disk as (sha256, path)
+    def iter_blobs(self) -> Iterator[Tuple[str, str]]:
+        for first in os.listdir(self.root):
+            if first == "tmp" or len(first) != 2:
+                continue
+            for second in os.listdir(os.path.join(self.root, first)):
+                directory = os.path.join(self.root, first, second)
+                for name in os.listdir(directory):
+                    yield (name, os.path.join(directory, name))
+    ## remove the blob files not in keep and untouched for grace_seconds,
+    ## the grace period covers uploads whose row is not committed yet
+    def remove_unreferenced(self, keep: Set[str], grace_seconds: float) -> int:
+        removed = 0
+        cutoff = time.time() - grace_seconds
+        for sha256, path in self.iter_blobs():
+            if sha256 in keep:
+                continue
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    shutil.rmtree(self.variants_dir(path), ignore_errors=True)
+                    removed += 1
+            except FileNotFoundError:
+                pass
+        return removed
+
+## the blob writer hashes and writes the chunks to a temporary file,
+## commit moves it to its content address. Its methods block, run them
+## off the event loop
+class BlobWriter:
+    def __init__(self, store: BlobStore) -> None:
+        self.store = store
+        self.hash = hashlib.sha256()
+        self.size = 0
+        descriptor, self.tmp_path = tempfile.mkstemp(dir=store.tmp_dir)
+        self.file = os.fdopen(descriptor, "wb")
+    def write(self, chunk: bytes) -> None:
+        self.hash.update(chunk)
+        self.file.write(chunk)
+        self.size += len(chunk)
+    ## returns (sha256, size, path), a blob already on disk is kept and
+    ## touched so the garbage collection leaves it alone
+    def commit(self) -> Tuple[str, int, str]:
+        self.file.close()
+        sha256 = self.hash.hexdigest()
+        path = self.store.path_for(sha256)
+        if os.path.exists(path):
+            os.remove(self.tmp_path)
+            os.utime(path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(self.tmp_path, path)
+        return (sha256, self.size, path)
+    def abort(self) -> None:
+        self.file.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
@@ -0,0 +1,64 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+## a bounded least-recently-used cache with an optional time to live, 
+## safe to share between the event loop and the database threads
+class LRUCache:
+    def __init__(self, maxsize: int = 4096, ttl_seconds: Optional[float] = None) -> None:
+        self.maxsize = maxsize
+        self.ttl_seconds = ttl_seconds
+        self.lock = threading.Lock()
+        self.entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    def configure(self, maxsize: int, ttl_seconds: Optional[float] = None) -> None:
+        with self.lock:
+            self.maxsize = maxsize
+            self.ttl_seconds = ttl_seconds
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at is None or expires_at > time.monotonic():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.entries[key]
+            self.misses += 1
+            return None
+    def put(self, key: Hashable, value: Any) -> None:
+        expires_at = None
+        if self.ttl_seconds is not None:
+            expires_at = time.monotonic() + self.ttl_seconds
+        with self.lock:
+            self.entries[key] = (value, expires_at)
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+    def invalidate(self, key: Hashable) -> None:
+        with self.lock:
+            self.entries.pop(key, None)
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+    def stats(self) -> Dict[str, float]:
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self.entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": 0.0 if total == 0 else self.hits / total,
+            }
+
+## lineUserId -> UserInfo.id of the users resolved by the handlers
+user_cache = LRUCache()
+## webhookEventId of the events processed recently, the duplicates are 
+## rejected here before the database is asked
+recent_events = LRUCache(maxsize=65536)
@@ -0,0 +1,41 @@
+import fcntl
+import os
+from typing import Optional
+
+## an advisory lock on a file, shared by every worker process of one
+## host. A blocking acquire serialises work the workers must not run
+## together, like creating the schema, a non-blocking one elects the
+## single worker that runs a job for all of them. The kernel releases
+## the lock when its holder dies, so another worker can take over
+class FileLock:
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.descriptor: Optional[int] = None
+    @property
+    def held(self) -> bool:
+        return self.descriptor is not None
+    def acquire(self, blocking: bool = True) -> bool:
+        if self.descriptor is not None:
+            return True
+        directory = os.path.dirname(self.path)
+        if directory != "":
+            os.makedirs(directory, exist_ok=True)
+        descriptor = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(descriptor, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(descriptor)
+            return False
+        self.descriptor = descriptor
+        return True
+    def release(self) -> None:
+        if self.descriptor is None:
+            return
+        fcntl.flock(self.descriptor, fcntl.LOCK_UN)
+        os.close(self.descriptor)
+        self.descriptor = None
+    def __enter__(self) -> "FileLock":
+        self.acquire()
+        return self
+    def __exit__(self, *exc_info) -> None:
+        self.release()
@@ -1,8 +1,163 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+import asyncio
+import functools
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, TypeVar
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session, sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
+from metrics import DB_IN_FLIGHT, DB_POOL_CHECKED_OUT
 
 DATABASE_URL = "sqlite:///./data.db"
 engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
 db_session = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-Base = declarative_base()
\ No newline at end of file
+Base = declarative_base()
+
+## the DATABASE section of config.yaml, every key is optional. The 
+## pragmas only apply to sqlite, WAL lets readers run while a commit 
+## is written and synchronous=NORMAL only fsyncs at checkpoints. See 
+## SqliteWalDocument: https://www.sqlite.org/wal.html
+DEFAULT_DATABASE_CONFIG = {
+    "URL": DATABASE_URL,
+    "JOURNAL_MODE": "WAL",
+    "SYNCHRONOUS": "NORMAL",
+    "MMAP_SIZE": 268435456,
+    "CACHE_SIZE": -65536,
+    "BUSY_TIMEOUT_MS": 5000,
+    "AUTO_VACUUM": "INCREMENTAL",
+    "POOL_SIZE": 5,
+    "MAX_OVERFLOW": 10,
+    "POOL_RECYCLE_SECONDS": 3600,
+    ## more than one shard spreads the users over SHARD_URL files, 
+    ## see sharding.py
+    "SHARDS": 1,
+    "SHARD_URL": "sqlite:///./data-{shard}.db",
+}
+
+## build an engine from the DATABASE config, a postgres URL gets a 
+## plain connection pool and the same models
+def create_database_engine(database_config: Dict[str, Any] = None) -> Engine:
+    database_config = {**DEFAULT_DATABASE_CONFIG, **(database_config or {})}
+    url = database_config["URL"]
+    if not url.startswith("sqlite"):
+        return create_engine(
+            url,
+            pool_size = database_config["POOL_SIZE"],
+            max_overflow = database_config["MAX_OVERFLOW"],
+            pool_recycle = database_config["POOL_RECYCLE_SECONDS"],
+            pool_pre_ping = True
+        )
+    sqlite_engine = create_engine(
+        url,
+        connect_args = {"check_same_thread": False},
+        pool_size = database_config["POOL_SIZE"],
+        max_overflow = database_config["MAX_OVERFLOW"]
+    )
+    ## auto_vacuum first, it only applies to a file without tables 
+    ## yet. An existing one keeps its mode until a full VACUUM
+    pragmas = [
+        ("auto_vacuum", database_config["AUTO_VACUUM"]),
+        ("journal_mode", database_config["JOURNAL_MODE"]),
+        ("synchronous", database_config["SYNCHRONOUS"]),
+        ("mmap_size", database_config["MMAP_SIZE"]),
+        ("cache_size", database_config["CACHE_SIZE"]),
+        ("busy_timeout", database_config["BUSY_TIMEOUT_MS"]),
+    ]
+    @event.listens_for(sqlite_engine, "connect")
+    def apply_pragmas(dbapi_connection, connection_record) -> None:
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas:
+            if value is not None:
+                cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+    return sqlite_engine
+
+## replace the default engine with the configured one, db_session is 
+## rebound so every session made afterwards uses it
+def init_database(database_config: Dict[str, Any] = None) -> Engine:
+    global engine
+    engine.dispose()
+    engine = create_database_engine(database_config)
+    db_session.configure(bind=engine)
+    if hasattr(engine.pool, "checkedout"):
+        DB_POOL_CHECKED_OUT.set_function(engine.pool.checkedout)
+    return engine
+
+T = TypeVar("T")
+## marks the end of a streamed generator
+_END = object()
+
+## the database executor runs the blocking sqlalchemy work on its own 
+## thread pool, so a commit never stalls the event loop. Every call 
+## gets a session from the factory which is closed when the call ends. 
+## It is the only shard of itself, so the callers written for the 
+## sharded executor of sharding.py work with it unchanged
+class DatabaseExecutor:
+    def __init__(
+            self,
+            session_factory: sessionmaker = db_session,
+            max_workers: int = 4,
+            thread_name_prefix: str = "db"
+            ) -> None:
+        self.session_factory = session_factory
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+        self.shards: List["DatabaseExecutor"] = [self]
+    def shard_of(self, line_user_id: Optional[str]) -> int:
+        return 0
+    ## the messages grouped by the shard of their owner
+    def partition(self, messages: List[T]) -> List[List[T]]:
+        return [messages] if len(messages) > 0 else []
+    def __call(self, fn: Callable[..., T], args: tuple, kwargs: dict) -> T:
+        db: Session = self.session_factory()
+        try:
+            return fn(db, *args, **kwargs)
+        finally:
+            db.close()
+    ## await fn(db, *args, **kwargs) on the database thread pool
+    async def run(self, fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        loop = asyncio.get_running_loop()
+        DB_IN_FLIGHT.inc()
+        try:
+            return await loop.run_in_executor(
+                self.pool, functools.partial(self.__call, fn, args, kwargs))
+        finally:
+            DB_IN_FLIGHT.dec()
+    ## iterate fn(db, *args, **kwargs), a generator, with every step on 
+    ## the database thread pool. The session stays open while the 
+    ## consumer reads and is closed when the generator ends or the 
+    ## consumer stops reading
+    async def stream(self, fn: Callable[..., Iterator[T]], *args: Any, **kwargs: Any) -> AsyncIterator[T]:
+        db: Session = self.session_factory()
+        iterator = fn(db, *args, **kwargs)
+        pending: Optional[Future] = None
+        try:
+            while True:
+                DB_IN_FLIGHT.inc()
+                try:
+                    pending = self.pool.submit(next, iterator, _END)
+                    item = await asyncio.wrap_future(pending)
+                finally:
+                    DB_IN_FLIGHT.dec()
+                if item is _END:
+                    return
+                yield item
+        finally:
+            ## not awaited, a cancelled consumer cannot wait for it. A 
+            ## step still running on the pool closes the stream when it 
+            ## ends, the generator and the session are never used by two 
+            ## threads at once
+            if pending is None or pending.done():
+                self.pool.submit(self.__close_stream, iterator, db)
+            else:
+                pending.add_done_callback(lambda _: self.__close_stream(iterator, db))
+    ## await fn(db, *args, **kwargs) on every shard, a list of the results
+    async def run_all(self, fn: Callable[..., T], *args: Any, **kwargs: Any) -> List[T]:
+        return [await self.run(fn, *args, **kwargs)]
+    @staticmethod
+    def __close_stream(iterator: Iterator[Any], db: Session) -> None:
+        try:
+            iterator.close()
+        finally:
+            db.close()
+    def shutdown(self) -> None:
+        self.pool.shutdown(wait=True)
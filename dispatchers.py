@@ -0,0 +1,247 @@
+import asyncio
+import logging
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Set, Tuple
+from caches import LRUCache
+from handlers import LineApiClient, PushMessagesHandler, ReplyMessagesHandler
+from metrics import OUTBOUND_CALLS
+from rules import OutboundMessage
+
+logger = logging.getLogger(__name__)
+
+## a token bucket: rate tokens a second up to burst, one per call
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated_at")
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+    def __refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+    ## take a token, returns 0 when taken or the seconds until one is
+    def take(self) -> float:
+        self.__refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+    ## take cost tokens now or ahead of time, returns the seconds until 
+    ## they are there. The bucket goes into debt at most max_wait deep
+    def reserve(self, cost: float = 1.0, max_wait: float = float("inf")) -> float:
+        self.__refill()
+        self.tokens = max(self.tokens - cost, -max_wait * self.rate)
+        return max(0.0, -self.tokens / self.rate)
+
+## one reply or push call of up to five messages. A retried push keeps
+## its retry key, so line delivers it once however often it is sent. A
+## reply has no such key: unconfirmed tells an attempt got no answer,
+## and line may have delivered it and used the token
+@dataclass(slots=True)
+class OutboundCall:
+    api: str
+    messages: List[OutboundMessage]
+    reply_token: str = ""
+    ## when the event of the reply token was received
+    received_at: float = 0.0
+    retry_key: str = field(default_factory=lambda: str(uuid.uuid4()))
+    attempts: int = 0
+    unconfirmed: bool = False
+    @property
+    def to(self) -> Optional[str]:
+        return self.messages[0].line_user_id
+
+## the reply dispatcher is the single background task that sends the
+## texts back to line. The texts submitted within max_wait_ms are
+## grouped per user into calls of up to five messages, one reply token
+## per call. A token older than reply_ttl_seconds, or one line rejects,
+## falls back to the push api. Every user has a token bucket, a call
+## over the rate waits for its token, and a call that fails with 429,
+## 5xx or a network error is retried with backoff until max_attempts.
+## The dispatcher is the only one retrying, the client sends every
+## attempt once
+class ReplyDispatcher:
+    MAX_MESSAGES = 5
+    RETRY_STATUSES = LineApiClient.RETRY_STATUSES
+    def __init__(
+            self,
+            client: LineApiClient,
+            reply_endpoint: str,
+            push_endpoint: str,
+            channel_access_token: str,
+            reply_ttl_seconds: float = 50.0,
+            max_wait_ms: float = 5.0,
+            user_rate: float = 1.0,
+            user_burst: float = 5.0,
+            max_attempts: int = 4,
+            backoff_seconds: float = 1.0,
+            concurrency: int = 16
+            ) -> None:
+        self.client = client
+        self.reply_endpoint = reply_endpoint
+        self.push_endpoint = push_endpoint
+        self.channel_access_token = channel_access_token
+        self.reply_ttl_seconds = reply_ttl_seconds
+        self.max_wait_seconds = max_wait_ms / 1000
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.concurrency = concurrency
+        self.buckets = LRUCache(maxsize=65536)
+        self.queue: "asyncio.Queue[OutboundMessage]" = None
+        self.task: asyncio.Task = None
+        self.limit: asyncio.Semaphore = None
+        ## the calls sending now and the ones waiting for a retry
+        self.sending: Set[asyncio.Task] = set()
+        self.scheduled: Dict[int, Tuple[asyncio.TimerHandle, OutboundCall]] = {}
+        self.stopping = False
+    def start(self) -> None:
+        self.queue = asyncio.Queue()
+        self.limit = asyncio.Semaphore(self.concurrency)
+        self.stopping = False
+        self.task = asyncio.create_task(self.__run())
+    ## send what is queued, retry the scheduled calls once at once, then
+    ## stop the dispatcher task
+    async def stop(self) -> None:
+        if self.task is None:
+            return
+        await self.queue.join()
+        self.stopping = True
+        for handle, call in list(self.scheduled.values()):
+            handle.cancel()
+            self.__start_sending(call)
+        self.scheduled.clear()
+        while len(self.sending) > 0:
+            await asyncio.gather(*list(self.sending), return_exceptions=True)
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+        self.task = None
+    def submit(self, message: OutboundMessage) -> None:
+        self.queue.put_nowait(message)
+    async def __collect(self) -> List[OutboundMessage]:
+        batch = [await self.queue.get()]
+        deadline = asyncio.get_running_loop().time() + self.max_wait_seconds
+        while True:
+            if self.queue.empty():
+                timeout = deadline - asyncio.get_running_loop().time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            else:
+                batch.append(self.queue.get_nowait())
+        return batch
+    ## the calls for the texts of one batch: per user, every chunk of
+    ## five takes one of the user's fresh reply tokens, the chunks left
+    ## without a token are pushed
+    def __plan(self, batch: List[OutboundMessage]) -> List[OutboundCall]:
+        fresh_after = time.time() - self.reply_ttl_seconds
+        users: Dict[str, List[OutboundMessage]] = {}
+        for message in batch:
+            key = message.line_user_id or f"token:{message.reply_token}"
+            users.setdefault(key, []).append(message)
+        calls = []
+        for messages in users.values():
+            tokens = [(message.reply_token, message.received_at) for message in messages
+                      if message.reply_token != "" and message.received_at >= fresh_after]
+            for start in range(0, len(messages), self.MAX_MESSAGES):
+                chunk = messages[start:start + self.MAX_MESSAGES]
+                if len(tokens) > 0:
+                    reply_token, received_at = tokens.pop(0)
+                    calls.append(OutboundCall("reply", chunk, reply_token, received_at))
+                elif chunk[0].line_user_id is not None:
+                    calls.append(OutboundCall("push", chunk))
+                else:
+                    OUTBOUND_CALLS.labels(api="reply", result="dropped").inc()
+                    logger.warning("no reply token and no user to push to",
+                                   extra={"messages": len(chunk)})
+        return calls
+    async def __run(self) -> None:
+        while True:
+            batch = await self.__collect()
+            for call in self.__plan(batch):
+                self.__dispatch(call)
+            for _ in batch:
+                self.queue.task_done()
+    ## send the call when the user has a token left, later otherwise
+    def __dispatch(self, call: OutboundCall) -> None:
+        key = call.to or call.reply_token
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(self.user_rate, self.user_burst)
+            self.buckets.put(key, bucket)
+        wait = bucket.take()
+        if wait > 0 and not self.stopping:
+            self.__schedule(call, wait)
+        else:
+            self.__start_sending(call)
+    def __schedule(self, call: OutboundCall, delay: float) -> None:
+        handle = asyncio.get_running_loop().call_later(delay, self.__wake, call)
+        self.scheduled[id(call)] = (handle, call)
+    def __wake(self, call: OutboundCall) -> None:
+        self.scheduled.pop(id(call), None)
+        ## a reply that waited too long goes out as a push
+        if call.api == "reply" and call.received_at < time.time() - self.reply_ttl_seconds:
+            if call.to is None:
+                OUTBOUND_CALLS.labels(api="reply", result="dropped").inc()
+                return
+            call = OutboundCall("push", call.messages)
+        self.__dispatch(call)
+    def __start_sending(self, call: OutboundCall) -> None:
+        task = asyncio.create_task(self.__send(call))
+        self.sending.add(task)
+        task.add_done_callback(self.sending.discard)
+    async def __send(self, call: OutboundCall) -> None:
+        texts = [message.text for message in call.messages]
+        call.attempts += 1
+        try:
+            async with self.limit:
+                if call.api == "reply":
+                    status, body = await ReplyMessagesHandler(
+                        self.client, self.reply_endpoint, self.channel_access_token,
+                        call.reply_token, texts)
+                else:
+                    status, body = await PushMessagesHandler(
+                        self.client, self.push_endpoint, self.channel_access_token,
+                        call.to, texts, call.retry_key)
+        except Exception as e:
+            status, body = None, str(e)
+            call.unconfirmed = True
+        ## 409 means line already accepted a push with this retry key
+        if status == 200 or (call.api == "push" and status == 409):
+            OUTBOUND_CALLS.labels(api=call.api, result="ok").inc()
+            return
+        if call.api == "reply" and status == 400 and call.unconfirmed:
+            ## an attempt before got no answer and most likely used the 
+            ## token, pushing now could deliver the texts twice
+            OUTBOUND_CALLS.labels(api="reply", result="unconfirmed").inc()
+            logger.warning("reply token used by an unconfirmed attempt", extra={
+                "attempts": call.attempts, "messages": len(texts)})
+            return
+        if call.api == "reply" and status == 400 and call.to is not None:
+            ## the reply token expired or was used, push the texts instead
+            OUTBOUND_CALLS.labels(api="reply", result="fallback").inc()
+            self.__dispatch(OutboundCall("push", call.messages))
+            return
+        if (status is None or status in self.RETRY_STATUSES) and \
+                call.attempts < self.max_attempts and not self.stopping:
+            OUTBOUND_CALLS.labels(api=call.api, result="retry").inc()
+            self.__schedule(call, self.backoff_seconds * (2 ** (call.attempts - 1)))
+            return
+        OUTBOUND_CALLS.labels(api=call.api, result="dropped").inc()
+        logger.error("outbound call dropped", extra={
+            "api": call.api, "status": status, "response": body,
+            "attempts": call.attempts, "messages": len(texts)})
+    def stats(self) -> Dict[str, int]:
+        return {
+            "queued": 0 if self.queue is None else self.queue.qsize(),
+            "sending": len(self.sending),
+            "scheduled": len(self.scheduled),
+        }
@@ -1,13 +1,27 @@
 from datetime import datetime
-import json
-from typing import Any, Dict, Tuple
-from sqlalchemy.orm import Session
+import asyncio
+import orjson
+from typing import Awaitable, Callable, Dict, List, Tuple
+from database import DatabaseExecutor
+from writers import GroupCommitWriter
+from dispatchers import ReplyDispatcher
+from postprocessing import PostProcessor
 from fastapi import Request
 import base64
 import hashlib
 import hmac
-from handlers import ReplyMessageHandler, MessageRecordHandler
-from rules import ProcessMessage, MessageType, Message
+import logging
+from blobstore import BlobStore
+from handlers import LineApiClient, ReplyMessageHandler, MessageRecordsBatchHandler, FileFetchHandler
+from handlers import SearchNotesHandler, ClaimEventsHandler, ReleaseEventsHandler
+from handlers import TagNotesHandler, UserTagsHandler
+from caches import recent_events
+from exports import EXPORT_FORMATS, export_link
+from tags import tag_query
+from rules import ProcessMessage, MessageType, MESSAGE_TYPES, Message, WebhookEvent, OutboundMessage
+from metrics import MESSAGE_OUTCOMES, MESSAGES_RECEIVED, PARSE_STAGE, SIGNATURE_STAGE
+
+logger = logging.getLogger(__name__)
 
 ## the senior officer bot only holds a custom dictionary call 
 ## "configuration key", nothing more, nothing else
@@ -16,6 +30,28 @@ class SeniorOfficerBot:
         self.channel_secret = configuration_key.get("CHANNEL_SECRET")
         self.channel_access_token = configuration_key.get("CHANNEL_ACCESS_TOKEN")
         self.reply_endpoint = configuration_key.get("REPLY_ENDPOINT")
+        self.push_endpoint = configuration_key.get(
+            "PUSH_ENDPOINT", "https://api.line.me/v2/bot/message/push")
+        ## the hmac keyed with the channel secret, copied per request
+        self.signature_key = hmac.new(
+            (self.channel_secret or "").encode('utf-8'), digestmod=hashlib.sha256)
+        self.content_endpoint = configuration_key.get(
+            "CONTENT_ENDPOINT",
+            "https://api-data.line.me/v2/bot/message/{messageId}/content")
+        ## the public url of /export, the /export command links to it
+        self.export_url = configuration_key.get("EXPORT_URL")
+        self.export_link_ttl = configuration_key.get("EXPORT_LINK_TTL_SECONDS", 3600)
+        self.media_dir = configuration_key.get("MEDIA_DIR", "./media")
+        self.blob_store = BlobStore(self.media_dir)
+        ## bounds the content downloads running at the same time
+        self.fetch_limit = asyncio.Semaphore(configuration_key.get("FETCH_CONCURRENCY", 8))
+        ## one pooled client for every outbound call of the app
+        self.http_client = LineApiClient(
+            limit_per_host = configuration_key.get("HTTP_POOL_SIZE", 10),
+            timeout_seconds = configuration_key.get("HTTP_TIMEOUT_SECONDS", 10.0),
+            max_retries = configuration_key.get("HTTP_MAX_RETRIES", 3),
+            backoff_seconds = configuration_key.get("HTTP_BACKOFF_SECONDS", 0.5)
+        )
 
 ##: the manager bot is responsible for signature validation and 
 ##: database operations. See VerifySignatureDocument: https://
@@ -25,37 +61,51 @@ class ManagerBot:
     def __init__(
             self,
             senior: SeniorOfficerBot,
-            DB: type[Session]
+            DB: DatabaseExecutor,
+            writer: GroupCommitWriter = None,
+            dispatcher: ReplyDispatcher = None,
+            post_processor: PostProcessor = None
             ) -> None:
         self.channel_secret = senior.channel_secret
         self.channel_access_token = senior.channel_access_token
+        self.signature_key = senior.signature_key
         self.reply_endpoint = senior.reply_endpoint
+        self.http_client = senior.http_client
+        self.content_endpoint = senior.content_endpoint
+        self.blob_store = senior.blob_store
+        self.fetch_limit = senior.fetch_limit
+        self.export_url = senior.export_url
+        self.export_link_ttl = senior.export_link_ttl
         self.DB = DB
-        self.body_str = ""
+        self.writer = writer
+        self.dispatcher = dispatcher
+        self.post_processor = post_processor
+        self.body = b""
         self.outgoingPayload = Message(msg_id="0")
     def online(self) -> None:
         if self.channel_access_token == "" or self.channel_secret == "":
-            print("Manager bot sleeping...something went wrong!")
+            logger.warning("Manager bot sleeping...something went wrong!")
         else:
-            print("Manager bot at your service!")
+            logger.info("Manager bot at your service!")
     ## record the payload for further processing
     def __record_payload(self, payload: Message) -> None:
         self.outgoingPayload = payload
-    ## validate the x-line-signature    
+    ## validate the x-line-signature over the raw body bytes, the 
+    ## signatures are compared in constant time
     async def validate_signature(
             self, 
             request: Request
             ) -> bool:
-        ## Validate the x-line-signature
-        body_bytes = await request.body()
-        body = body_bytes.decode('utf-8')
+        body = await request.body()
         signature = request.headers.get('x-line-signature')
-        hash = hmac.new(self.channel_secret.encode('utf-8'),
-            body.encode('utf-8'), hashlib.sha256).digest()
-        correct_signature = base64.b64encode(hash).decode()
-        if signature != correct_signature:
+        if signature is None:
             return False
-        self.body_str = body
+        with SIGNATURE_STAGE.time():
+            mac = self.signature_key.copy()
+            mac.update(body)
+            if not hmac.compare_digest(base64.b64encode(mac.digest()), signature.encode()):
+                return False
+        self.body = body
         return True
     ## deal error from other bots and decide what to do
     def report_error(self, msg: Message) -> bool:
@@ -63,9 +113,80 @@ class ManagerBot:
 
     ## deal success from other bots
     def report_success(self, msg: ProcessMessage) -> None:
-        print(f"Success: {msg.value}")
-
-    
+        logger.debug("Success", extra={"outcome": msg.value})
+    ## reject the events already processed: the recent event ids are 
+    ## checked in memory first, the rest are claimed in the database, 
+    ## in shard 0 with the other tables of no user. 
+    ## Returns the events to process and the ids claimed for them
+    async def __drop_duplicates(
+            self,
+            results: List[Tuple[bool, Message]]
+            ) -> Tuple[List[Tuple[bool, Message]], List[str]]:
+        fresh = [(ok, msg) for ok, msg in results
+                 if msg.msg_event_id is None or recent_events.get(msg.msg_event_id) is None]
+        event_ids = [msg.msg_event_id for _, msg in fresh if msg.msg_event_id is not None]
+        if len(event_ids) == 0:
+            return (fresh, [])
+        claimed = await self.DB.shards[0].run(ClaimEventsHandler, event_ids = event_ids)
+        for event_id in event_ids:
+            recent_events.put(event_id, True)
+        fresh = [(ok, msg) for ok, msg in fresh
+                 if msg.msg_event_id is None or msg.msg_event_id in claimed]
+        return (fresh, list(claimed))
+    ## the released events are not recent any more, or the retry of 
+    ## the job would drop them as duplicates in this process
+    def __forget(self, event_ids: List[str]) -> None:
+        for event_id in event_ids:
+            recent_events.invalidate(event_id)
+    ## dispatch every event of the validated payload: the clerk bot 
+    ## parses them, the storage bot writes them as one batch, and 
+    ## the customer bot replies to each of them. final tells the job 
+    ## runs for the last time
+    async def process_payload(self, final: bool = True) -> None:
+        with PARSE_STAGE.time():
+            clerkBot = ClerkBot(manager = self)
+            messages = clerkBot.getMessages()
+        results, claimed = await self.__drop_duplicates(messages)
+        try:
+            await self.__dispatch(results, final)
+        except BaseException:
+            if len(claimed) > 0:
+                await self.DB.shards[0].run(ReleaseEventsHandler, event_ids = claimed)
+                self.__forget(claimed)
+            raise
+        ## line was acknowledged when the body was journaled and won't 
+        ## redeliver it: the events whose error may pass give their claims 
+        ## back and fail the job, the ingestion queue runs it again and the 
+        ## events done already are rejected as duplicates then. An event 
+        ## failing for good, like a content gone with 404, was answered 
+        ## with its error and stays claimed
+        retry = [msg.msg_event_id for ok, msg in results
+                 if ok and msg.error_retryable and msg.msg_event_id in claimed]
+        if len(retry) > 0:
+            await self.DB.shards[0].run(ReleaseEventsHandler, event_ids = retry)
+            self.__forget(retry)
+            raise RuntimeError(f"{len(retry)} events failed and are processed again")
+    async def __dispatch(self, results: List[Tuple[bool, Message]], final: bool = True) -> None:
+        for ok, msg in results:
+            if not ok:
+                self.report_error(msg)
+        ## the notes are stored before the commands run, so a command 
+        ## finds the notes sent before it in the same delivery
+        commands = [msg for ok, msg in results if ok and CommandBot.is_command(msg)]
+        to_store = [msg for ok, msg in results if ok and not CommandBot.is_command(msg)]
+        if len(to_store) > 0:
+            await StorageBot(manager = self, objects_to_store = to_store).process_messages()
+        await asyncio.gather(*[
+            CommandBot(manager = self, command = msg).process_command()
+            for msg in commands
+        ])
+        ## an event processed again is answered then, the last time 
+        ## with its error
+        await asyncio.gather(*[
+            CustomerBot(manager = self, payload = msg).respond_message()
+            for _, msg in results
+            if final or not msg.error_retryable
+        ])
 
 ## the clerk bot deals with every incoming message
 class ClerkBot:
@@ -73,74 +194,181 @@ class ClerkBot:
             self,
             manager: ManagerBot
             ) -> None:
-        self.payload = json.load(manager.body_str)
-        self.replyToken = ""
-        self.webhookEventId = ""
-        self.line_user_id = ""
-        self.time_stamp = ""
-    ## events in payload is List[Dict[str, str]], but only one 
-    ## event is inside the list currently and its is subjective to 
-    ## change by the line api. Refer to WebhookEventDocument: 
+        self.payload = orjson.loads(manager.body)
+    ## events in payload is List[Dict[str, str]], and the line api 
+    ## may pack several events into one webhook request when it is 
+    ## under load, so every event in the list has to be processed. 
+    ## Refer to WebhookEventDocument: 
     ## https://developers.line.biz/en/docs/messaging-api/
     ## receiving-messages/
     ## webhook-event-in-one-on-one-talk-or-group-chat 
     ## for more info.
-    def __process_events(self) -> Tuple[bool , Dict[Any, str]]:
+    def __process_events(self) -> List[WebhookEvent]:
         events = self.payload.get("events")
         if events is None:
-            return (False, {})
-        event = events[0]
-        isReDeliver = event.get("deliveryContext").get("isRedelivery")
-        if isReDeliver:
-            return (False, {})
-        if event.get("source").get("userId") is None:
-            print("No user id found")
-            return (False, {})
-        self.replyToken = event.get("replyToken")
-        self.webhookEventId = event.get("webhookEventId")
-        self.line_user_id = event.get("source").get("userId")
-        ## the timestamp is in milliseconds according to
-        ## WebhookEventDocument, 
-        ## so we need to convert it to seconds, adjust the process 
-        ## subjectively
-        self.__process_timestamp(event.get("timestamp")/1000)
-        return (True, event.get("message"))
-    def __process_message(self) -> Tuple[bool, Message]:
-        ok, message = self.__process_events()
-        if not ok:
-            return (False, Message(msg_id="", error_description="No valid message events received"))
-        msgType = message.get("type")
-        if msgType is None:
+            return []
+        return [WebhookEvent.from_dict(event) for event in events]
+    ## a redelivered event is processed like any other, the manager bot 
+    ## rejects the ones already processed by their webhookEventId
+    def __process_event(self, event: WebhookEvent) -> Tuple[bool, Message]:
+        if event.line_user_id is None:
+            logger.info("No user id found", extra={"event_id": event.event_id})
+            return (False, Message(msg_id="", msg_event_id=event.event_id, error_description="No user id found"))
+        if event.message_id is None:
+            return (False, Message(
+                msg_id="",
+                msg_reply_token=event.reply_token,
+                msg_event_id=event.event_id,
+                error_description="No valid message events received"))
+        msg_type = MESSAGE_TYPES.get(event.message_type)
+        if msg_type is None:
+            MESSAGES_RECEIVED.labels(type="unsupported").inc()
             return (False, Message(
                 msg_id="",
-                reply_token=self.replyToken, 
+                msg_reply_token=event.reply_token, 
+                msg_event_id=event.event_id,
                 error_description="No valid message type found"))
+        MESSAGES_RECEIVED.labels(type=msg_type.value).inc()
         ## process the message based on the type: text, image, file, audio
         return (True, Message(
-            msg_id = message.get("id"),
-            msg_type = MessageType[msgType.upper()],
-            msg_text = message.get("text"),
-            msg_filename = message.get("fileName"),
-            msg_reply_token = self.replyToken,
-            msg_timestamp= self.time_stamp,
-            owner_id = self.line_user_id,
+            msg_id = event.message_id,
+            msg_type = msg_type,
+            msg_text = event.text,
+            msg_filename = event.file_name,
+            msg_reply_token = event.reply_token,
+            msg_timestamp = self.__process_timestamp(event.timestamp),
+            owner_id = event.line_user_id,
+            msg_event_id = event.event_id,
             error_description = ""
         ))
+    ## the timestamp is in milliseconds according to 
+    ## WebhookEventDocument, so we need to convert it to seconds, 
+    ## adjust the process subjectively
     def __process_timestamp(self, timestamp: int) -> datetime:
-        self.time_stamp = datetime.fromtimestamp(timestamp)
-    ## get message after initialize clerk bot
-    def getMessage(self) -> Tuple[bool, Message]:
-        return self.__process_message()
+        return datetime.fromtimestamp(timestamp/1000)
+    ## get every message after initialize clerk bot, the flag tells 
+    ## whether the message is valid for storage
+    def getMessages(self) -> List[Tuple[bool, Message]]:
+        return [self.__process_event(event) for event in self.__process_events()]
+
+## the command bot answers the text messages that are commands 
+## instead of notes, e.g. "/find groceries" searches the user's notes, 
+## "/export" links to a download of all of them, "#groceries" alone 
+## lists the latest notes tagged with it and "/tags" the user's tags. 
+## The answer is left in msg_reply_text for the customer bot
+class CommandBot:
+    NAMES = ("/find", "/export", "/tags")
+    ## line limits a text message to 5000 characters
+    MAX_REPLY_LENGTH = 5000
+    def __init__(
+            self,
+            manager: ManagerBot,
+            command: Message
+            ) -> None:
+        self.manager = manager
+        self.command = command
+        self.commands = {
+            "/find": self.__find,
+            "/export": self.__export,
+            "/tags": self.__tags,
+            "#": self.__tag,
+        }
+    @staticmethod
+    def __split(msg: Message) -> Tuple[str, str]:
+        parts = (msg.msg_text or "").strip().split(maxsplit=1)
+        if len(parts) == 0:
+            return ("", "")
+        return (parts[0].lower(), parts[1] if len(parts) > 1 else "")
+    @staticmethod
+    def is_command(msg: Message) -> bool:
+        return (msg.msg_type == MessageType.TEXT 
+                and (CommandBot.__split(msg)[0] in CommandBot.NAMES
+                     or tag_query(msg.msg_text) is not None))
+    async def __find(self, argument: str) -> str:
+        if argument == "":
+            return 'tell me what to find, e.g. "/find groceries"'
+        result = await self.manager.DB.run(
+            SearchNotesHandler,
+            line_user_id = self.command.owner_id,
+            query = argument,
+            page_size = 5
+        )
+        if len(result["results"]) == 0:
+            return f'no notes found for "{argument}"'
+        lines = [f'notes matching "{argument}":']
+        for index, note in enumerate(result["results"], start=1):
+            when = note["timestamp"].strftime("%Y-%m-%d %H:%M") if note["timestamp"] else ""
+            lines.append(f'{index}. {when} {note["snippet"]}')
+        return "\n".join(lines)
+    async def __export(self, argument: str) -> str:
+        if self.manager.export_url is None:
+            return "the export is not available"
+        format = argument.strip().lower() or "zip"
+        if format not in EXPORT_FORMATS:
+            return 'export as "zip" or "ndjson", e.g. "/export ndjson"'
+        link = export_link(
+            self.manager.export_url,
+            self.manager.channel_secret,
+            self.command.owner_id,
+            self.manager.export_link_ttl,
+            format
+        )
+        minutes = max(self.manager.export_link_ttl // 60, 1)
+        return f"download all your notes within {minutes} minutes:\n{link}"
+    async def __tags(self, argument: str) -> str:
+        result = await self.manager.DB.run(
+            UserTagsHandler,
+            line_user_id = self.command.owner_id,
+            limit = 50
+        )
+        if len(result["tags"]) == 0:
+            return 'no tags yet, add one to a note, e.g. "milk #groceries"'
+        return "your tags:\n" + "\n".join(
+            f'#{tag["tag"]} ({tag["count"]})' for tag in result["tags"])
+    async def __tag(self, tag: str) -> str:
+        result = await self.manager.DB.run(
+            TagNotesHandler,
+            line_user_id = self.command.owner_id,
+            tag = tag,
+            limit = 5
+        )
+        if len(result["notes"]) == 0:
+            return f'no notes tagged #{tag}'
+        lines = [f'latest of {result["count"]} notes tagged #{tag}:']
+        for index, note in enumerate(result["notes"], start=1):
+            when = note["timestamp"].strftime("%Y-%m-%d %H:%M") if note["timestamp"] else ""
+            lines.append(f'{index}. {when} {note["message"] or note["filename"] or ""}')
+        return "\n".join(lines)
+    async def process_command(self) -> None:
+        name, argument = self.__split(self.command)
+        tag = tag_query(self.command.msg_text)
+        if tag is not None:
+            name, argument = "#", tag
+        try:
+            reply = await self.commands[name](argument)
+        except Exception as e:
+            logger.error("command error", extra={"command": name, "error": str(e)})
+            MESSAGE_OUTCOMES.labels(outcome=ProcessMessage.DATABASE_READ_ERROR.name).inc()
+            self.command.error_description = ProcessMessage.DATABASE_READ_ERROR.value
+            self.command.error_retryable = True
+            self.manager.report_error(self.command)
+            return
+        self.command.msg_reply_text = reply[:self.MAX_REPLY_LENGTH]
 
 ## the customer bot will handle response message
 class CustomerBot:
     def __init__(
             self,
             manager: ManagerBot,
+            payload: Message = None
             ) -> None:
         self.manager = manager
-        self.payload = manager.outgoingPayload
+        if payload is None:
+            payload = manager.outgoingPayload
+        self.payload = payload
     def __generate_reply_message(self) -> str:
+        if self.payload.msg_reply_text is not None:
+            return self.payload.msg_reply_text
         if self.payload.error_description != "":
             return f'we have a problem: {self.payload.error_description}'
         return f'we have received and processed your {self.payload.msg_type} message.'
@@ -148,47 +376,102 @@ class CustomerBot:
         reply_message = self.__generate_reply_message()
         ## extract the reply token from the payload
         reply_token = self.payload.msg_reply_token
+        ## the dispatcher coalesces the replies of a user and pushes 
+        ## when the token is missing or stale
+        if self.manager.dispatcher is not None:
+            self.manager.dispatcher.submit(OutboundMessage(
+                text = reply_message,
+                line_user_id = self.payload.owner_id,
+                reply_token = reply_token,
+                received_at = self.payload.msg_timestamp.timestamp()
+            ))
+            return {}
         if reply_token == "":
-            print("No reply token found, and the error description: ", reply_message)
+            logger.debug("No reply token found", extra={"reply": reply_message})
             return {}
         ## call the reply message handler
         res = await ReplyMessageHandler(
             reply_endpoint=self.manager.reply_endpoint,
             channel_access_token=self.manager.channel_access_token,
             reply_token=reply_token,
-            message=reply_message
+            message=reply_message,
+            client=self.manager.http_client
         )
-        json_res = json.loads(res)
-        print(json_res)
+        try:
+            json_res = orjson.loads(res)
+        except orjson.JSONDecodeError:
+            json_res = {"error": res}
+        logger.debug("reply response", extra={"response": json_res})
         return json_res
     
+## the storage bot writes a batch of messages, text messages of the 
+## batch share one database transaction
 class StorageBot:
     def __init__(
             self,
             manager: ManagerBot,
-            object_to_store: Message
+            objects_to_store: List[Message]
             ) -> None:
         self.manager = manager
-        self.object_to_store = object_to_store
-    def __file_storage_operation(self) -> Tuple[bool, str]:
-        
-        pass
-    def process_message(self) -> None:
-        if self.object_to_store.msg_type == MessageType.TEXT:
-            success, msg = MessageRecordHandler(
-                    db = self.manager.DB,
-                    message = self.object_to_store
-                )
+        self.objects_to_store = objects_to_store
+    ## download the content of an image/audio/file message, the record 
+    ## keeps the path of its blob
+    async def __file_storage_operation(self, msg: Message) -> Tuple[bool, str]:
+        success, report, sha256, size, retryable = await DeliveryBot(
+            manager = self.manager, 
+            object_to_fetch = msg
+        ).fetch_file()
+        if success:
+            msg.msg_filepath = report
+            msg.msg_content_hash = sha256
+            msg.msg_content_size = size
+        msg.error_retryable = retryable
+        return (success, report)
+    ## the coroutine preparing a message of each type before it is 
+    ## written, text messages need none
+    PREPARE: Dict[MessageType, Callable[["StorageBot", Message], Awaitable[Tuple[bool, str]]]] = {
+        MessageType.IMAGE: __file_storage_operation,
+        MessageType.AUDIO: __file_storage_operation,
+        MessageType.FILE: __file_storage_operation,
+    }
+    async def process_messages(self) -> None:
+        preparing = []
+        for msg in self.objects_to_store:
+            prepare = self.PREPARE.get(msg.msg_type)
+            if prepare is not None:
+                preparing.append((msg, prepare(self, msg)))
+        reports = await asyncio.gather(*[coroutine for _, coroutine in preparing])
+        for (msg, _), (success, report) in zip(preparing, reports):
             if not success:
+                msg.error_description = report
                 self.manager.report_error(msg)
-            else:
-                self.manager.report_success(msg)
+        ## text messages and the prepared ones share one write per shard, 
+        ## a shard failing fails only the messages it holds
+        to_write = [msg for msg in self.objects_to_store if msg.error_description == ""]
+        await asyncio.gather(*[
+            self.__write(part) for part in self.manager.DB.partition(to_write)
+        ])
+    async def __write(self, to_write: List[Message]) -> None:
+        if self.manager.writer is not None:
+            ## coalesced with the messages of other requests
+            status = await self.manager.writer.submit(to_write)
         else:
-            success, report = self.__file_storage_operation()
-            if not success:
-                self.manager.report_error(report)
-            else:
-                self.manager.report_success(report)
+            status = await self.manager.DB.run(
+                    MessageRecordsBatchHandler,
+                    messages = to_write
+                )
+        MESSAGE_OUTCOMES.labels(outcome=status.msg.name).inc(len(to_write))
+        if not status.success:
+            for msg in to_write:
+                msg.error_description = status.msg.value
+                msg.error_retryable = True
+                self.manager.report_error(msg)
+        else:
+            self.manager.report_success(status.msg)
+            ## the attachments are post-processed in the background
+            if self.manager.post_processor is not None and \
+                    any(msg.msg_filepath is not None for msg in to_write):
+                self.manager.post_processor.notify()
 
 ## deal with file fetch from line data endpoint
 class DeliveryBot:
@@ -199,7 +482,14 @@ class DeliveryBot:
             ) -> None:
         self.manager = manager
         self.object_to_fetch = object_to_fetch
-    def __file_fetch_operation(self) -> Tuple[bool, str]:
-        FileFetchHandler()
-        pass
-
+    async def __file_fetch_operation(self) -> Tuple[bool, str, str, int, bool]:
+        async with self.manager.fetch_limit:
+            return await FileFetchHandler(
+                client = self.manager.http_client,
+                content_endpoint = self.manager.content_endpoint,
+                channel_access_token = self.manager.channel_access_token,
+                message_id = self.object_to_fetch.msg_id,
+                blob_store = self.manager.blob_store
+            )
+    def fetch_file(self) -> Awaitable[Tuple[bool, str, str, int, bool]]:
+        return self.__file_fetch_operation()
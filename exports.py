@@ -0,0 +1,53 @@
+import hashlib
+import hmac
+import time
+from typing import List
+from urllib.parse import urlencode
+
+## the note export is a download link: the /export command replies with
+## a link signed with the channel secret that expires after ttl seconds,
+## so a user only downloads their own notes. The other endpoints reading
+## the notes of a user check the same signature
+EXPORT_FORMATS = {
+    "zip": "application/zip",
+    "ndjson": "application/x-ndjson",
+}
+
+def export_signature(secret: str, line_user_id: str, expires: int) -> str:
+    return hmac.new(
+        (secret or "").encode(), f"{line_user_id}|{expires}".encode(), hashlib.sha256
+    ).hexdigest()
+
+def export_link(base_url: str, secret: str, line_user_id: str, ttl_seconds: int, format: str = "zip") -> str:
+    expires = int(time.time()) + ttl_seconds
+    query = urlencode({
+        "lineUserId": line_user_id,
+        "format": format,
+        "expires": expires,
+        "signature": export_signature(secret, line_user_id, expires),
+    })
+    return f"{base_url}?{query}"
+
+def verify_export_link(secret: str, line_user_id: str, expires: int, signature: str) -> bool:
+    if expires < time.time():
+        return False
+    return hmac.compare_digest(export_signature(secret, line_user_id, expires), signature)
+
+## zipfile writes into the sink as if it were a file, take hands over
+## what was written since. The sink cannot seek, so zipfile puts the
+## sizes and crc after every entry and an entry is written as it streams
+class ZipSink:
+    def __init__(self) -> None:
+        self.chunks: List[bytes] = []
+        self.size = 0
+    def write(self, data: bytes) -> int:
+        self.chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+    def flush(self) -> None:
+        pass
+    def take(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        return data
@@ -1,65 +1,1027 @@
+import asyncio
 import aiohttp
+import base64
 import json
-from datetime import datetime
+import logging
+import os
+import re
+import time
+import zipfile
+import orjson
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Set, Tuple, Union
+from sqlalchemy import DateTime, bindparam, delete, func, insert, null, select, text, tuple_, update
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
-from rules import ProcessMessage, UserInfo, MessageRecords, HandleStatus
+from archive import NoteArchive
+from blobstore import BlobStore
+from exports import ZipSink
+from caches import recent_events, user_cache
+from search import FTS_TABLE, build_match_query, needs_substring_search, search_index_enabled
+from tags import extract_tags
+from rules import ProcessMessage, UserInfo, MessageRecords, Blobs, ProcessedEvents, HandleStatus
+from rules import Tags, NoteTags, UserTags
 from rules import MessageType, Message
+from metrics import CONTENT_FETCH_STAGE, DB_WRITE_STAGE, LINE_API_IN_FLIGHT
+from metrics import PUSH_STAGE, REPLY_STAGE, USER_LOOKUP_STAGE
+
+logger = logging.getLogger(__name__)
+
+## the line api client keeps one aiohttp session for the app lifetime, 
+## so replies reuse keep-alive connections instead of paying a new 
+## TCP+TLS handshake per message. Requests answered with 429 or 5xx are 
+## retried with exponential backoff. See RateLimitsDocument: https://
+## developers.line.biz/en/reference/messaging-api/#rate-limits
+class LineApiClient:
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+    def __init__(
+            self,
+            limit_per_host: int = 10,
+            timeout_seconds: float = 10.0,
+            max_retries: int = 3,
+            backoff_seconds: float = 0.5
+            ) -> None:
+        self.limit_per_host = limit_per_host
+        self.timeout_seconds = timeout_seconds
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.session: aiohttp.ClientSession = None
+    async def start(self) -> None:
+        if self.session is not None:
+            return
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=30
+            ),
+            timeout=aiohttp.ClientTimeout(total=self.timeout_seconds)
+        )
+    async def close(self) -> None:
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+    ## wait before the next attempt, line sends Retry-After with 429
+    def __backoff(self, attempt: int, retry_after: str = None) -> float:
+        if retry_after is not None and retry_after.isdigit():
+            return float(retry_after)
+        return self.backoff_seconds * (2 ** attempt)
+    async def post(self, url: str, headers: Dict[str, str], data: str) -> str:
+        status, text = await self.send(url, headers, data)
+        return text
+    ## post and return the final status with the body, for the callers 
+    ## that act on a failure. max_retries=0 sends once, for the callers 
+    ## that retry themselves
+    async def send(
+            self,
+            url: str,
+            headers: Dict[str, str],
+            data: str,
+            max_retries: Optional[int] = None
+            ) -> Tuple[int, str]:
+        await self.start()
+        if max_retries is None:
+            max_retries = self.max_retries
+        attempt = 0
+        while True:
+            LINE_API_IN_FLIGHT.inc()
+            try:
+                async with self.session.post(url, headers=headers, data=data) as response:
+                    text = await response.text()
+                    if response.status not in self.RETRY_STATUSES or attempt >= max_retries:
+                        return (response.status, text)
+                    delay = self.__backoff(attempt, response.headers.get("Retry-After"))
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt >= max_retries:
+                    raise
+                delay = self.__backoff(attempt)
+            finally:
+                LINE_API_IN_FLIGHT.dec()
+            attempt += 1
+            await asyncio.sleep(delay)
+    ## open a GET whose body is read by the caller in chunks, the total 
+    ## timeout is lifted for large downloads and only reads are bounded
+    @asynccontextmanager
+    async def stream(self, url: str, headers: Dict[str, str]) -> AsyncIterator[aiohttp.ClientResponse]:
+        await self.start()
+        timeout = aiohttp.ClientTimeout(total=None, sock_read=self.timeout_seconds)
+        attempt = 0
+        while True:
+            LINE_API_IN_FLIGHT.inc()
+            try:
+                response = await self.session.get(url, headers=headers, timeout=timeout)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                LINE_API_IN_FLIGHT.dec()
+                if attempt >= self.max_retries:
+                    raise
+                delay = self.__backoff(attempt)
+            else:
+                if response.status not in self.RETRY_STATUSES or attempt >= self.max_retries:
+                    try:
+                        yield response
+                    finally:
+                        response.release()
+                        LINE_API_IN_FLIGHT.dec()
+                    return
+                delay = self.__backoff(attempt, response.headers.get("Retry-After"))
+                response.release()
+                LINE_API_IN_FLIGHT.dec()
+            attempt += 1
+            await asyncio.sleep(delay)
+
+def _text_messages(message: Union[str, List[str]]) -> List[Dict[str, str]]:
+    texts = [message] if isinstance(message, str) else message
+    return [{"type": "text", "text": text} for text in texts]
 
 async def ReplyMessageHandler(
         reply_endpoint: str,
         channel_access_token: str, 
         reply_token: str, 
-        message: str
+        message: Union[str, List[str]],
+        client: LineApiClient = None
         ) -> str:
-    print(f"Replying with message: {message}")
+    logger.debug("replying", extra={"reply_token": reply_token, "reply": message})
     headers = {
         'Content-Type': 'application/json',
         'Authorization': f'Bearer {channel_access_token}'
     }
     reqBody = {
         "replyToken": reply_token,
-        "messages": [
-            {
-                "type": "text",
-                "text": message
-            }
-        ]
+        "messages": _text_messages(message)
+    }
+    with REPLY_STAGE.time():
+        if client is not None:
+            return await client.post(reply_endpoint, headers=headers, data=json.dumps(reqBody))
+        async with aiohttp.ClientSession() as session:
+            async with session.post(reply_endpoint, headers=headers, data=json.dumps(reqBody)) as response:
+                return await response.text()
+
+## reply with up to 5 text messages in one call, returns the status 
+## and the body. The call is sent once, the reply dispatcher retries 
+## it. See ReplyMessageDocument: https://developers.line.biz/
+## en/reference/messaging-api/#send-reply-message
+async def ReplyMessagesHandler(
+        client: LineApiClient,
+        reply_endpoint: str,
+        channel_access_token: str,
+        reply_token: str,
+        messages: List[str]
+        ) -> Tuple[int, str]:
+    headers = {
+        'Content-Type': 'application/json',
+        'Authorization': f'Bearer {channel_access_token}'
+    }
+    reqBody = {"replyToken": reply_token, "messages": _text_messages(messages)}
+    with REPLY_STAGE.time():
+        return await client.send(reply_endpoint, headers=headers, data=json.dumps(reqBody), max_retries=0)
+
+## push up to 5 text messages to a user once, the retry key makes the 
+## push the dispatcher retries idempotent: line answers 409 for a key 
+## it already accepted. See 
+## PushMessageDocument: https://developers.line.biz/en/reference/
+## messaging-api/#send-push-message
+async def PushMessagesHandler(
+        client: LineApiClient,
+        push_endpoint: str,
+        channel_access_token: str,
+        to: str,
+        messages: List[str],
+        retry_key: str
+        ) -> Tuple[int, str]:
+    headers = {
+        'Content-Type': 'application/json',
+        'Authorization': f'Bearer {channel_access_token}',
+        'X-Line-Retry-Key': retry_key
     }
-    async with aiohttp.ClientSession() as session:
-        async with session.post(reply_endpoint, headers=headers, data=json.dumps(reqBody)) as response:
-            return await response.text()
+    reqBody = {"to": to, "messages": _text_messages(messages)}
+    with PUSH_STAGE.time():
+        return await client.send(push_endpoint, headers=headers, data=json.dumps(reqBody), max_retries=0)
+
+## insert the rows and skip the ones whose unique key already exists, 
+## this is safe when two writers insert the same key at the same time. 
+## Given a single row, the returned rowcount tells whether it was new
+def _insert_ignoring_conflicts(
+        db: Session,
+        model: type,
+        index_elements: List[str],
+        rows: Union[Dict[str, Any], List[Dict[str, Any]]]
+        ) -> int:
+    table = model.__table__
+    dialect = db.get_bind().dialect.name
+    if dialect == "sqlite":
+        return db.execute(sqlite_insert(table).on_conflict_do_nothing(
+            index_elements=index_elements), rows).rowcount
+    if dialect == "postgresql":
+        return db.execute(postgresql_insert(table).on_conflict_do_nothing(
+            index_elements=index_elements), rows).rowcount
+    rowcount = 0
+    for row in ([rows] if isinstance(rows, dict) else rows):
+        try:
+            with db.begin_nested():
+                rowcount += db.execute(insert(table), row).rowcount
+        except IntegrityError:
+            pass
+    return rowcount
+
+## count one more reference for every blob the messages point at, in 
+## the transaction of the message records
+def _reference_blobs(db: Session, messages: List[Message]) -> None:
+    references: Dict[str, int] = {}
+    sizes: Dict[str, int] = {}
+    for message in messages:
+        if message.msg_content_hash is not None:
+            references[message.msg_content_hash] = references.get(message.msg_content_hash, 0) + 1
+            sizes[message.msg_content_hash] = message.msg_content_size
+    add_blob_references(db, references, sizes)
+
+## add the sha256 -> difference to the refcounts of the blobs, a blob 
+## without a row gets one of the given size
+def add_blob_references(db: Session, references: Dict[str, int], sizes: Dict[str, int]) -> None:
+    if len(references) == 0:
+        return
+    _insert_ignoring_conflicts(db, Blobs, ["sha256"], [
+        {"sha256": sha256, "size": sizes[sha256], "refcount": 0, "created_at": datetime.now()}
+        for sha256 in references
+    ])
+    blobs = Blobs.__table__
+    db.execute(
+        update(blobs).where(blobs.c.sha256 == bindparam("blob_sha256"))
+        .values(refcount=blobs.c.refcount + bindparam("references")),
+        [{"blob_sha256": sha256, "references": count} for sha256, count in references.items()]
+    )
+
+## resolve lineUserId -> UserInfo.id, create the missing users in the 
+## current transaction. The second dict holds the ids that came from 
+## the database, put them in the user cache once the caller commits
+def ResolveUsersHandler(
+        db: type[Session],
+        line_user_ids: Set[str]
+        ) -> Tuple[Dict[str, int], Dict[str, int]]:
+    with USER_LOOKUP_STAGE.time():
+        user_ids: Dict[str, int] = {}
+        for line_user_id in line_user_ids:
+            user_id = user_cache.get(line_user_id)
+            if user_id is not None:
+                user_ids[line_user_id] = user_id
+        missing = line_user_ids - user_ids.keys()
+        if len(missing) == 0:
+            return (user_ids, {})
+        resolved: Dict[str, int] = dict(
+            db.query(UserInfo.lineUserId, UserInfo.id)
+            .filter(UserInfo.lineUserId.in_(missing))
+            .all()
+        )
+        if len(resolved) < len(missing):
+            _insert_ignoring_conflicts(db, UserInfo, ["lineUserId"], [
+                {"lineUserId": line_user_id} for line_user_id in missing - resolved.keys()
+            ])
+            resolved = dict(
+                db.query(UserInfo.lineUserId, UserInfo.id)
+                .filter(UserInfo.lineUserId.in_(missing))
+                .all()
+            )
+        user_ids.update(resolved)
+        return (user_ids, resolved)
 
 ## handle message write in database
 def MessageRecordHandler(
         db: type[Session], 
         message: Message
         ) -> HandleStatus:
-    ## Check if the user exists in the database, if not, create a new user
-    user_object = db.query(UserInfo).filter(UserInfo.lineUserId == message.owner_id).first()
-    if not user_object:
+    with DB_WRITE_STAGE.time():
+        tags = extract_tags(message.msg_text)
+        ## resolve the user through the cache, create it if needed
         try:
-            new_user_info = UserInfo(lineUserId=message.owner_id)
-            db.add(new_user_info)
+            user_ids, resolved = ResolveUsersHandler(db, {message.owner_id})
             db.commit()
-            user_object = new_user_info
         except Exception as e:
-            print("database create user error", e)
-            return HandleStatus(ProcessMessage.USER_CREATE_ERROR, False)
-    ## Create a new message record
-    try:
-        MessageRecord = MessageRecords(
-        userInfo_id=user_object.id,
-        lineUserId=message.owner_id, 
-        message=message.msg_text,
-        filename=message.msg_filename, 
-        timestamp=message.msg_timestamp
+            db.rollback()
+            logger.error("database create user error", extra={"error": str(e)})
+            return HandleStatus(False, ProcessMessage.USER_CREATE_ERROR)
+        for line_user_id, user_id in resolved.items():
+            user_cache.put(line_user_id, user_id)
+        ## Create a new message record
+        try:
+            MessageRecord = MessageRecords(
+            userInfo_id=user_ids[message.owner_id],
+            lineUserId=message.owner_id, 
+            message=message.msg_text,
+            filename=message.msg_filename, 
+            filepath=message.msg_filepath,
+            timestamp=message.msg_timestamp,
+            media_status=_media_status(message)
+            )
+            db.add(MessageRecord)
+            _reference_blobs(db, [message])
+            if len(tags) > 0 and message.msg_timestamp is not None:
+                db.flush()
+                index_note_tags(db, [(MessageRecord.id, MessageRecord.userInfo_id,
+                                      message.msg_timestamp, tags)])
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            logger.error("database write error", extra={"error": str(e)})
+            return HandleStatus(False, ProcessMessage.DATABASE_WRITE_ERROR)
+        return HandleStatus(True, ProcessMessage.ALL_OK)
+
+## handle a batch of message writes in database, new users and all 
+## message records of the batch are written in a single transaction
+def MessageRecordsBatchHandler(
+        db: type[Session], 
+        messages: List[Message]
+        ) -> HandleStatus:
+    with DB_WRITE_STAGE.time():
+        tags = [extract_tags(message.msg_text) for message in messages]
+        try:
+            user_ids, resolved = ResolveUsersHandler(
+                db, {message.owner_id for message in messages})
+            rows = [
+                {
+                    "userInfo_id": user_ids[message.owner_id],
+                    "lineUserId": message.owner_id,
+                    "message": message.msg_text,
+                    "filename": message.msg_filename,
+                    "filepath": message.msg_filepath,
+                    "timestamp": message.msg_timestamp,
+                    "media_status": _media_status(message),
+                }
+                for message in messages
+            ]
+            ## bulk insert every message record of the batch, the 
+            ## records come back only when tagged notes need their ids. 
+            ## Their order is not asked for, it would cost a statement 
+            ## per row, a record finds its tags by its text instead
+            tags_of = {message.msg_text: note_tags
+                       for message, note_tags in zip(messages, tags) if len(note_tags) > 0}
+            if len(tags_of) > 0:
+                records = db.execute(
+                    insert(MessageRecords).returning(
+                        MessageRecords.id, MessageRecords.userInfo_id,
+                        MessageRecords.timestamp, MessageRecords.message),
+                    rows
+                ).all()
+                index_note_tags(db, [
+                    (record.id, record.userInfo_id, record.timestamp, tags_of[record.message])
+                    for record in records
+                    if record.message in tags_of and record.timestamp is not None
+                ])
+            else:
+                db.execute(insert(MessageRecords), rows)
+            _reference_blobs(db, messages)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            logger.error("database batch write error", extra={"error": str(e), "messages": len(messages)})
+            return HandleStatus(False, ProcessMessage.DATABASE_WRITE_ERROR)
+        ## only committed users go in the cache
+        for line_user_id, user_id in resolved.items():
+            user_cache.put(line_user_id, user_id)
+        return HandleStatus(True, ProcessMessage.ALL_OK)
+
+## add notes to the tag index in the transaction that writes them, 
+## given as (note id, userInfo_id, timestamp, tags). The tags new to 
+## the database are created, the counts of the user's tags go up
+def index_note_tags(
+        db: Session,
+        notes: List[Tuple[int, int, datetime, List[str]]]
+        ) -> None:
+    if len(notes) == 0:
+        return
+    names = {tag for _, _, _, note_tags in notes for tag in note_tags}
+    tag_ids: Dict[str, int] = dict(db.execute(
+        select(Tags.name, Tags.id).where(Tags.name.in_(names))).all())
+    if len(tag_ids) < len(names):
+        _insert_ignoring_conflicts(db, Tags, ["name"], [
+            {"name": name} for name in names - tag_ids.keys()
+        ])
+        tag_ids = dict(db.execute(
+            select(Tags.name, Tags.id).where(Tags.name.in_(names))).all())
+    counts: Dict[Tuple[int, int], int] = {}
+    rows = []
+    for note_id, user_id, timestamp, note_tags in notes:
+        for tag in note_tags:
+            rows.append({"userInfo_id": user_id, "tag_id": tag_ids[tag],
+                         "timestamp": timestamp, "note_id": note_id})
+            counts[(user_id, tag_ids[tag])] = counts.get((user_id, tag_ids[tag]), 0) + 1
+    db.execute(insert(NoteTags.__table__), rows)
+    _count_user_tags(db, counts)
+
+## take notes out of the tag index before they are deleted, the counts 
+## of their tags go down and a tag the user has no note of left is 
+## not listed any more
+def unindex_note_tags(
+        db: Session,
+        note_ids: List[int]
+        ) -> None:
+    counts: Dict[Tuple[int, int], int] = {
+        (row.userInfo_id, row.tag_id): -row.notes
+        for row in db.execute(
+            select(NoteTags.userInfo_id, NoteTags.tag_id, func.count().label("notes"))
+            .where(NoteTags.note_id.in_(note_ids))
+            .group_by(NoteTags.userInfo_id, NoteTags.tag_id))
+    }
+    if len(counts) == 0:
+        return
+    db.execute(delete(NoteTags).where(NoteTags.note_id.in_(note_ids)))
+    _count_user_tags(db, counts)
+    db.execute(delete(UserTags).where(
+        tuple_(UserTags.userInfo_id, UserTags.tag_id).in_(list(counts)),
+        UserTags.note_count <= 0))
+
+## add the (userInfo_id, tag_id) -> difference to the tag counts
+def _count_user_tags(db: Session, counts: Dict[Tuple[int, int], int]) -> None:
+    _insert_ignoring_conflicts(db, UserTags, ["userInfo_id", "tag_id"], [
+        {"userInfo_id": user_id, "tag_id": tag_id, "note_count": 0}
+        for user_id, tag_id in counts
+    ])
+    user_tags = UserTags.__table__
+    db.execute(
+        update(user_tags)
+        .where(user_tags.c.userInfo_id == bindparam("tag_user_id"),
+               user_tags.c.tag_id == bindparam("count_tag_id"))
+        .values(note_count=user_tags.c.note_count + bindparam("difference")),
+        [{"tag_user_id": user_id, "count_tag_id": tag_id, "difference": difference}
+         for (user_id, tag_id), difference in counts.items()]
+    )
+
+## the stored attachments wait for the post processor
+def _media_status(message: Message) -> Optional[str]:
+    return "pending" if message.msg_filepath is not None else None
+
+## handle the fetch request to line-data endpoint for downloading 
+## image/audio/file. The body is streamed into the blob store in 
+## chunks, hashed on the way, so memory stays flat whatever the file 
+## size and a duplicate content is stored once. Returns the blob path, 
+## sha256 and size, or the error and whether a later fetch may succeed: 
+## a 4xx stays a 4xx, a 5xx or a network error may pass. See FetchDataDocument: https://developers.line.biz/
+## en/reference/messaging-api/#get-content
+async def FileFetchHandler(
+        client: LineApiClient,
+        content_endpoint: str,
+        channel_access_token: str,
+        message_id: str,
+        blob_store: BlobStore,
+        chunk_size: int = 64 * 1024
+        ) -> Tuple[bool, str, str, int, bool]:
+    with CONTENT_FETCH_STAGE.time():
+        headers = {'Authorization': f'Bearer {channel_access_token}'}
+        url = content_endpoint.format(messageId=message_id)
+        loop = asyncio.get_running_loop()
+        writer = None
+        try:
+            async with client.stream(url, headers) as response:
+                if response.status != 200:
+                    return (False, f"content fetch failed with status {response.status}", None, 0,
+                            response.status in LineApiClient.RETRY_STATUSES)
+                writer = await loop.run_in_executor(None, blob_store.open_writer)
+                async for chunk in response.content.iter_chunked(chunk_size):
+                    await loop.run_in_executor(None, writer.write, chunk)
+            sha256, size, path = await loop.run_in_executor(None, writer.commit)
+        except Exception as e:
+            logger.warning("content fetch error", extra={"message_id": message_id, "error": str(e)})
+            if writer is not None:
+                await loop.run_in_executor(None, writer.abort)
+            return (False, f"content fetch failed: {e}", None, 0, True)
+        return (True, path, sha256, size, False)
+
+## handle the garbage collection of the blob store: blobs no message 
+## record uses any more lose their row and their file, files without a 
+## row are removed once they are older than the grace period
+def BlobGarbageHandler(
+        db: type[Session],
+        blob_store: BlobStore,
+        grace_seconds: float = 3600
+        ) -> Dict[str, int]:
+    removed_rows, keep = ReferencedBlobsHandler(db, grace_seconds)
+    removed = blob_store.remove_unreferenced(keep, grace_seconds)
+    return {"removed_rows": removed_rows, "removed_files": removed}
+
+## handle the rows of the blob garbage collection: the blobs no message 
+## record uses any more lose their row. Returns the number removed and 
+## the blobs still referenced, the files of the blob store are shared 
+## by the shards and only go once no shard keeps them
+def ReferencedBlobsHandler(
+        db: type[Session],
+        grace_seconds: float = 3600
+        ) -> Tuple[int, Set[str]]:
+    cutoff = datetime.fromtimestamp(time.time() - grace_seconds)
+    unused = db.execute(
+        select(Blobs.sha256).where(Blobs.refcount <= 0, Blobs.created_at < cutoff)
+    ).scalars().all()
+    ## the refcount is checked again, a blob referenced meanwhile stays
+    removed_rows = 0
+    if len(unused) > 0:
+        removed_rows = db.execute(
+            delete(Blobs).where(Blobs.sha256.in_(unused), Blobs.refcount <= 0)
+        ).rowcount
+        db.commit()
+    return (removed_rows, set(db.execute(select(Blobs.sha256)).scalars()))
+
+## a term matched literally by LIKE, its wildcards escaped
+def _escape_like(term: str) -> str:
+    return term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+## handle the note search of one user, ranked by bm25 with a snippet 
+## around the matched terms. Databases without FTS5, and queries in a 
+## script written without spaces, fall back to a LIKE scan of the notes 
+## holding every term, ordered by time
+def SearchNotesHandler(
+        db: type[Session],
+        line_user_id: str,
+        query: str,
+        page: int = 1,
+        page_size: int = 10
+        ) -> Dict[str, Any]:
+    page = max(page, 1)
+    result = {"query": query, "page": page, "page_size": page_size, "has_more": False, "results": []}
+    if query.strip() == "":
+        return result
+    offset = (page - 1) * page_size
+    if search_index_enabled(db.get_bind()) and not needs_substring_search(query):
+        rows = db.execute(text(f"""
+            SELECT m.id, m.message, m.filename, m.timestamp,
+                   snippet({FTS_TABLE}, 0, '[', ']', '...', 12) AS snippet,
+                   bm25({FTS_TABLE}) AS rank
+            FROM {FTS_TABLE} JOIN message_records AS m ON m.id = {FTS_TABLE}.rowid
+            WHERE {FTS_TABLE} MATCH :match
+            ORDER BY rank LIMIT :limit OFFSET :offset""").columns(timestamp=DateTime),
+            {"match": build_match_query(line_user_id, query),
+             "limit": page_size + 1, "offset": offset}).all()
+    else:
+        rows = db.execute(
+            select(MessageRecords.id, MessageRecords.message, MessageRecords.filename,
+                   MessageRecords.timestamp, MessageRecords.message, null())
+            .where(MessageRecords.lineUserId == line_user_id,
+                   *[MessageRecords.message.like(f"%{_escape_like(term)}%", escape="\\")
+                     for term in query.split()])
+            .order_by(MessageRecords.timestamp.desc())
+            .limit(page_size + 1).offset(offset)).all()
+    result["has_more"] = len(rows) > page_size
+    result["results"] = [
+        {"id": row[0], "message": row[1], "filename": row[2], "timestamp": row[3],
+         "snippet": row[4], "rank": row[5]}
+        for row in rows[:page_size]
+    ]
+    return result
+
+## the id of a user known by its lineUserId, None for a stranger
+def _user_id(db: Session, line_user_id: str) -> Optional[int]:
+    user_id = user_cache.get(line_user_id)
+    if user_id is None:
+        user_id = db.execute(
+            select(UserInfo.id).where(UserInfo.lineUserId == line_user_id)
+        ).scalar()
+    return user_id
+
+## handle the tag list of one user, the most used first. It reads the 
+## counts kept in user_tags, so it costs the same for a user with 100 
+## notes and one with 100k
+def UserTagsHandler(
+        db: type[Session],
+        line_user_id: str,
+        limit: int = 100
+        ) -> Dict[str, Any]:
+    result = {"tags": []}
+    user_id = _user_id(db, line_user_id)
+    if user_id is None:
+        return result
+    rows = db.execute(
+        select(Tags.name, UserTags.note_count)
+        .join(Tags, Tags.id == UserTags.tag_id)
+        .where(UserTags.userInfo_id == user_id, UserTags.note_count > 0)
+        .order_by(UserTags.note_count.desc(), Tags.name)
+        .limit(limit)
+    ).all()
+    result["tags"] = [{"tag": row.name, "count": row.note_count} for row in rows]
+    return result
+
+## handle the notes of one user carrying a tag newest-first, read along 
+## the primary key of note_tags
+def TagNotesHandler(
+        db: type[Session],
+        line_user_id: str,
+        tag: str,
+        limit: int = 20
+        ) -> Dict[str, Any]:
+    result = {"tag": tag, "count": 0, "notes": []}
+    user_id = _user_id(db, line_user_id)
+    if user_id is None:
+        return result
+    tag_id = db.execute(select(Tags.id).where(Tags.name == tag)).scalar()
+    if tag_id is None:
+        return result
+    result["count"] = db.execute(
+        select(UserTags.note_count)
+        .where(UserTags.userInfo_id == user_id, UserTags.tag_id == tag_id)
+    ).scalar() or 0
+    rows = db.execute(
+        select(MessageRecords.id, MessageRecords.message, MessageRecords.filename,
+               MessageRecords.timestamp)
+        .join(NoteTags, NoteTags.note_id == MessageRecords.id)
+        .where(NoteTags.userInfo_id == user_id, NoteTags.tag_id == tag_id)
+        .order_by(NoteTags.timestamp.desc(), NoteTags.note_id.desc())
+        .limit(limit)
+    ).all()
+    result["notes"] = [
+        {"id": row.id, "message": row.message, "filename": row.filename, "timestamp": row.timestamp}
+        for row in rows
+    ]
+    return result
+
+## the cursor of the note history is the (timestamp, id) of the last 
+## note of a page, opaque to the client
+def encode_notes_cursor(timestamp: datetime, record_id: int) -> str:
+    raw = f"{timestamp.isoformat()}|{record_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+def decode_notes_cursor(cursor: str) -> Tuple[datetime, int]:
+    raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+    timestamp, record_id = raw.rsplit("|", 1)
+    return (datetime.fromisoformat(timestamp), int(record_id))
+
+## handle the note history of one user newest-first. Pages are read 
+## by keyset along the (userInfo_id, timestamp, id) index, so a deep 
+## page costs the same as the first one. Notes without a timestamp are 
+## not listed. The attachment paths are relative to the media root of 
+## blob_store, without one they are left out
+def NotesHistoryHandler(
+        db: type[Session],
+        line_user_id: str,
+        cursor: Optional[str] = None,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+        limit: int = 20,
+        archive: Optional[NoteArchive] = None,
+        blob_store: Optional[BlobStore] = None
+        ) -> Dict[str, Any]:
+    result = {"notes": [], "next_cursor": None}
+    user_id = user_cache.get(line_user_id)
+    if user_id is None:
+        user_id = db.execute(
+            select(UserInfo.id).where(UserInfo.lineUserId == line_user_id)
+        ).scalar()
+        if user_id is None:
+            return result
+    query = (
+        select(MessageRecords.id, MessageRecords.message, MessageRecords.filename,
+               MessageRecords.filepath, MessageRecords.timestamp, MessageRecords.thumbnail_path,
+               MessageRecords.preview_path, MessageRecords.media_info)
+        .where(MessageRecords.userInfo_id == user_id,
+               MessageRecords.timestamp.is_not(None))
+    )
+    if since is not None:
+        query = query.where(MessageRecords.timestamp >= since)
+    if until is not None:
+        query = query.where(MessageRecords.timestamp < until)
+    if cursor is not None:
+        query = query.where(
+            tuple_(MessageRecords.timestamp, MessageRecords.id) < tuple_(*decode_notes_cursor(cursor)))
+    rows = db.execute(
+        query.order_by(MessageRecords.timestamp.desc(), MessageRecords.id.desc())
+        .limit(limit + 1)
+    ).all()
+    notes = [
+        {"id": row.id, "message": row.message, "filename": row.filename,
+         "filepath": row.filepath, "timestamp": row.timestamp, "archived": False,
+         "thumbnail_path": row.thumbnail_path, "preview_path": row.preview_path,
+         "media": orjson.loads(row.media_info) if row.media_info is not None else None}
+        for row in rows
+    ]
+    ## the page reaches past the archive horizon, the archived notes of 
+    ## the same range are merged in
+    if archive is not None:
+        horizon = archive.horizon(line_user_id)
+        if horizon is not None and (len(notes) <= limit or notes[-1]["timestamp"] < horizon):
+            hot_ids = {note["id"] for note in notes}
+            archived = archive.history(
+                line_user_id,
+                before = decode_notes_cursor(cursor) if cursor is not None else None,
+                since = since,
+                until = until,
+                limit = limit + 1
+            )
+            notes.extend(
+                {"id": note["id"], "message": note["message"], "filename": note["filename"],
+                 "filepath": note["filepath"], "timestamp": note["timestamp"], "archived": True,
+                 "thumbnail_path": note.get("thumbnail_path"), "preview_path": note.get("preview_path"),
+                 "media": note.get("media")}
+                for note in archived if note["id"] not in hot_ids)
+            notes.sort(key=lambda note: (note["timestamp"], note["id"]), reverse=True)
+            notes = notes[:limit + 1]
+    result["notes"] = notes[:limit]
+    for note in result["notes"]:
+        for key in ("filepath", "thumbnail_path", "preview_path"):
+            note[key] = blob_store.relative_path(note[key]) if blob_store is not None else None
+    if len(notes) > limit:
+        last = notes[limit - 1]
+        result["next_cursor"] = encode_notes_cursor(last["timestamp"], last["id"])
+    return result
+
+## the notes of one user oldest-first for the export: the rows come 
+## from a server-side cursor yield_per rows at a time, the archived 
+## months are read as they stream out of their files. The rows of an 
+## archived month are merged in after it, so a note both archived and 
+## still in message_records is exported once
+def _export_notes(
+        db: type[Session],
+        line_user_id: str,
+        archive: Optional[NoteArchive],
+        yield_per: int,
+        max_id: Optional[int] = None
+        ) -> Iterator[Dict[str, Any]]:
+    user_id = user_cache.get(line_user_id)
+    if user_id is None:
+        user_id = db.execute(
+            select(UserInfo.id).where(UserInfo.lineUserId == line_user_id)
+        ).scalar()
+    rows: Iterator[Any] = iter(())
+    if user_id is not None:
+        query = (
+            select(MessageRecords.id, MessageRecords.message, MessageRecords.filename,
+                   MessageRecords.filepath, MessageRecords.timestamp)
+            .where(MessageRecords.userInfo_id == user_id)
+            .order_by(MessageRecords.timestamp, MessageRecords.id)
+            .execution_options(yield_per=yield_per)
         )
-        db.add(MessageRecord)
+        if max_id is not None:
+            query = query.where(MessageRecords.id <= max_id)
+        rows = iter(db.execute(query))
+    row = next(rows, None)
+    months = [] if archive is None else sorted(archive.months(line_user_id))
+    for month in months:
+        year, number = (int(part) for part in month.split("-"))
+        end = datetime(year + number // 12, number % 12 + 1, 1)
+        archived_ids = set()
+        for note in archive.iter_month(line_user_id, month):
+            if max_id is not None and note["id"] > max_id:
+                continue
+            archived_ids.add(note["id"])
+            yield {"id": note["id"], "message": note["message"], "filename": note["filename"],
+                   "filepath": note["filepath"], "timestamp": note["timestamp"], "archived": True}
+        while row is not None and (row.timestamp is None or row.timestamp < end):
+            if row.id not in archived_ids:
+                yield {"id": row.id, "message": row.message, "filename": row.filename,
+                       "filepath": row.filepath, "timestamp": row.timestamp, "archived": False}
+            row = next(rows, None)
+    while row is not None:
+        yield {"id": row.id, "message": row.message, "filename": row.filename,
+               "filepath": row.filepath, "timestamp": row.timestamp, "archived": False}
+        row = next(rows, None)
+
+## the name of a note's attachment in the export zip
+def _attachment_name(note: Dict[str, Any]) -> str:
+    name = note["filename"] or os.path.basename(note["filepath"])
+    return f"attachments/{note['id']}-{re.sub(r'[^A-Za-z0-9._-]', '_', name)[-100:]}"
+
+## handle the export of every note of one user, archived ones included, 
+## as json lines or as a zip of notes.ndjson and the attachments. The 
+## bytes are produced chunk by chunk while they are sent, memory stays 
+## the same whatever the size of the history. Run it with 
+## DatabaseExecutor.stream
+def ExportNotesHandler(
+        db: type[Session],
+        line_user_id: str,
+        archive: Optional[NoteArchive] = None,
+        format: str = "zip",
+        chunk_size: int = 64 * 1024,
+        yield_per: int = 500
+        ) -> Iterator[bytes]:
+    if format == "ndjson":
+        buffer = bytearray()
+        for note in _export_notes(db, line_user_id, archive, yield_per):
+            del note["filepath"]
+            buffer += orjson.dumps(note) + b"\n"
+            if len(buffer) >= chunk_size:
+                yield bytes(buffer)
+                buffer.clear()
+        if len(buffer) > 0:
+            yield bytes(buffer)
+        return
+    sink = ZipSink()
+    now = time.localtime()[:6]
+    ## the notes are deflated at the fastest level, the attachments are 
+    ## stored as they are, media is compressed already
+    with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=1) as bundle:
+        ## the notes first, the attachments after them: every entry of 
+        ## a zip is written in one piece
+        max_id = 0
+        with bundle.open("notes.ndjson", "w", force_zip64=True) as file:
+            for note in _export_notes(db, line_user_id, archive, yield_per):
+                max_id = max(max_id, note["id"])
+                note["attachment"] = _attachment_name(note) if note["filepath"] is not None else None
+                del note["filepath"]
+                file.write(orjson.dumps(note) + b"\n")
+                if sink.size >= chunk_size:
+                    yield sink.take()
+        ## the notes written since the first pass are left out
+        for note in _export_notes(db, line_user_id, archive, yield_per, max_id):
+            if note["filepath"] is None:
+                continue
+            try:
+                content = open(note["filepath"], "rb")
+            except FileNotFoundError:
+                logger.warning("export attachment missing", extra={"id": note["id"]})
+                continue
+            with content:
+                entry = zipfile.ZipInfo(_attachment_name(note), date_time=now)
+                with bundle.open(entry, "w", force_zip64=True) as file:
+                    while True:
+                        chunk = content.read(chunk_size)
+                        if not chunk:
+                            break
+                        file.write(chunk)
+                        if sink.size >= chunk_size:
+                            yield sink.take()
+    yield sink.take()
+
+## handle one chunk of the retention: the notes older than older_than 
+## are taken user by user along the history index, appended to the 
+## archive, then deleted in a short transaction of their own. Their blobs keep the reference, an 
+## archived note can still be opened, they leave the tag index. Call it again until fewer than 
+## chunk_size notes were archived
+def ArchiveNotesHandler(
+        db: type[Session],
+        archive: NoteArchive,
+        older_than: datetime,
+        chunk_size: int = 500
+        ) -> Dict[str, int]:
+    rows = db.execute(
+        select(MessageRecords.id, MessageRecords.userInfo_id, MessageRecords.lineUserId,
+               MessageRecords.message, MessageRecords.filename, MessageRecords.filepath,
+               MessageRecords.timestamp, MessageRecords.thumbnail_path, MessageRecords.preview_path,
+               MessageRecords.media_info)
+        .where(MessageRecords.timestamp < older_than)
+        .order_by(MessageRecords.userInfo_id, MessageRecords.timestamp, MessageRecords.id)
+        .limit(chunk_size)
+    ).all()
+    if len(rows) == 0:
+        return {"archived": 0}
+    groups: Dict[Tuple[str, str], List[Dict[str, Any]]] = {}
+    for row in rows:
+        groups.setdefault((row.lineUserId or "", row.timestamp.strftime("%Y-%m")), []).append({
+            "id": row.id, "userInfo_id": row.userInfo_id, "lineUserId": row.lineUserId,
+            "message": row.message, "filename": row.filename, "filepath": row.filepath,
+            "timestamp": row.timestamp.isoformat(),
+            "thumbnail_path": row.thumbnail_path, "preview_path": row.preview_path,
+            "media": orjson.loads(row.media_info) if row.media_info is not None else None,
+        })
+    for (line_user_id, month), notes in groups.items():
+        archive.append(line_user_id, month, notes)
+    try:
+        unindex_note_tags(db, [row.id for row in rows])
+        db.execute(delete(MessageRecords).where(MessageRecords.id.in_([row.id for row in rows])))
         db.commit()
     except Exception as e:
-        print("database error", e)
-        return HandleStatus(ProcessMessage.DATABASE_WRITE_ERROR, False)
-    return HandleStatus(ProcessMessage.ALL_OK, True)
+        db.rollback()
+        logger.error(ProcessMessage.DATABASE_DELETE_ERROR.value, extra={"error": str(e)})
+        raise
+    return {"archived": len(rows)}
 
-## handle the fetch request to line-data endpoint for downloading 
-## image/audio/file
\ No newline at end of file
+## handle the compaction after the retention: the free pages are given 
+## back to the file step by step with incremental_vacuum, so writers 
+## get the lock between the steps, then the statistics are refreshed. 
+## A data.db created before auto_vacuum=INCREMENTAL needs one full 
+## VACUUM, which locks it for its whole run and only happens with 
+## convert. See SqliteVacuumDocument: https://www.sqlite.org/
+## pragma.html#pragma_incremental_vacuum
+def CompactDatabaseHandler(
+        db: type[Session],
+        step_pages: int = 1000,
+        convert: bool = False
+        ) -> Dict[str, Any]:
+    engine = db.get_bind()
+    report = {"freed_pages": 0, "converted": False, "incremental": True}
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        if engine.dialect.name != "sqlite":
+            connection.exec_driver_sql("ANALYZE")
+            return report
+        if connection.exec_driver_sql("PRAGMA auto_vacuum").scalar() != 2:
+            if not convert:
+                report["incremental"] = False
+            else:
+                connection.exec_driver_sql("PRAGMA auto_vacuum=INCREMENTAL")
+                connection.exec_driver_sql("VACUUM")
+                report["converted"] = True
+        if report["incremental"]:
+            free = connection.exec_driver_sql("PRAGMA freelist_count").scalar()
+            while free > 0:
+                connection.exec_driver_sql(f"PRAGMA incremental_vacuum({int(step_pages)})")
+                remaining = connection.exec_driver_sql("PRAGMA freelist_count").scalar()
+                if remaining >= free:
+                    break
+                report["freed_pages"] += free - remaining
+                free = remaining
+        connection.exec_driver_sql("PRAGMA analysis_limit=1000")
+        connection.exec_driver_sql("ANALYZE")
+        connection.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+    return report
+
+## handle the claim of up to limit pending attachments for the post 
+## processor owner, the claims of a stopped owner are taken over once 
+## older than lease_seconds. Returns the (id, filepath) claimed
+def ClaimAttachmentsHandler(
+        db: type[Session],
+        owner: str,
+        limit: int,
+        lease_seconds: float
+        ) -> List[Tuple[int, str]]:
+    now = datetime.now()
+    claimable = (
+        (MessageRecords.media_status == "pending")
+        & ((MessageRecords.media_claimed_by.is_(None))
+           | (MessageRecords.media_claimed_at < now - timedelta(seconds=lease_seconds)))
+    )
+    ids = list(db.execute(
+        select(MessageRecords.id).where(claimable).order_by(MessageRecords.id).limit(limit)
+    ).scalars())
+    if len(ids) == 0:
+        return []
+    ## the condition again, another process may have claimed some of them
+    db.execute(
+        update(MessageRecords)
+        .where(MessageRecords.id.in_(ids), claimable)
+        .values(media_claimed_by=owner, media_claimed_at=now)
+    )
+    db.commit()
+    return [tuple(row) for row in db.execute(
+        select(MessageRecords.id, MessageRecords.filepath)
+        .where(MessageRecords.id.in_(ids), MessageRecords.media_claimed_by == owner,
+               MessageRecords.media_claimed_at == now)
+    )]
+
+## handle the result of a post-processed attachment, a claim taken 
+## over by another owner in the meantime is left to it
+def RecordAttachmentHandler(
+        db: type[Session],
+        record_id: int,
+        owner: str,
+        status: str,
+        result: Dict[str, Any]
+        ) -> bool:
+    updated = db.execute(
+        update(MessageRecords)
+        .where(MessageRecords.id == record_id, MessageRecords.media_claimed_by == owner)
+        .values(media_status=status,
+                media_info=orjson.dumps(result.get("info")).decode(),
+                thumbnail_path=result.get("thumbnail_path"),
+                preview_path=result.get("preview_path"),
+                media_claimed_by=None,
+                media_claimed_at=None)
+    ).rowcount
+    db.commit()
+    return updated > 0
+
+## handle the claims of a stopping post processor, its unfinished 
+## attachments are pending for the others at once
+def ReleaseAttachmentsHandler(
+        db: type[Session],
+        owner: str
+        ) -> int:
+    released = db.execute(
+        update(MessageRecords)
+        .where(MessageRecords.media_claimed_by == owner)
+        .values(media_claimed_by=None, media_claimed_at=None)
+    ).rowcount
+    db.commit()
+    return released
+
+## claim the webhook event ids for processing, the ids another worker 
+## or an earlier delivery already claimed are left out of the result. 
+## Every id is inserted on its own so its rowcount tells who won it
+def ClaimEventsHandler(
+        db: type[Session],
+        event_ids: List[str]
+        ) -> Set[str]:
+    claimed: Set[str] = set()
+    processed_at = datetime.now()
+    for event_id in event_ids:
+        rowcount = _insert_ignoring_conflicts(db, ProcessedEvents, ["webhookEventId"], 
+            {"webhookEventId": event_id, "processed_at": processed_at})
+        if rowcount == 1:
+            claimed.add(event_id)
+    db.commit()
+    return claimed
+
+## give the claims back when processing the events failed, so their 
+## redelivery is processed
+def ReleaseEventsHandler(
+        db: type[Session],
+        event_ids: List[str]
+        ) -> None:
+    db.execute(delete(ProcessedEvents).where(ProcessedEvents.webhookEventId.in_(event_ids)))
+    db.commit()
+    for event_id in event_ids:
+        recent_events.invalidate(event_id)
+
+## forget the event ids older than line could redeliver them
+def PruneProcessedEventsHandler(
+        db: type[Session],
+        older_than: datetime
+        ) -> int:
+    removed = db.execute(
+        delete(ProcessedEvents).where(ProcessedEvents.processed_at < older_than)
+    ).rowcount
+    db.commit()
+    return removed
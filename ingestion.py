@@ -0,0 +1,275 @@
+import asyncio
+import functools
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from metrics import INGESTION_BUSY
+
+logger = logging.getLogger(__name__)
+
+## the ingestion queue journals every verified webhook body in a local
+## sqlite file before the webhook is acknowledged, so line gets its
+## 200 at once and pending work survives a restart. See
+## ReceivingMessagesDocument: https://developers.line.biz/en/docs/
+## messaging-api/receiving-messages/#webhook-delivery-failure
+## Worker processes share the journal: a job is claimed under the name
+## of its process, and the jobs of a process whose heartbeat stopped
+## go back to pending for the others. A job enqueued with a delay is
+## not claimed before not_before, jobs are claimed in due order. A failed
+## job is due again after a backoff doubling with every attempt. The
+## calls wait for the write lock up to the busy timeout, the event loop
+## makes them on the queue's own thread through run
+class IngestionQueue:
+    def __init__(
+            self,
+            path: str = "./queue.db",
+            max_attempts: int = 5,
+            lease_seconds: float = 30.0,
+            retry_backoff_seconds: float = 1.0,
+            max_backoff_seconds: float = 300.0
+            ) -> None:
+        self.path = path
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+        self.retry_backoff_seconds = retry_backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        ## every worker process sharing the journal owns the jobs it
+        ## claims under its own name
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.lock = threading.Lock()
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.conn: sqlite3.Connection = None
+        self.processed = 0
+        self.failed = 0
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.wakeup: Optional[asyncio.Event] = None
+    ## run a call of the queue on its thread and await it from the loop
+    async def run(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, functools.partial(fn, *args, **kwargs))
+    ## connect and start the queue's thread in the process that uses the
+    ## queue, neither must cross a fork
+    def open(self) -> None:
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="queue")
+        self.conn = sqlite3.connect(
+            self.path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS ingestion_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                body BLOB NOT NULL,
+                enqueued_at REAL NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                claimed_by TEXT,
+                not_before REAL NOT NULL DEFAULT 0
+            )""")
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(ingestion_jobs)")]
+        if "claimed_by" not in columns:
+            self.conn.execute("ALTER TABLE ingestion_jobs ADD COLUMN claimed_by TEXT")
+        if "not_before" not in columns:
+            self.conn.execute("ALTER TABLE ingestion_jobs ADD COLUMN not_before REAL NOT NULL DEFAULT 0")
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS ix_ingestion_jobs_status_id "
+            "ON ingestion_jobs (status, id)")
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS ix_ingestion_jobs_status_not_before_id "
+            "ON ingestion_jobs (status, not_before, id)")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS ingestion_owners (
+                owner TEXT PRIMARY KEY,
+                heartbeat_at REAL NOT NULL
+            )""")
+        self.heartbeat()
+    ## tell the other processes this one is alive, and put back the jobs
+    ## of the owners that stopped beating: they were never acknowledged
+    def heartbeat(self) -> int:
+        now = time.time()
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.execute(
+                    "INSERT INTO ingestion_owners (owner, heartbeat_at) VALUES (?, ?) "
+                    "ON CONFLICT (owner) DO UPDATE SET heartbeat_at = excluded.heartbeat_at",
+                    (self.owner, now))
+                self.conn.execute(
+                    "DELETE FROM ingestion_owners WHERE heartbeat_at < ?",
+                    (now - self.lease_seconds,))
+                recovered = self.conn.execute(
+                    "UPDATE ingestion_jobs SET status = 'pending', claimed_by = NULL "
+                    "WHERE status = 'running' AND (claimed_by IS NULL OR claimed_by "
+                    "NOT IN (SELECT owner FROM ingestion_owners))").rowcount
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        return recovered
+    ## write the body in the journal, the job is durable once this 
+    ## returns and claimed delay_seconds later at the earliest
+    def enqueue(self, body: bytes, delay_seconds: float = 0.0) -> int:
+        now = time.time()
+        with self.lock:
+            cursor = self.conn.execute(
+                "INSERT INTO ingestion_jobs (body, enqueued_at, not_before) VALUES (?, ?, ?)",
+                (body, now, now + delay_seconds))
+        ## enqueued from the queue's thread, the workers wait on the loop
+        if self.wakeup is not None and delay_seconds <= 0:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+        return cursor.lastrowid
+    ## take the pending job due first and mark it running, returns its 
+    ## id, body, enqueue time and the number of this attempt
+    def claim(self) -> Optional[Tuple[int, bytes, float, int]]:
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.conn.execute(
+                    "SELECT id, body, enqueued_at, attempts + 1 FROM ingestion_jobs "
+                    "WHERE status = 'pending' AND not_before <= ? "
+                    "ORDER BY not_before, id LIMIT 1", (time.time(),)).fetchone()
+                if row is not None:
+                    self.conn.execute(
+                        "UPDATE ingestion_jobs SET status = 'running', "
+                        "attempts = attempts + 1, claimed_by = ? WHERE id = ?",
+                        (self.owner, row[0]))
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        return row
+    ## write a body no attempt could process in the journal as dead, 
+    ## it is kept to look at and never claimed
+    def bury(self, body: bytes) -> int:
+        with self.lock:
+            cursor = self.conn.execute(
+                "INSERT INTO ingestion_jobs (body, enqueued_at, status) VALUES (?, ?, 'dead')",
+                (body, time.time()))
+        logger.warning("webhook body %d is no webhook payload, journaled dead", cursor.lastrowid)
+        return cursor.lastrowid
+    ## the job is done, remove it from the journal
+    def ack(self, job_id: int) -> None:
+        with self.lock:
+            self.conn.execute("DELETE FROM ingestion_jobs WHERE id = ?", (job_id,))
+        self.processed += 1
+    ## the job failed, put it back until it runs out of attempts, due
+    ## again retry_backoff_seconds * 2 ** (attempts - 1) later
+    def fail(self, job_id: int) -> None:
+        with self.lock:
+            self.conn.execute(
+                "UPDATE ingestion_jobs SET status = CASE WHEN attempts >= ? "
+                "THEN 'dead' ELSE 'pending' END, claimed_by = NULL, "
+                "not_before = ? + MIN(?, ? * (1 << MAX(attempts - 1, 0))) WHERE id = ?",
+                (self.max_attempts, time.time(), self.max_backoff_seconds,
+                 self.retry_backoff_seconds, job_id))
+        self.failed += 1
+    ## the jobs due or running, the work the workers have in front of them
+    def ready(self) -> int:
+        with self.lock:
+            return self.conn.execute(
+                "SELECT (SELECT COUNT(*) FROM ingestion_jobs WHERE status = 'pending' "
+                "AND not_before <= ?) + (SELECT COUNT(*) FROM ingestion_jobs "
+                "WHERE status = 'running')", (time.time(),)).fetchone()[0]
+    ## depth is the number of jobs waiting, deferred the ones of them 
+    ## not due yet, lag is the age in seconds of the oldest due one
+    def stats(self) -> Dict[str, float]:
+        now = time.time()
+        with self.lock:
+            counts = dict(self.conn.execute(
+                "SELECT status, COUNT(*) FROM ingestion_jobs GROUP BY status").fetchall())
+            deferred = self.conn.execute(
+                "SELECT COUNT(*) FROM ingestion_jobs WHERE status = 'pending' "
+                "AND not_before > ?", (now,)).fetchone()[0]
+            oldest = self.conn.execute(
+                "SELECT MIN(enqueued_at) FROM ingestion_jobs "
+                "WHERE status = 'pending' AND not_before <= ?", (now,)).fetchone()[0]
+        return {
+            "depth": counts.get("pending", 0),
+            "deferred": deferred,
+            "running": counts.get("running", 0),
+            "dead": counts.get("dead", 0),
+            "lag_seconds": 0.0 if oldest is None else max(0.0, now - oldest),
+            "processed": self.processed,
+            "failed": self.failed,
+        }
+    ## give back the jobs this process still runs and leave the owners
+    def close(self) -> None:
+        if self.conn is None:
+            return
+        with self.lock:
+            self.conn.execute(
+                "UPDATE ingestion_jobs SET status = 'pending', claimed_by = NULL "
+                "WHERE status = 'running' AND claimed_by = ?", (self.owner,))
+            self.conn.execute("DELETE FROM ingestion_owners WHERE owner = ?", (self.owner,))
+            self.conn.close()
+            self.conn = None
+        self.executor.shutdown()
+        self.executor = None
+
+## the worker pool drains the ingestion queue with a fixed number of
+## asyncio tasks, each one hands the body to the job handler and tells
+## it whether the job runs for the last time
+class IngestionWorkers:
+    def __init__(
+            self,
+            queue: IngestionQueue,
+            handler: Callable[[bytes, bool], Awaitable[None]],
+            size: int = 4,
+            idle_seconds: float = 1.0
+            ) -> None:
+        self.queue = queue
+        self.handler = handler
+        self.size = size
+        self.idle_seconds = idle_seconds
+        self.tasks: List[asyncio.Task] = []
+    ## beat well inside the lease so a slow beat doesn't cost the jobs
+    async def __beat(self) -> None:
+        while True:
+            await asyncio.sleep(self.queue.lease_seconds / 3)
+            try:
+                recovered = await self.queue.run(self.queue.heartbeat)
+            except Exception as e:
+                logger.error("ingestion heartbeat error", extra={"error": str(e)})
+                continue
+            if recovered > 0:
+                self.queue.wakeup.set()
+    async def __work(self) -> None:
+        while True:
+            self.queue.wakeup.clear()
+            job = await self.queue.run(self.queue.claim)
+            if job is None:
+                try:
+                    await asyncio.wait_for(self.queue.wakeup.wait(), self.idle_seconds)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            job_id, body, _, attempt = job
+            INGESTION_BUSY.inc()
+            try:
+                await self.handler(body, attempt >= self.queue.max_attempts)
+            except asyncio.CancelledError:
+                ## leave the job running, closing the queue or the next
+                ## heartbeat of another process puts it back
+                raise
+            except Exception as e:
+                logger.exception("ingestion job error", extra={"job_id": job_id, "error": str(e)})
+                await self.queue.run(self.queue.fail, job_id)
+            else:
+                await self.queue.run(self.queue.ack, job_id)
+            finally:
+                INGESTION_BUSY.dec()
+    def start(self) -> None:
+        self.queue.loop = asyncio.get_running_loop()
+        self.queue.wakeup = asyncio.Event()
+        self.tasks = [asyncio.create_task(self.__work()) for _ in range(self.size)]
+        self.tasks.append(asyncio.create_task(self.__beat()))
+    async def stop(self) -> None:
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
@@ -0,0 +1,64 @@
+import logging
+import logging.handlers
+import queue
+import sys
+from datetime import datetime, timezone
+from typing import Optional
+import orjson
+
+## the attributes every log record has, anything else came in extra=
+## and is written as a field of its own
+_RECORD_ATTRIBUTES = set(logging.LogRecord("", 0, "", 0, "", (), None).__dict__) | {"message", "asctime"}
+
+## one json object per line: time, level, logger, message and the
+## extra fields of the call, e.g.
+## logger.warning("database batch write error", extra={"error": str(e)})
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return orjson.dumps(entry, default=str).decode()
+
+## merge the arguments into the message before the record crosses to
+## the listener thread, the exception stays for the json formatter
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+## route the records of every logger through a queue: the event loop
+## only puts them in it, a listener thread formats and writes them
+def start_logging(level: str = "INFO") -> None:
+    global _listener
+    if _listener is not None:
+        return
+    records: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter())
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_QueueHandler(records))
+    root.setLevel(level)
+    _listener = logging.handlers.QueueListener(records, output)
+    _listener.start()
+
+## write what is still queued and stop the listener
+def stop_logging() -> None:
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    _listener = None
@@ -1,55 +1,415 @@
 
-from typing import Annotated
+import argparse
+import asyncio
+import logging
+import os
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from typing import Annotated, Optional
+import orjson
 import uvicorn
 import yaml
 from fastapi import FastAPI, Request, HTTPException, Depends, status
-from rules import Base, UserInfo, MessageRecords, ProcessMessage
-from database import engine, db_session
-from sqlalchemy.orm import Session
-from executors import ManagerBot, ClerkBot, CustomerBot, SeniorOfficerBot, StorageBot
-
-## Create sqlite data.db, but only if it doesn't exist
-Base.metadata.create_all(bind=engine)
-def setup_db_session():
-    db = db_session()
-    try:
-        yield db
-    finally:
-        db.close()
-db_driver = Annotated[Session, Depends(setup_db_session)]
-## Load the config file
-with open('./config.yaml') as file:
-    config = yaml.safe_load(file)
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from database import db_session, DatabaseExecutor
+from sqlalchemy.orm import sessionmaker
+from executors import ManagerBot, SeniorOfficerBot
+from handlers import ReferencedBlobsHandler, SearchNotesHandler, NotesHistoryHandler
+from handlers import PruneProcessedEventsHandler, ArchiveNotesHandler, CompactDatabaseHandler
+from handlers import ExportNotesHandler, UserTagsHandler, TagNotesHandler
+from sharding import ShardedDatabaseExecutor, init_shards, prepare_shard, shard_urls
+from tags import tag_query
+from ingestion import IngestionQueue, IngestionWorkers
+from writers import GroupCommitWriter
+from dispatchers import ReplyDispatcher
+from admission import AdmissionController
+from postprocessing import PostProcessor
+from caches import recent_events, user_cache
+from coordination import FileLock
+from maintenance import MaintenanceScheduler
+from archive import NoteArchive
+from exports import EXPORT_FORMATS, verify_export_link
+from logs import start_logging, stop_logging
+from metrics import HTTP_IN_FLIGHT, INGESTION_DEPTH, render as render_metrics
+
+## Load the config file, the launcher hands the config it loaded to 
+## its worker processes in APP_CONFIG so every worker runs with the 
+## same one
+def load_config() -> dict:
+    if os.environ.get("APP_CONFIG"):
+        return orjson.loads(os.environ["APP_CONFIG"])
+    with open(os.environ.get("APP_CONFIG_PATH", "./config.yaml")) as file:
+        return yaml.safe_load(file)
+config = load_config()
+logger = logging.getLogger("main")
+## the worker processes of one host coordinate through lock files: 
+## the schema is created by one worker at a time, and one worker is 
+## elected to run the maintenance for all of them
+LOCK_DIR = config.get("LOCK_DIR", "./locks")
+schemaLock = FileLock(os.path.join(LOCK_DIR, "schema.lock"))
+maintenanceLock = FileLock(os.path.join(LOCK_DIR, "maintenance.lock"))
+## Configure the database from the DATABASE section, then create the 
+## tables, but only if they don't exist, in every shard. Every worker 
+## runs this after it started, so no connection is shared across a fork
+def prepare_database() -> None:
+    engines = init_shards(config.get("DATABASE"))
+    with schemaLock:
+        for shard, engine in zip(dbExecutor.shards, engines):
+            shard.session_factory.configure(bind=engine)
+            prepare_shard(engine)
+## size the lineUserId -> UserInfo.id cache
+user_cache.configure(
+    maxsize = config.get("USER_CACHE_SIZE", 4096),
+    ttl_seconds = config.get("USER_CACHE_TTL_SECONDS")
+)
+## size the in-memory set of recent webhook event ids
+recent_events.configure(maxsize = config.get("RECENT_EVENTS_SIZE", 65536))
 ## initialize the manager bot
 seniorBot = SeniorOfficerBot(config)
+## the ingestion queue journals verified webhook bodies, the workers 
+## process them after line has been acknowledged
+ingestionQueue = IngestionQueue(
+    path = config.get("QUEUE_PATH", "./queue.db"),
+    max_attempts = config.get("QUEUE_MAX_ATTEMPTS", 5),
+    lease_seconds = config.get("QUEUE_LEASE_SECONDS", 30),
+    retry_backoff_seconds = config.get("QUEUE_RETRY_BACKOFF_SECONDS", 1.0),
+    max_backoff_seconds = config.get("QUEUE_MAX_BACKOFF_SECONDS", 300)
+)
+## the admission control of /webhook defers the events of a user over 
+## ADMISSION_USER_RATE, and every event while ADMISSION_MAX_READY jobs 
+## are due, null turns either off
+admissionController = AdmissionController(
+    user_rate = config.get("ADMISSION_USER_RATE", 5.0),
+    user_burst = config.get("ADMISSION_USER_BURST", 20),
+    max_ready = config.get("ADMISSION_MAX_READY", 1000),
+    write_latency_target_ms = config.get("ADMISSION_WRITE_LATENCY_TARGET_MS", 50),
+    shed_delay_seconds = config.get("ADMISSION_SHED_DELAY_SECONDS", 2.0),
+    max_delay_seconds = config.get("ADMISSION_MAX_DELAY_SECONDS", 600),
+    ready = lambda: ingestionQueue.run(ingestionQueue.ready)
+)
+## the database executor keeps sqlalchemy work off the event loop, 
+## with DATABASE.SHARDS above 1 it routes every user to its shard and 
+## runs DB_WORKERS threads per shard
+if len(shard_urls(config.get("DATABASE"))) > 1:
+    dbExecutor = ShardedDatabaseExecutor(
+        session_factories = [sessionmaker(autocommit=False, autoflush=False)
+                             for _ in shard_urls(config.get("DATABASE"))],
+        max_workers = config.get("DB_WORKERS", 4)
+    )
+else:
+    dbExecutor = DatabaseExecutor(
+        session_factory = db_session,
+        max_workers = config.get("DB_WORKERS", 4)
+    )
+## one background writer group-commits the message records of every 
+## concurrent request
+recordWriter = GroupCommitWriter(
+    executor = dbExecutor,
+    max_batch_size = config.get("WRITER_MAX_BATCH_SIZE", 256),
+    max_wait_ms = config.get("WRITER_MAX_WAIT_MS", 5)
+)
+## one background dispatcher coalesces the replies, falls back to the 
+## push api and retries the failed calls
+replyDispatcher = ReplyDispatcher(
+    client = seniorBot.http_client,
+    reply_endpoint = seniorBot.reply_endpoint,
+    push_endpoint = seniorBot.push_endpoint,
+    channel_access_token = seniorBot.channel_access_token,
+    reply_ttl_seconds = config.get("REPLY_TOKEN_TTL_SECONDS", 50),
+    max_wait_ms = config.get("REPLY_MAX_WAIT_MS", 5),
+    user_rate = config.get("OUTBOUND_USER_RATE", 1.0),
+    user_burst = config.get("OUTBOUND_USER_BURST", 5),
+    max_attempts = config.get("OUTBOUND_MAX_ATTEMPTS", 4),
+    backoff_seconds = config.get("OUTBOUND_BACKOFF_SECONDS", 1.0),
+    concurrency = config.get("OUTBOUND_CONCURRENCY", 16)
+)
+## the thumbnails, previews and media info of the attachments are 
+## made on a pool of POSTPROCESS_WORKERS processes in every worker 
+## process of the app, 0 turns them off
+postProcessor = PostProcessor(
+    executor = dbExecutor,
+    blob_store = seniorBot.blob_store,
+    workers = config.get("POSTPROCESS_WORKERS", 2),
+    max_pending = config.get("POSTPROCESS_MAX_PENDING"),
+    lease_seconds = config.get("POSTPROCESS_LEASE_SECONDS", 300),
+    poll_seconds = config.get("POSTPROCESS_POLL_SECONDS", 30),
+    thumbnail_size = config.get("THUMBNAIL_SIZE", 256),
+    preview_size = config.get("PREVIEW_SIZE", 1280)
+)
+async def processQueuedPayload(body: bytes, final: bool) -> None:
+    managerBot = ManagerBot(
+        senior = seniorBot,
+        DB = dbExecutor,
+        writer = recordWriter,
+        dispatcher = replyDispatcher,
+        post_processor = postProcessor
+    )
+    managerBot.body = body
+    await managerBot.process_payload(final)
+ingestionWorkers = IngestionWorkers(
+    queue = ingestionQueue,
+    handler = processQueuedPayload,
+    size = config.get("QUEUE_WORKERS", 4)
+)
+## the notes older than RETENTION_DAYS move to the archive, /notes 
+## reads them from there
+noteArchive = NoteArchive(config.get("ARCHIVE_DIR", "./archive"))
+## collect the blobs no message record of any shard uses any more
+async def collectBlobGarbage() -> dict:
+    grace_seconds = config.get("BLOB_GC_GRACE_SECONDS", 3600)
+    results = await dbExecutor.run_all(ReferencedBlobsHandler, grace_seconds = grace_seconds)
+    keep = set().union(*[referenced for _, referenced in results])
+    removed = await asyncio.to_thread(seniorBot.blob_store.remove_unreferenced, keep, grace_seconds)
+    return {"removed_rows": sum(removed_rows for removed_rows, _ in results), "removed_files": removed}
+## forget the webhook event ids line won't redeliver, they are kept 
+## in shard 0
+async def pruneProcessedEvents() -> dict:
+    removed = await dbExecutor.shards[0].run(
+        PruneProcessedEventsHandler,
+        older_than = datetime.now() - timedelta(
+            days = config.get("PROCESSED_EVENTS_TTL_DAYS", 7))
+    )
+    return {"removed": removed}
+## archive the old notes chunk by chunk, every chunk is its own short 
+## transaction and the writers get the database between two of them
+async def archiveOldNotes() -> dict:
+    chunk_size = config.get("RETENTION_CHUNK_SIZE", 500)
+    older_than = datetime.now() - timedelta(days = config.get("RETENTION_DAYS"))
+    archived = 0
+    for shard in dbExecutor.shards:
+        for _ in range(config.get("RETENTION_MAX_CHUNKS", 200)):
+            report = await shard.run(
+                ArchiveNotesHandler,
+                archive = noteArchive,
+                older_than = older_than,
+                chunk_size = chunk_size
+            )
+            archived += report["archived"]
+            if report["archived"] < chunk_size:
+                break
+            await asyncio.sleep(config.get("RETENTION_CHUNK_PAUSE_SECONDS", 0.05))
+    return {"archived": archived}
+## give the free pages back and refresh the query planner statistics
+async def compactDatabase() -> dict:
+    reports = []
+    for shard in dbExecutor.shards:
+        reports.append(await shard.run(
+            CompactDatabaseHandler,
+            step_pages = config.get("COMPACTION_STEP_PAGES", 1000),
+            convert = config.get("COMPACTION_FULL_VACUUM", False)
+        ))
+    return reports[0] if len(reports) == 1 else {"shards": reports}
+maintenanceScheduler = MaintenanceScheduler(maintenanceLock)
+maintenanceScheduler.add(
+    "blob_gc", config.get("BLOB_GC_INTERVAL_SECONDS", 3600), collectBlobGarbage)
+maintenanceScheduler.add(
+    "processed_events", config.get("PROCESSED_EVENTS_PRUNE_INTERVAL_SECONDS", 3600), pruneProcessedEvents)
+if config.get("RETENTION_DAYS") is not None:
+    maintenanceScheduler.add(
+        "retention", config.get("RETENTION_INTERVAL_SECONDS", 3600), archiveOldNotes)
+maintenanceScheduler.add(
+    "compaction", config.get("COMPACTION_INTERVAL_SECONDS", 86400), compactDatabase)
+## start the workers with the app, pending jobs of a previous run are 
+## picked up right away
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    start_logging(config.get("LOG_LEVEL", "INFO"))
+    prepare_database()
+    ingestionQueue.open()
+    INGESTION_DEPTH.set_function(lambda: ingestionQueue.stats()["depth"])
+    await seniorBot.http_client.start()
+    recordWriter.start()
+    replyDispatcher.start()
+    ingestionWorkers.start()
+    postProcessor.start()
+    maintenanceScheduler.start()
+    yield
+    await maintenanceScheduler.stop()
+    await ingestionWorkers.stop()
+    await postProcessor.stop()
+    await recordWriter.stop()
+    await replyDispatcher.stop()
+    ingestionQueue.close()
+    dbExecutor.shutdown()
+    await seniorBot.http_client.close()
+    stop_logging()
 ## Create a FastAPI instance
-app = FastAPI()
+app = FastAPI(lifespan = lifespan)
+## count the requests being served for the in-flight gauge, a plain 
+## asgi middleware so the request body is not buffered twice
+class InFlightMiddleware:
+    def __init__(self, app) -> None:
+        self.app = app
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        HTTP_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            HTTP_IN_FLIGHT.dec()
+app.add_middleware(InFlightMiddleware)
 ## place liff webpage here
 
 ## Define the webhook endpoint
 @app.post("/webhook", status_code = status.HTTP_200_OK)
-async def handleInboundMessage(request: Request, db: db_driver):
+async def handleInboundMessage(request: Request):
     ## initialize the manager bot
     managerBot = ManagerBot(
         senior = seniorBot,
-        DB = db
+        DB = None
     )
     ## call manager bot to validate the x-line-signature
-    ok = managerBot.validate_signature(request)
+    ok = await managerBot.validate_signature(request)
     if not ok:
         raise HTTPException(status_code=400, detail="Invalid signature")
-    ## call clerk bot to process the inbound request string
-    clerkBot = ClerkBot(manager = managerBot)
-    ok, msg = clerkBot.getMessage()
-    if not ok:
-        managerBot.report_error(msg)
-        
+    ## journal the verified body and acknowledge line at once, the 
+    ## ingestion workers dispatch every event of the batch. The events 
+    ## the admission control defers are journaled with their delay, a 
+    ## body no attempt could process is journaled dead at once
+    await admissionController.refresh()
+    for body, delay, dead in admissionController.plan(managerBot.body):
+        if dead:
+            await ingestionQueue.run(ingestionQueue.bury, body)
+        else:
+            await ingestionQueue.run(ingestionQueue.enqueue, body, delay_seconds = delay)
+
+## the endpoints reading the notes of one user take the lineUserId of 
+## a link the bot replied with, signed with the channel secret and 
+## expiring, so a user only reads their own notes
+def verifyUserLink(lineUserId: str, expires: int, signature: str) -> str:
+    if not verify_export_link(seniorBot.channel_secret, lineUserId, expires, signature):
+        raise HTTPException(status_code=403, detail="Invalid or expired link")
+    return lineUserId
+signed_user = Annotated[str, Depends(verifyUserLink)]
+
+## full-text search over the notes of one user
+@app.get("/search", status_code = status.HTTP_200_OK)
+async def searchNotes(lineUserId: signed_user, q: str, page: int = 1, page_size: int = 10):
+    if page_size < 1 or page_size > 100:
+        raise HTTPException(status_code=400, detail="page_size must be between 1 and 100")
+    return await dbExecutor.run(
+        SearchNotesHandler,
+        line_user_id = lineUserId,
+        query = q,
+        page = page,
+        page_size = page_size
+    )
+
+## the notes of one user newest-first, pass next_cursor back to get 
+## the following page
+@app.get("/notes", status_code = status.HTTP_200_OK)
+async def getNotes(
+        lineUserId: signed_user,
+        cursor: Optional[str] = None,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+        limit: int = 20
+        ):
+    if limit < 1 or limit > 200:
+        raise HTTPException(status_code=400, detail="limit must be between 1 and 200")
+    try:
+        return await dbExecutor.run(
+            NotesHistoryHandler,
+            line_user_id = lineUserId,
+            cursor = cursor,
+            since = since,
+            until = until,
+            limit = limit,
+            archive = noteArchive,
+            blob_store = seniorBot.blob_store
+        )
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+## the tags of one user with their note counts, the most used first
+@app.get("/tags", status_code = status.HTTP_200_OK)
+async def getTags(lineUserId: signed_user, limit: int = 100):
+    if limit < 1 or limit > 1000:
+        raise HTTPException(status_code=400, detail="limit must be between 1 and 1000")
+    return await dbExecutor.run(
+        UserTagsHandler,
+        line_user_id = lineUserId,
+        limit = limit
+    )
+
+## the notes of one user carrying a tag newest-first
+@app.get("/tags/{tag}", status_code = status.HTTP_200_OK)
+async def getTagNotes(tag: str, lineUserId: signed_user, limit: int = 20):
+    if limit < 1 or limit > 200:
+        raise HTTPException(status_code=400, detail="limit must be between 1 and 200")
+    return await dbExecutor.run(
+        TagNotesHandler,
+        line_user_id = lineUserId,
+        tag = tag_query(f"#{tag.lstrip('#')}") or tag,
+        limit = limit
+    )
+
+## every note of one user with the attachments, streamed as a zip or 
+## as json lines. The link comes from the /export command and is 
+## signed with the channel secret
+@app.get("/export", status_code = status.HTTP_200_OK)
+async def exportNotes(lineUserId: signed_user, format: str = "zip"):
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail="format must be zip or ndjson")
+    return StreamingResponse(
+        dbExecutor.stream(
+            ExportNotesHandler,
+            line_user_id = lineUserId,
+            archive = noteArchive,
+            format = format,
+            chunk_size = config.get("EXPORT_CHUNK_SIZE", 65536),
+            yield_per = config.get("EXPORT_YIELD_PER", 500)
+        ),
+        media_type = EXPORT_FORMATS[format],
+        headers = {"Content-Disposition": f'attachment; filename="notes.{format}"'}
+    )
+
+## queue depth and lag, user cache hits and misses for monitoring
+@app.get("/stats", status_code = status.HTTP_200_OK)
+async def getStats():
+    return {
+        "queue": await ingestionQueue.run(ingestionQueue.stats),
+        "user_cache": user_cache.stats(),
+        "recent_events": recent_events.stats(),
+        "admission": admissionController.stats(),
+        "outbound": replyDispatcher.stats(),
+        "postprocess": postProcessor.stats()
+    }
+
+## the metrics of this worker process in the prometheus text format
+@app.get("/metrics", response_class = PlainTextResponse)
+async def getMetrics():
+    ## the queue depth gauge reads the journal, rendered off the loop
+    return PlainTextResponse(
+        await asyncio.to_thread(render_metrics), media_type = "text/plain; version=0.0.4; charset=utf-8")
 
+## python main.py runs one reloading process for development, 
+## python main.py --workers N runs N worker processes on uvloop and 
+## httptools. The workers share data.db and queue.db, both in WAL 
+## mode with a busy timeout, so their writes queue up instead of failing
 if __name__ == "__main__":
-  uvicorn.run(
-      "main:app",
-      host="0.0.0.0",
-      port=8080,
-      log_level="info",
-      reload=True
-  )
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=config.get("WORKERS"))
+    parser.add_argument("--host", default=config.get("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=config.get("PORT", 8080))
+    args = parser.parse_args()
+    if args.workers is None:
+        uvicorn.run(
+            "main:app",
+            host=args.host,
+            port=args.port,
+            log_level="info",
+            reload=True
+        )
+    else:
+        os.environ["APP_CONFIG"] = orjson.dumps(config).decode()
+        uvicorn.run(
+            "main:app",
+            host=args.host,
+            port=args.port,
+            log_level="info",
+            workers=args.workers,
+            loop="uvloop",
+            http="httptools"
+        )
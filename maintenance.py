@@ -0,0 +1,57 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, List
+from coordination import FileLock
+
+logger = logging.getLogger(__name__)
+
+@dataclass(slots=True)
+class MaintenanceJob:
+    name: str
+    interval_seconds: float
+    run: Callable[[], Awaitable[Any]]
+    due_at: float = 0.0
+
+## the maintenance scheduler runs every job on its own interval, one
+## job at a time. Only the worker process holding the maintenance lock
+## runs them, another one takes over when it stops
+class MaintenanceScheduler:
+    def __init__(self, lock: FileLock) -> None:
+        self.lock = lock
+        self.jobs: List[MaintenanceJob] = []
+        self.task: asyncio.Task = None
+    ## the first run of a job is one interval after the start
+    def add(self, name: str, interval_seconds: float, run: Callable[[], Awaitable[Any]]) -> None:
+        self.jobs.append(MaintenanceJob(name, interval_seconds, run))
+    def start(self) -> None:
+        now = time.monotonic()
+        for job in self.jobs:
+            job.due_at = now + job.interval_seconds
+        self.task = asyncio.create_task(self.__run())
+    async def stop(self) -> None:
+        if self.task is None:
+            return
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+        self.task = None
+        self.lock.release()
+    async def __run(self) -> None:
+        while len(self.jobs) > 0:
+            job = min(self.jobs, key=lambda job: job.due_at)
+            await asyncio.sleep(max(0.0, job.due_at - time.monotonic()))
+            job.due_at = time.monotonic() + job.interval_seconds
+            if not self.lock.acquire(blocking = False):
+                continue
+            start = time.perf_counter()
+            try:
+                report = await job.run()
+            except Exception as e:
+                logger.exception("maintenance error", extra={"job": job.name, "error": str(e)})
+                continue
+            logger.info("maintenance", extra={
+                "job": job.name,
+                "seconds": round(time.perf_counter() - start, 3),
+                "report": report,
+            })
@@ -0,0 +1,257 @@
+import bisect
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+## the metrics of one process in the prometheus text format, served by
+## /metrics. An update is a lock and a few additions, so the hot path
+## pays well under a microsecond per call. Every worker process of the
+## launcher keeps its own, scrape them one by one or sum them. See
+## PrometheusExpositionDocument: https://prometheus.io/docs/instrumenting/
+## exposition_formats/
+DEFAULT_BUCKETS: Tuple[float, ...] = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+    0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra != "":
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if len(pairs) > 0 else ""
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+## a metric family holds one child per combination of label values,
+## keep the child of a hot path in a variable instead of looking it up
+class _Metric:
+    TYPE = ""
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.children: Dict[Tuple[str, ...], object] = {}
+        ## a metric without labels has a single child, it reports 0
+        ## before its first update
+        self.default = self.labels() if len(self.labelnames) == 0 else None
+        REGISTRY.register(self)
+    def _new_child(self) -> object:
+        raise NotImplementedError
+    def labels(self, **labels: str) -> object:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        child = self.children.get(key)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(key, self._new_child())
+        return child
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.TYPE}",
+        ]
+        lines.extend(self._samples())
+        return lines
+
+class _CounterChild:
+    __slots__ = ("lock", "value")
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.value = 0
+    def inc(self, amount: float = 1) -> None:
+        with self.lock:
+            self.value += amount
+
+class Counter(_Metric):
+    TYPE = "counter"
+    def _new_child(self) -> _CounterChild:
+        return _CounterChild()
+    def inc(self, amount: float = 1) -> None:
+        self.default.inc(amount)
+    def _samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(child.value)}"
+                for key, child in list(self.children.items())]
+
+class _GaugeChild:
+    __slots__ = ("lock", "value", "function")
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.value = 0
+        self.function: Optional[Callable[[], float]] = None
+    def inc(self, amount: float = 1) -> None:
+        with self.lock:
+            self.value += amount
+    def dec(self, amount: float = 1) -> None:
+        with self.lock:
+            self.value -= amount
+    def set(self, value: float) -> None:
+        self.value = value
+    ## read the value from function when the metrics are rendered
+    def set_function(self, function: Callable[[], float]) -> None:
+        self.function = function
+    def get(self) -> float:
+        if self.function is not None:
+            try:
+                return self.function()
+            except Exception:
+                return float("nan")
+        return self.value
+
+class Gauge(_Metric):
+    TYPE = "gauge"
+    def _new_child(self) -> _GaugeChild:
+        return _GaugeChild()
+    def inc(self, amount: float = 1) -> None:
+        self.default.inc(amount)
+    def dec(self, amount: float = 1) -> None:
+        self.default.dec(amount)
+    def set(self, value: float) -> None:
+        self.default.set(value)
+    def set_function(self, function: Callable[[], float]) -> None:
+        self.default.set_function(function)
+    def _samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(child.get())}"
+                for key, child in list(self.children.items())]
+
+## time a block into a histogram: with STAGE.time(): ...
+class _Timer:
+    __slots__ = ("child", "start")
+    def __init__(self, child: "_HistogramChild") -> None:
+        self.child = child
+    def __enter__(self) -> "_Timer":
+        self.start = time.perf_counter()
+        return self
+    def __exit__(self, *exc_info) -> None:
+        self.child.observe(time.perf_counter() - self.start)
+
+class _HistogramChild:
+    __slots__ = ("lock", "bounds", "counts", "sum", "count")
+    def __init__(self, bounds: Tuple[float, ...]) -> None:
+        self.lock = threading.Lock()
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+    def time(self) -> _Timer:
+        return _Timer(self)
+
+class Histogram(_Metric):
+    TYPE = "histogram"
+    def __init__(
+            self,
+            name: str,
+            documentation: str,
+            labelnames: Tuple[str, ...] = (),
+            buckets: Tuple[float, ...] = DEFAULT_BUCKETS
+            ) -> None:
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+    def _new_child(self) -> _HistogramChild:
+        return _HistogramChild(self.buckets)
+    def observe(self, value: float) -> None:
+        self.default.observe(value)
+    def time(self) -> _Timer:
+        return self.default.time()
+    def _samples(self) -> List[str]:
+        lines = []
+        for key, child in list(self.children.items()):
+            with child.lock:
+                counts = list(child.counts)
+                total, count = child.sum, child.count
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket
+                le = f'le="{_format_value(float(bound))}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics: List[_Metric] = []
+    def register(self, metric: _Metric) -> None:
+        self.metrics.append(metric)
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+## the metrics of the webhook pipeline
+STAGE_SECONDS = Histogram(
+    "pipeline_stage_seconds",
+    "Time spent in each stage of the webhook pipeline.",
+    ("stage",))
+SIGNATURE_STAGE = STAGE_SECONDS.labels(stage="signature")
+PARSE_STAGE = STAGE_SECONDS.labels(stage="parse")
+USER_LOOKUP_STAGE = STAGE_SECONDS.labels(stage="user_lookup")
+DB_WRITE_STAGE = STAGE_SECONDS.labels(stage="db_write")
+REPLY_STAGE = STAGE_SECONDS.labels(stage="reply")
+CONTENT_FETCH_STAGE = STAGE_SECONDS.labels(stage="content_fetch")
+PUSH_STAGE = STAGE_SECONDS.labels(stage="push")
+POSTPROCESS_STAGE = STAGE_SECONDS.labels(stage="postprocess")
+MESSAGES_RECEIVED = Counter(
+    "messages_received_total",
+    "Webhook message events received, by message type.",
+    ("type",))
+MESSAGE_OUTCOMES = Counter(
+    "message_outcomes_total",
+    "Messages handled by the database, by ProcessMessage outcome.",
+    ("outcome",))
+OUTBOUND_CALLS = Counter(
+    "outbound_calls_total",
+    "Reply and push calls by api and result: ok, fallback, retry, unconfirmed or dropped.",
+    ("api", "result"))
+ADMISSION_DECISIONS = Counter(
+    "admission_decisions_total",
+    "Webhook events by admission decision: admitted, user_rate or overload.",
+    ("decision",))
+ATTACHMENTS_PROCESSED = Counter(
+    "attachments_processed_total",
+    "Attachments post-processed, by status: done or failed.",
+    ("status",))
+HTTP_IN_FLIGHT = Gauge(
+    "http_requests_in_flight",
+    "HTTP requests being served.")
+DB_IN_FLIGHT = Gauge(
+    "db_executor_in_flight",
+    "Database calls queued or running on the database executor.")
+DB_POOL_CHECKED_OUT = Gauge(
+    "db_pool_checked_out",
+    "Connections checked out of the database engine pool.")
+LINE_API_IN_FLIGHT = Gauge(
+    "line_api_requests_in_flight",
+    "Requests to the line api being sent or read.")
+INGESTION_BUSY = Gauge(
+    "ingestion_workers_busy",
+    "Ingestion workers processing a job.")
+POSTPROCESS_IN_FLIGHT = Gauge(
+    "postprocess_in_flight",
+    "Attachments handed to the post-processing pool and not recorded yet.")
+ADMISSION_SCALE = Gauge(
+    "admission_scale",
+    "Share of the per-user event rate admitted, lowered while database writes are slow.")
+INGESTION_DEPTH = Gauge(
+    "ingestion_queue_depth",
+    "Jobs waiting in the ingestion queue.")
+
+def render() -> str:
+    return REGISTRY.render()
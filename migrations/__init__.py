@@ -0,0 +1,58 @@
+import importlib
+import pkgutil
+from types import ModuleType
+from typing import List
+from sqlalchemy import Column, MetaData, String, Table, select
+from sqlalchemy.engine import Engine
+
+## alembic-style migrations for data.db files created by earlier 
+## versions: every module in migrations/versions has a revision, a 
+## down_revision and upgrade/downgrade functions taking a connection. 
+## The applied revisions are kept in the schema_migrations table
+schema_migrations = Table(
+    "schema_migrations", MetaData(),
+    Column("revision", String, primary_key=True),
+)
+
+## the revisions in order, following the down_revision chain
+def load_revisions() -> List[ModuleType]:
+    from migrations import versions
+    modules = {}
+    for info in pkgutil.iter_modules(versions.__path__):
+        module = importlib.import_module(f"migrations.versions.{info.name}")
+        modules[module.down_revision] = module
+    ordered = []
+    down_revision = None
+    while down_revision in modules:
+        module = modules[down_revision]
+        ordered.append(module)
+        down_revision = module.revision
+    return ordered
+
+## apply the revisions not applied yet, each one in its own transaction
+def run_migrations(engine: Engine) -> List[str]:
+    schema_migrations.create(bind=engine, checkfirst=True)
+    with engine.connect() as connection:
+        applied = set(connection.execute(select(schema_migrations.c.revision)).scalars())
+    upgraded = []
+    for module in load_revisions():
+        if module.revision in applied:
+            continue
+        with engine.begin() as connection:
+            module.upgrade(connection)
+            connection.execute(schema_migrations.insert().values(revision=module.revision))
+        upgraded.append(module.revision)
+    return upgraded
+
+## revert the latest applied revision
+def downgrade_last(engine: Engine) -> str:
+    with engine.connect() as connection:
+        applied = set(connection.execute(select(schema_migrations.c.revision)).scalars())
+    for module in reversed(load_revisions()):
+        if module.revision in applied:
+            with engine.begin() as connection:
+                module.downgrade(connection)
+                connection.execute(schema_migrations.delete().where(
+                    schema_migrations.c.revision == module.revision))
+            return module.revision
+    return None
@@ -0,0 +1,18 @@
+## add the composite (userInfo_id, timestamp, id) index the keyset 
+## pagination of the note history reads along
+from sqlalchemy import Index
+from sqlalchemy.engine import Connection
+from rules import MessageRecords
+
+revision = "0001"
+down_revision = None
+
+def history_index() -> Index:
+    return next(index for index in MessageRecords.__table__.indexes
+                if index.name == "ix_message_records_user_timestamp_id")
+
+def upgrade(connection: Connection) -> None:
+    history_index().create(bind=connection, checkfirst=True)
+
+def downgrade(connection: Connection) -> None:
+    history_index().drop(bind=connection, checkfirst=True)
@@ -0,0 +1,32 @@
+## add the post-processing columns of message_records, the attachments 
+## already stored are marked pending so the post processor catches up
+from sqlalchemy import inspect, update
+from sqlalchemy.engine import Connection
+from rules import MessageRecords
+
+revision = "0002"
+down_revision = "0001"
+
+COLUMNS = ("media_status", "media_info", "thumbnail_path", "preview_path",
+           "media_claimed_by", "media_claimed_at")
+
+def media_status_index():
+    return next(index for index in MessageRecords.__table__.indexes
+                if index.name == "ix_message_records_media_status")
+
+def upgrade(connection: Connection) -> None:
+    existing = {column["name"] for column in inspect(connection).get_columns("message_records")}
+    for name in COLUMNS:
+        if name not in existing:
+            column_type = MessageRecords.__table__.c[name].type.compile(dialect=connection.dialect)
+            connection.exec_driver_sql(f"ALTER TABLE message_records ADD COLUMN {name} {column_type}")
+    media_status_index().create(bind=connection, checkfirst=True)
+    connection.execute(
+        update(MessageRecords)
+        .where(MessageRecords.filepath.is_not(None), MessageRecords.media_status.is_(None))
+        .values(media_status="pending"))
+
+def downgrade(connection: Connection) -> None:
+    media_status_index().drop(bind=connection, checkfirst=True)
+    for name in COLUMNS:
+        connection.exec_driver_sql(f"ALTER TABLE message_records DROP COLUMN {name}")
@@ -0,0 +1,40 @@
+## add the tag index: the tags, note_tags and user_tags tables, filled 
+## from the notes already in message_records chunk by chunk
+from sqlalchemy import or_, select
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session
+from handlers import index_note_tags
+from rules import MessageRecords, NoteTags, Tags, UserTags
+from tags import extract_tags
+
+revision = "0003"
+down_revision = "0002"
+
+CHUNK_SIZE = 2000
+TABLES = (Tags.__table__, NoteTags.__table__, UserTags.__table__)
+
+def upgrade(connection: Connection) -> None:
+    for table in TABLES:
+        table.create(bind=connection, checkfirst=True)
+    db = Session(bind=connection)
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            select(MessageRecords.id, MessageRecords.userInfo_id, MessageRecords.timestamp,
+                   MessageRecords.message)
+            .where(MessageRecords.id > last_id,
+                   or_(MessageRecords.message.contains("#"), MessageRecords.message.contains("＃")))
+            .order_by(MessageRecords.id)
+            .limit(CHUNK_SIZE)
+        ).all()
+        if len(rows) == 0:
+            break
+        last_id = rows[-1].id
+        notes = [(row.id, row.userInfo_id, row.timestamp, extract_tags(row.message))
+                 for row in rows if row.timestamp is not None and row.userInfo_id is not None]
+        index_note_tags(db, [note for note in notes if len(note[3]) > 0])
+    db.close()
+
+def downgrade(connection: Connection) -> None:
+    for table in reversed(TABLES):
+        table.drop(bind=connection, checkfirst=True)
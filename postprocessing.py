@@ -0,0 +1,178 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import socket
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, List, Set, Tuple
+from attachments import inspect_attachment
+from blobstore import BlobStore
+from database import DatabaseExecutor
+from handlers import ClaimAttachmentsHandler, RecordAttachmentHandler, ReleaseAttachmentsHandler
+from metrics import ATTACHMENTS_PROCESSED, POSTPROCESS_IN_FLIGHT, POSTPROCESS_STAGE
+
+logger = logging.getLogger(__name__)
+
+## the post processor makes the thumbnails, previews and media info of
+## the stored attachments on a pool of worker processes, away from the
+## event loop and its GIL. The pending attachments wait in
+## message_records: it claims only as many as the pool has room for,
+## so a busy pool leaves them there instead of queueing in memory, and
+## the ingestion never waits for it. A worker gets the path of the blob
+## and writes the variants itself, no content is pickled. The storage
+## bot notifies it after a write, and it polls for the attachments of
+## other processes and of earlier runs. The shards of a sharded
+## executor are claimed from in turn, starting one further every time
+class PostProcessor:
+    def __init__(
+            self,
+            executor: DatabaseExecutor,
+            blob_store: BlobStore,
+            workers: int = 2,
+            max_pending: int = None,
+            lease_seconds: float = 300.0,
+            poll_seconds: float = 30.0,
+            thumbnail_size: int = 256,
+            preview_size: int = 1280
+            ) -> None:
+        self.executor = executor
+        self.blob_store = blob_store
+        self.workers = workers
+        ## a job waiting in the pool for every worker keeps it busy
+        self.max_pending = max_pending or workers * 2
+        self.lease_seconds = lease_seconds
+        self.poll_seconds = poll_seconds
+        self.thumbnail_size = thumbnail_size
+        self.preview_size = preview_size
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.pool: ProcessPoolExecutor = None
+        self.task: asyncio.Task = None
+        self.wakeup: asyncio.Event = None
+        self.running: Set[asyncio.Task] = set()
+        self.next_shard = 0
+        self.processed = 0
+        self.failed = 0
+    ## the workers are spawned, not forked, so they don't inherit the
+    ## threads and connections of the app
+    def __new_pool(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(
+            max_workers = self.workers,
+            mp_context = multiprocessing.get_context("spawn")
+        )
+    def start(self) -> None:
+        if self.workers <= 0:
+            return
+        self.pool = self.__new_pool()
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.create_task(self.__run())
+    async def stop(self) -> None:
+        if self.task is None:
+            return
+        self.task.cancel()
+        for task in list(self.running):
+            task.cancel()
+        await asyncio.gather(self.task, *self.running, return_exceptions=True)
+        self.task = None
+        self.pool.shutdown(wait=True, cancel_futures=True)
+        await self.executor.run_all(ReleaseAttachmentsHandler, owner = self.owner)
+    ## new attachments were stored
+    def notify(self) -> None:
+        if self.wakeup is not None:
+            self.wakeup.set()
+    ## claim up to room attachments from the shards in turn, as 
+    ## (shard, id, filepath)
+    async def __claim(self, room: int) -> List[Tuple[DatabaseExecutor, int, str]]:
+        shards = self.executor.shards
+        self.next_shard = (self.next_shard + 1) % len(shards)
+        claimed = []
+        for index in range(len(shards)):
+            if len(claimed) >= room:
+                break
+            shard = shards[(self.next_shard + index) % len(shards)]
+            try:
+                rows = await shard.run(
+                    ClaimAttachmentsHandler,
+                    owner = self.owner,
+                    limit = room - len(claimed),
+                    lease_seconds = self.lease_seconds
+                )
+            except Exception as e:
+                logger.error("postprocess claim error", extra={"error": str(e)})
+                continue
+            claimed.extend((shard, record_id, filepath) for record_id, filepath in rows)
+        return claimed
+    async def __run(self) -> None:
+        while True:
+            self.wakeup.clear()
+            room = self.max_pending - len(self.running)
+            claimed = []
+            if room > 0:
+                claimed = await self.__claim(room)
+                for shard, record_id, filepath in claimed:
+                    task = asyncio.create_task(self.__process(shard, record_id, filepath))
+                    self.running.add(task)
+                    task.add_done_callback(self.running.discard)
+            if len(self.running) >= self.max_pending:
+                ## the pool is full, claim again once a job is done
+                await asyncio.wait(list(self.running), return_when=asyncio.FIRST_COMPLETED)
+            elif len(claimed) < room:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), self.poll_seconds)
+                except asyncio.TimeoutError:
+                    pass
+    ## a worker that dies breaks the pool and every job in it, the 
+    ## first job to notice replaces the pool and each of them is tried 
+    ## once more, so only the attachment killing its worker twice fails
+    async def __inspect(self, filepath: str) -> Dict[str, Any]:
+        loop = asyncio.get_running_loop()
+        for attempt in range(2):
+            pool = self.pool
+            try:
+                return await loop.run_in_executor(
+                    pool, inspect_attachment, filepath,
+                    self.blob_store.variants_dir(filepath),
+                    self.thumbnail_size, self.preview_size)
+            except BrokenProcessPool:
+                if self.pool is pool:
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    self.pool = self.__new_pool()
+                if attempt == 1:
+                    raise
+    async def __process(self, shard: DatabaseExecutor, record_id: int, filepath: str) -> None:
+        status = "done"
+        POSTPROCESS_IN_FLIGHT.inc()
+        try:
+            with POSTPROCESS_STAGE.time():
+                result: Dict[str, Any] = await self.__inspect(filepath)
+        except BrokenProcessPool:
+            logger.error("postprocess worker died", extra={"id": record_id})
+            status, result = "failed", {"info": {"error": "worker died"}}
+        except Exception as e:
+            logger.warning("postprocess error", extra={"id": record_id, "error": str(e)})
+            status, result = "failed", {"info": {"error": str(e)}}
+        finally:
+            POSTPROCESS_IN_FLIGHT.dec()
+        ATTACHMENTS_PROCESSED.labels(status=status).inc()
+        if status == "done":
+            self.processed += 1
+        else:
+            self.failed += 1
+        try:
+            await shard.run(
+                RecordAttachmentHandler,
+                record_id = record_id,
+                owner = self.owner,
+                status = status,
+                result = result
+            )
+        except Exception as e:
+            logger.error("postprocess record error", extra={"id": record_id, "error": str(e)})
+    def stats(self) -> Dict[str, int]:
+        return {
+            "workers": self.workers,
+            "running": len(self.running),
+            "processed": self.processed,
+            "failed": self.failed,
+        }
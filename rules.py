@@ -1,7 +1,11 @@
+from dataclasses import dataclass, field
 from datetime import datetime
+import time
 from enum import Enum
+from typing import Any, Dict, Optional
 from database import Base
-from sqlalchemy import Column, DateTime, ForeignKey, Integer, String, Boolean
+from caches import user_cache
+from sqlalchemy import Column, DateTime, ForeignKey, Index, Integer, String, Boolean, event
 
 ## the model that write in database user_info
 class UserInfo(Base):
@@ -12,6 +16,14 @@ class UserInfo(Base):
     hashed_password = Column(String, nullable=True)
     is_active = Column(Boolean, default=True)
 
+## drop the cached id of a user whose is_active flag changes, bulk 
+## UPDATE statements bypass this event and have to invalidate the 
+## user cache themselves
+@event.listens_for(UserInfo.is_active, "set")
+def invalidate_cached_user(target: UserInfo, value, oldvalue, initiator) -> None:
+    if value != oldvalue and target.lineUserId is not None:
+        user_cache.invalidate(target.lineUserId)
+
 ## the model that write in database message_records
 class MessageRecords(Base):
     __tablename__ = "message_records"
@@ -22,6 +34,64 @@ class MessageRecords(Base):
     filename = Column(String, nullable=True)
     filepath = Column(String, nullable=True)
     timestamp = Column(DateTime, nullable=True)
+    ## the post-processing of an attachment: pending until the post 
+    ## processor stored its variants and media_info (json), then done 
+    ## or failed. A claim is taken over once its lease ran out
+    media_status = Column(String, nullable=True, index=True)
+    media_info = Column(String, nullable=True)
+    thumbnail_path = Column(String, nullable=True)
+    preview_path = Column(String, nullable=True)
+    media_claimed_by = Column(String, nullable=True)
+    media_claimed_at = Column(DateTime, nullable=True)
+    ## the note history pages along this index newest-first
+    __table_args__ = (
+        Index("ix_message_records_user_timestamp_id", "userInfo_id", "timestamp", "id"),
+    )
+
+## the models of the #tags: tags holds every tag once, note_tags is the
+## inverted index from a tag to the notes of a user carrying it, newest
+## first along its primary key, and user_tags keeps the number of notes
+## per user and tag, counted up and down with the notes. Listing the
+## tags of a user reads user_tags only, whatever the number of notes
+class Tags(Base):
+    __tablename__ = "tags"
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String, unique=True, index=True)
+
+class NoteTags(Base):
+    __tablename__ = "note_tags"
+    userInfo_id = Column(Integer, ForeignKey("user_info.id"), primary_key=True)
+    tag_id = Column(Integer, ForeignKey("tags.id"), primary_key=True)
+    timestamp = Column(DateTime, primary_key=True)
+    note_id = Column(Integer, ForeignKey("message_records.id"), primary_key=True)
+    ## the tags of a note, for taking it out of the index
+    __table_args__ = (
+        Index("ix_note_tags_note_id", "note_id"),
+    )
+
+class UserTags(Base):
+    __tablename__ = "user_tags"
+    userInfo_id = Column(Integer, ForeignKey("user_info.id"), primary_key=True)
+    tag_id = Column(Integer, ForeignKey("tags.id"), primary_key=True)
+    note_count = Column(Integer, default=0)
+
+## the model that write in database blobs, one row per stored 
+## attachment content, refcount counts the message records using it
+class Blobs(Base):
+    __tablename__ = "blobs"
+    sha256 = Column(String, primary_key=True)
+    size = Column(Integer)
+    refcount = Column(Integer, default=0, index=True)
+    created_at = Column(DateTime, default=datetime.now)
+
+## the model that write in database processed_events, the webhook 
+## event ids already processed, so a redelivered event is not stored 
+## and answered twice
+class ProcessedEvents(Base):
+    __tablename__ = "processed_events"
+    id = Column(Integer, primary_key=True, index=True)
+    webhookEventId = Column(String, unique=True, index=True)
+    processed_at = Column(DateTime, default=datetime.now, index=True)
 
 class ProcessMessage(Enum):
     ALL_OK = "all is well"
@@ -33,10 +103,11 @@ class ProcessMessage(Enum):
     DATABASE_DELETE_ERROR = "deleting from database failed"
     DATABASE_CONNECTION_ERROR = "database connection failed"
 
+## the outcome of a database handler
+@dataclass(frozen=True, slots=True)
 class HandleStatus:
-    def __init__(self, success: bool, msg: ProcessMessage):
-        self.success = success
-        self.msg = msg
+    success: bool
+    msg: ProcessMessage
 
 ## enum MessageType for validation of message type in inbound 
 ## payload
@@ -47,39 +118,85 @@ class MessageType(Enum):
     AUDIO = "audio"
     FILE = "file"
 
+## the payload's message type string to MessageType, built once so an 
+## event costs one dict lookup
+MESSAGE_TYPES: Dict[str, MessageType] = {
+    msg_type.value: msg_type for msg_type in MessageType if msg_type.value is not None
+}
+
+## WebhookEvent holds the fields of one event of the inbound payload 
+## the bots use, read straight from the decoded json. See 
+## WebhookEventDocument: https://developers.line.biz/en/reference/
+## messaging-api/#message-event
+@dataclass(slots=True)
+class WebhookEvent:
+    event_id: Optional[str]
+    event_type: Optional[str]
+    reply_token: str
+    timestamp: Optional[int]
+    line_user_id: Optional[str]
+    is_redelivery: bool
+    message_id: Optional[str]
+    message_type: Optional[str]
+    text: Optional[str]
+    file_name: Optional[str]
+    @classmethod
+    def from_dict(cls, event: Dict[str, Any]) -> "WebhookEvent":
+        source = event.get("source") or {}
+        delivery = event.get("deliveryContext") or {}
+        message = event.get("message") or {}
+        return cls(
+            event_id = event.get("webhookEventId"),
+            event_type = event.get("type"),
+            reply_token = event.get("replyToken") or "",
+            timestamp = event.get("timestamp"),
+            line_user_id = source.get("userId"),
+            is_redelivery = bool(delivery.get("isRedelivery")),
+            message_id = message.get("id"),
+            message_type = message.get("type"),
+            text = message.get("text"),
+            file_name = message.get("fileName")
+        )
+
 ## Message class holds the message content for process, because 
 ## the image/audio/file message need to be fetch from the line 
 ## data endpoint. See FetchDataDocument: https://developers.line.
 ## biz/en/reference/messaging-api/#get-content
+@dataclass(slots=True)
 class Message:
-    def __init__(self,
-                 msg_id: str = None, 
-                 msg_type: MessageType = MessageType.NULL, 
-                 msg_text: str = None, 
-                 msg_filename: str = None,
-                 msg_reply_token: str = "",
-                 msg_timestamp: datetime = datetime.now(),
-                 owner_id: str = None,
-                 error_description: str = None,
-                 ) -> None:
-        if msg_id is None:
-            print("message initialize error, please verify.")
-            raise ValueError
-        self.msg_id = msg_id
-        self.msg_type = msg_type
-        if msg_text is None:
-            msg_text = "this is a file message"
-        self.msg_text = msg_text
-        if msg_filename is None:
-            msg_filename = "this is a text message"
-        self.msg_filename = msg_filename
-        self.msg_reply_token = msg_reply_token
-        self.msg_timestamp = msg_timestamp
-        self.owner_id = owner_id
-        if error_description is None:
-            error_description = ""
-        self.error_description = error_description
+    msg_id: str
+    msg_type: MessageType = MessageType.NULL
+    msg_text: Optional[str] = None
+    msg_filename: Optional[str] = None
+    msg_filepath: Optional[str] = None
+    msg_content_hash: Optional[str] = None
+    msg_content_size: Optional[int] = None
+    msg_reply_token: str = ""
+    msg_reply_text: Optional[str] = None
+    msg_event_id: Optional[str] = None
+    ## evaluated per message, not once at import
+    msg_timestamp: datetime = field(default_factory=datetime.now)
+    owner_id: Optional[str] = None
+    error_description: str = ""
+    ## the error may pass, a database or a network error, the event is 
+    ## processed again instead of being answered with it
+    error_retryable: bool = False
+    def __post_init__(self) -> None:
+        if self.msg_id is None:
+            raise ValueError("message initialize error, please verify.")
+        if self.error_description is None:
+            self.error_description = ""
     def __str__(self) -> str:
         if self.msg_type.value is None:
             return "this is a null message"
         return f"{self.msg_type.value} : {self.msg_id} : {self.msg_text} : {self.msg_filename}"
+
+## a text on its way back to a line user, the dispatcher replies with 
+## the token while it is fresh and pushes to the user otherwise
+@dataclass(slots=True)
+class OutboundMessage:
+    text: str
+    line_user_id: Optional[str] = None
+    reply_token: str = ""
+    ## epoch seconds of the webhook event the text answers
+    received_at: float = field(default_factory=time.time)
@@ -0,0 +1,71 @@
+import re
+from typing import List
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+
+## the full-text index over message_records is an sqlite FTS5 table
+## with external content, the triggers keep it in sync with every
+## insert, update and delete of a message record. lineUserId is indexed
+## too so a query is scoped to one user inside the index. See
+## Fts5Document: https://www.sqlite.org/fts5.html#external_content_tables
+FTS_TABLE = "message_records_fts"
+FTS_DDL: List[str] = [
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+        message, lineUserId,
+        content='message_records', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2')""",
+    f"""CREATE TRIGGER IF NOT EXISTS message_records_fts_insert
+        AFTER INSERT ON message_records BEGIN
+        INSERT INTO {FTS_TABLE} (rowid, message, lineUserId)
+        VALUES (new.id, new.message, new.lineUserId);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS message_records_fts_delete
+        AFTER DELETE ON message_records BEGIN
+        INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rowid, message, lineUserId)
+        VALUES ('delete', old.id, old.message, old.lineUserId);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS message_records_fts_update
+        AFTER UPDATE OF message, lineUserId ON message_records BEGIN
+        INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rowid, message, lineUserId)
+        VALUES ('delete', old.id, old.message, old.lineUserId);
+        INSERT INTO {FTS_TABLE} (rowid, message, lineUserId)
+        VALUES (new.id, new.message, new.lineUserId);
+    END""",
+]
+
+## the scripts written without spaces between the words: chinese,
+## japanese kana, korean hangul and thai. unicode61 indexes a run of
+## them as one token, so "牛奶" is no token of "明天要買牛奶和雞蛋" and
+## a query in them is answered by a LIKE scan of the user's notes
+UNSPACED_SCRIPTS = re.compile(
+    "[\u0e00-\u0e7f\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff"
+    "\uac00-\ud7af\uf900-\ufaff\uff66-\uff9f]")
+
+def search_index_enabled(engine: Engine) -> bool:
+    return engine.dialect.name == "sqlite"
+
+def needs_substring_search(query: str) -> bool:
+    return UNSPACED_SCRIPTS.search(query) is not None
+
+## create the index and its triggers, but only if they don't exist. An
+## index created over an existing data.db is filled from its records
+def init_search_index(engine: Engine) -> None:
+    if not search_index_enabled(engine):
+        return
+    with engine.begin() as connection:
+        exists = connection.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+            {"name": FTS_TABLE}).first() is not None
+        for statement in FTS_DDL:
+            connection.execute(text(statement))
+        if not exists:
+            connection.execute(text(
+                f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('rebuild')"))
+
+## turn what the user typed into an FTS5 query: every term is a quoted
+## phrase, so operators and punctuation in notes can't break the syntax
+def build_match_query(line_user_id: str, query: str) -> str:
+    terms = [term.replace('"', '""') for term in query.split()]
+    phrases = " ".join(f'"{term}"' for term in terms if term != "")
+    owner = line_user_id.replace('"', '""')
+    return f'lineUserId : "{owner}" AND message : ({phrases})'
@@ -0,0 +1,287 @@
+import argparse
+import asyncio
+import hashlib
+import os
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple, TypeVar
+import yaml
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session, sessionmaker
+from database import DEFAULT_DATABASE_CONFIG, DatabaseExecutor, create_database_engine, init_database
+from handlers import add_blob_references, index_note_tags, unindex_note_tags, _insert_ignoring_conflicts
+from metrics import DB_POOL_CHECKED_OUT
+from migrations import run_migrations
+from search import init_search_index
+from rules import Base, Blobs, MessageRecords, ProcessedEvents, UserInfo
+from tags import extract_tags
+
+T = TypeVar("T")
+
+## the users are spread over DATABASE.SHARDS sqlite files, every file
+## has the full schema and a user lives in exactly one of them with its
+## notes, tags and blob references, so a write locks one file and the
+## writes of users on other shards commit in parallel. The shard of a
+## user is the jump consistent hash of its lineUserId: growing from n
+## to m shards moves only the users whose shard is one of the new ones.
+## See JumpHashDocument: https://arxiv.org/abs/1406.2294. The tables
+## of no user, the processed webhook events, live in shard 0
+def jump_hash(key: int, buckets: int) -> int:
+    bucket, next_bucket = -1, 0
+    while next_bucket < buckets:
+        bucket = next_bucket
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        next_bucket = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+def shard_for(line_user_id: Optional[str], shards: int) -> int:
+    if line_user_id is None or shards <= 1:
+        return 0
+    key = int.from_bytes(hashlib.blake2b(line_user_id.encode(), digest_size=8).digest(), "big")
+    return jump_hash(key, shards)
+
+## the urls of the shards in the DATABASE config, a single shard is
+## the plain URL so data.db stays where it was
+def shard_urls(database_config: Dict[str, Any] = None, shards: int = None) -> List[str]:
+    database_config = {**DEFAULT_DATABASE_CONFIG, **(database_config or {})}
+    shards = shards or database_config["SHARDS"] or 1
+    if shards <= 1:
+        return [database_config["URL"]]
+    return [database_config["SHARD_URL"].format(shard=shard) for shard in range(shards)]
+
+## an engine for every shard, a single shard replaces the default
+## engine like init_database
+def init_shards(database_config: Dict[str, Any] = None) -> List[Engine]:
+    urls = shard_urls(database_config)
+    if len(urls) == 1:
+        return [init_database(database_config)]
+    engines = [create_database_engine({**(database_config or {}), "URL": url}) for url in urls]
+    if all(hasattr(engine.pool, "checkedout") for engine in engines):
+        DB_POOL_CHECKED_OUT.set_function(lambda: sum(engine.pool.checkedout() for engine in engines))
+    return engines
+
+## the sharded database executor has the interface of the database
+## executor and routes every call by its arguments: line_user_id, the
+## owner of message, or the owners of messages, which are split by
+## shard when they span several. A call without a user runs on shard
+## 0, run_all runs it on every shard. Every shard has its own thread
+## pool, a slow commit on one shard holds up no other
+class ShardedDatabaseExecutor:
+    def __init__(
+            self,
+            session_factories: List[sessionmaker],
+            max_workers: int = 4
+            ) -> None:
+        self.shards: List[DatabaseExecutor] = [
+            DatabaseExecutor(session_factory, max_workers, thread_name_prefix=f"db-shard{index}")
+            for index, session_factory in enumerate(session_factories)
+        ]
+    def shard_of(self, line_user_id: Optional[str]) -> int:
+        return shard_for(line_user_id, len(self.shards))
+    def partition(self, messages: List[T]) -> List[List[T]]:
+        parts: Dict[int, List[T]] = {}
+        for message in messages:
+            parts.setdefault(self.shard_of(message.owner_id), []).append(message)
+        return list(parts.values())
+    ## a call names its user by the line_user_id, message or messages 
+    ## keyword. One naming none, like the ones on the processed events, 
+    ## picks its shard from shards itself, a call guessed onto shard 0 
+    ## would read or write the wrong file for any other user
+    def __route(self, fn: Callable[..., Any], kwargs: Dict[str, Any]) -> DatabaseExecutor:
+        if "line_user_id" in kwargs:
+            return self.shards[self.shard_of(kwargs["line_user_id"])]
+        if "message" in kwargs:
+            return self.shards[self.shard_of(kwargs["message"].owner_id)]
+        if "messages" in kwargs:
+            messages = kwargs["messages"]
+            return self.shards[self.shard_of(messages[0].owner_id if len(messages) > 0 else None)]
+        raise ValueError(
+            f"{getattr(fn, '__name__', fn)} names no user to route by, run it on one of shards")
+    async def run(self, fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        if "messages" in kwargs:
+            parts = self.partition(kwargs["messages"])
+            ## every shard commits its part, the batch fails if one does.
+            ## The callers partition first to know which part failed
+            if len(parts) > 1:
+                results = await asyncio.gather(*[
+                    self.shards[self.shard_of(part[0].owner_id)].run(fn, *args, **{**kwargs, "messages": part})
+                    for part in parts
+                ])
+                return next((result for result in results if not result.success), results[0])
+        return await self.__route(fn, kwargs).run(fn, *args, **kwargs)
+    def stream(self, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> AsyncIterator[Any]:
+        return self.__route(fn, kwargs).stream(fn, *args, **kwargs)
+    async def run_all(self, fn: Callable[..., T], *args: Any, **kwargs: Any) -> List[T]:
+        return list(await asyncio.gather(*[shard.run(fn, *args, **kwargs) for shard in self.shards]))
+    def shutdown(self) -> None:
+        for shard in self.shards:
+            shard.shutdown()
+
+## the admin query helper: fn(db, *args, **kwargs) on every shard in
+## turn, a list of (shard, result). For scripts and the command line,
+## the app uses run_all
+def query_shards(
+        session_factories: List[sessionmaker],
+        fn: Callable[..., T],
+        *args: Any,
+        **kwargs: Any
+        ) -> List[Tuple[int, T]]:
+    results = []
+    for shard, session_factory in enumerate(session_factories):
+        db = session_factory()
+        try:
+            results.append((shard, fn(db, *args, **kwargs)))
+        finally:
+            db.close()
+    return results
+
+## the users and notes of a shard, for python -m sharding stats
+def ShardStatsHandler(db: Session) -> Dict[str, int]:
+    return {
+        "users": db.execute(select(func.count()).select_from(UserInfo)).scalar(),
+        "notes": db.execute(select(func.count()).select_from(MessageRecords)).scalar(),
+    }
+
+## the tables, migrations and search index of a shard, like
+## prepare_database does for the app
+def prepare_shard(engine: Engine) -> None:
+    Base.metadata.create_all(bind=engine)
+    run_migrations(engine)
+    init_search_index(engine)
+
+## the blob references of message records by the sha256 their path
+## ends with, files stored before the blob store have none
+def _blob_references(db: Session, records: List[Dict[str, Any]]) -> Tuple[Dict[str, int], Dict[str, int]]:
+    references: Dict[str, int] = {}
+    for record in records:
+        if record["filepath"] is not None:
+            name = os.path.basename(record["filepath"])
+            references[name] = references.get(name, 0) + 1
+    if len(references) == 0:
+        return ({}, {})
+    sizes = dict(db.execute(
+        select(Blobs.sha256, Blobs.size).where(Blobs.sha256.in_(list(references)))).all())
+    return ({sha256: count for sha256, count in references.items() if sha256 in sizes}, sizes)
+
+## take the notes of a user out of a shard: their tags, their blob
+## references and the records, in the caller's transaction
+def _remove_user_notes(db: Session, line_user_id: str, chunk_size: int) -> int:
+    removed = 0
+    while True:
+        records = db.execute(
+            select(MessageRecords.id, MessageRecords.filepath)
+            .where(MessageRecords.lineUserId == line_user_id)
+            .limit(chunk_size)).mappings().all()
+        if len(records) == 0:
+            return removed
+        ids = [record["id"] for record in records]
+        unindex_note_tags(db, ids)
+        references, sizes = _blob_references(db, records)
+        add_blob_references(db, {sha256: -count for sha256, count in references.items()}, sizes)
+        db.execute(delete(MessageRecords).where(MessageRecords.id.in_(ids)))
+        removed += len(ids)
+
+## move one user with its notes from one shard to another. The target
+## commits the copy first, then the source deletes it, a move cut short
+## leaves the user on the source and the next run copies it again over
+## the partial copy
+def move_user(source: Session, target: Session, line_user_id: str, chunk_size: int = 1000) -> int:
+    user = source.execute(select(UserInfo).where(UserInfo.lineUserId == line_user_id)).scalar_one()
+    _remove_user_notes(target, line_user_id, chunk_size)
+    _insert_ignoring_conflicts(target, UserInfo, ["lineUserId"], {
+        "lineUserId": user.lineUserId, "email": user.email,
+        "hashed_password": user.hashed_password, "is_active": user.is_active})
+    user_id = target.execute(select(UserInfo.id).where(UserInfo.lineUserId == line_user_id)).scalar()
+    columns = [column for column in MessageRecords.__table__.c if column.name not in ("id", "userInfo_id")]
+    last_id, moved = 0, 0
+    while True:
+        records = source.execute(
+            select(MessageRecords.id, *columns)
+            .where(MessageRecords.lineUserId == line_user_id, MessageRecords.id > last_id)
+            .order_by(MessageRecords.id).limit(chunk_size)).mappings().all()
+        if len(records) == 0:
+            break
+        last_id = records[-1]["id"]
+        inserted = target.execute(
+            insert(MessageRecords).returning(
+                MessageRecords.id, MessageRecords.timestamp, MessageRecords.message),
+            [{**{column.name: record[column.name] for column in columns}, "userInfo_id": user_id}
+             for record in records]
+        ).all()
+        notes = [(row.id, user_id, row.timestamp, extract_tags(row.message))
+                 for row in inserted if row.timestamp is not None]
+        index_note_tags(target, [note for note in notes if len(note[3]) > 0])
+        add_blob_references(target, *_blob_references(source, records))
+        moved += len(records)
+    target.commit()
+    _remove_user_notes(source, line_user_id, chunk_size)
+    source.execute(delete(UserInfo).where(UserInfo.lineUserId == line_user_id))
+    source.commit()
+    return moved
+
+## change the number of shards: every user whose shard differs under
+## the new count is moved to it, shard by shard. Run it with the app
+## stopped, then set DATABASE.SHARDS to the new count
+def rebalance(database_config: Dict[str, Any], shards: int, chunk_size: int = 1000) -> Dict[str, int]:
+    sources = shard_urls(database_config)
+    targets = shard_urls(database_config, shards)
+    engines = {url: create_database_engine({**(database_config or {}), "URL": url})
+               for url in dict.fromkeys(sources + targets)}
+    for engine in engines.values():
+        prepare_shard(engine)
+    factories = {url: sessionmaker(autocommit=False, autoflush=False, bind=engine)
+                 for url, engine in engines.items()}
+    report = {"users": 0, "notes": 0}
+    try:
+        for url in sources:
+            source = factories[url]()
+            line_user_ids = source.execute(select(UserInfo.lineUserId)).scalars().all()
+            for line_user_id in line_user_ids:
+                target_url = targets[shard_for(line_user_id, shards)]
+                if target_url == url:
+                    continue
+                target = factories[target_url]()
+                try:
+                    report["notes"] += move_user(source, target, line_user_id, chunk_size)
+                    report["users"] += 1
+                finally:
+                    target.close()
+            source.close()
+        ## the processed events go with shard 0
+        if sources[0] != targets[0]:
+            source, target = factories[sources[0]](), factories[targets[0]]()
+            events = source.execute(
+                select(ProcessedEvents.webhookEventId, ProcessedEvents.processed_at)).mappings().all()
+            for start in range(0, len(events), chunk_size):
+                _insert_ignoring_conflicts(target, ProcessedEvents, ["webhookEventId"],
+                                           [dict(event) for event in events[start:start + chunk_size]])
+            target.commit()
+            source.close()
+            target.close()
+    finally:
+        for engine in engines.values():
+            engine.dispose()
+    return report
+
+## python -m sharding stats prints the users and notes of every shard,
+## python -m sharding rebalance N moves the users for N shards
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="the shards of data.db")
+    parser.add_argument("--config", default=os.environ.get("APP_CONFIG_PATH", "./config.yaml"))
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("stats")
+    rebalance_parser = commands.add_parser("rebalance")
+    rebalance_parser.add_argument("shards", type=int)
+    rebalance_parser.add_argument("--chunk-size", type=int, default=1000)
+    arguments = parser.parse_args()
+    with open(arguments.config) as file:
+        database_config = (yaml.safe_load(file) or {}).get("DATABASE")
+    if arguments.command == "stats":
+        engines = [create_database_engine({**(database_config or {}), "URL": url})
+                   for url in shard_urls(database_config)]
+        for shard, stats in query_shards(
+                [sessionmaker(bind=engine) for engine in engines], ShardStatsHandler):
+            print(f"shard {shard}: {stats['users']} users, {stats['notes']} notes")
+    else:
+        report = rebalance(database_config, arguments.shards, arguments.chunk_size)
+        print(f"moved {report['users']} users with {report['notes']} notes, "
+              f"set DATABASE.SHARDS to {arguments.shards}")
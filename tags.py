@@ -0,0 +1,33 @@
+import re
+import unicodedata
+from typing import List, Optional
+
+## the #tags of a note. The text is NFKC normalized first, so a
+## full-width "＃" counts too, and a tag is casefolded so "#Groceries"
+## and "#groceries" are one tag. A "#" inside a word, like in "C#" or
+## an url fragment, starts no tag
+TAG_PATTERN = re.compile(r"(?<![\w#&/])#(\w[\w-]*)")
+MAX_TAG_LENGTH = 64
+MAX_TAGS_PER_NOTE = 32
+
+## the distinct tags of a note in the order they appear
+def extract_tags(text: str) -> List[str]:
+    if not text or "#" not in text and "＃" not in text:
+        return []
+    tags: List[str] = []
+    for match in TAG_PATTERN.finditer(unicodedata.normalize("NFKC", text)):
+        tag = match.group(1).casefold()[:MAX_TAG_LENGTH]
+        if tag not in tags:
+            tags.append(tag)
+            if len(tags) == MAX_TAGS_PER_NOTE:
+                break
+    return tags
+
+## a text that is one #tag and nothing else asks for the notes of the
+## tag, a note carrying tags has some other text too
+def tag_query(text: str) -> Optional[str]:
+    parts = unicodedata.normalize("NFKC", text or "").split()
+    if len(parts) != 1:
+        return None
+    match = TAG_PATTERN.fullmatch(parts[0])
+    return match.group(1).casefold()[:MAX_TAG_LENGTH] if match is not None else None
@@ -0,0 +1,95 @@
+import asyncio
+import logging
+from typing import List, Tuple
+from database import DatabaseExecutor
+from handlers import MessageRecordsBatchHandler
+from rules import HandleStatus, Message, ProcessMessage
+
+logger = logging.getLogger(__name__)
+
+## the group commit writer is the background task that writes
+## message records. Concurrent requests submit their messages, the
+## writer coalesces them into one bulk insert and one commit per batch,
+## and every caller's future resolves once its rows are committed. With
+## a sharded executor every shard has a writer task and queue of its
+## own, and the shards commit in parallel
+class GroupCommitWriter:
+    def __init__(
+            self,
+            executor: DatabaseExecutor,
+            max_batch_size: int = 256,
+            max_wait_ms: float = 5.0
+            ) -> None:
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_wait_seconds = max_wait_ms / 1000
+        self.queues: "List[asyncio.Queue[Tuple[List[Message], asyncio.Future]]]" = []
+        self.tasks: List[asyncio.Task] = []
+        self.batches = 0
+        self.rows = 0
+    def start(self) -> None:
+        self.queues = [asyncio.Queue() for _ in self.executor.shards]
+        self.tasks = [asyncio.create_task(self.__run(queue)) for queue in self.queues]
+    ## write what is still queued, then stop the writer tasks
+    async def stop(self) -> None:
+        if len(self.tasks) == 0:
+            return
+        for queue in self.queues:
+            await queue.join()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+    ## queue the messages and wait until they are durable. A submission 
+    ## goes to the queue of its first owner's shard, the executor splits 
+    ## the ones spanning several shards
+    async def submit(self, messages: List[Message]) -> HandleStatus:
+        future = asyncio.get_running_loop().create_future()
+        shard = self.executor.shard_of(messages[0].owner_id) if len(messages) > 0 else 0
+        await self.queues[shard].put((messages, future))
+        return await future
+    ## collect submissions until the batch is full or the oldest one
+    ## has waited max_wait_ms
+    async def __collect(
+            self,
+            queue: "asyncio.Queue[Tuple[List[Message], asyncio.Future]]"
+            ) -> List[Tuple[List[Message], asyncio.Future]]:
+        batch = [await queue.get()]
+        size = len(batch[0][0])
+        deadline = asyncio.get_running_loop().time() + self.max_wait_seconds
+        while size < self.max_batch_size:
+            if queue.empty():
+                timeout = deadline - asyncio.get_running_loop().time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            else:
+                item = queue.get_nowait()
+            batch.append(item)
+            size += len(item[0])
+        return batch
+    async def __write(self, messages: List[Message]) -> HandleStatus:
+        try:
+            return await self.executor.run(MessageRecordsBatchHandler, messages = messages)
+        except Exception as e:
+            logger.error("group commit writer error", extra={"error": str(e), "messages": len(messages)})
+            return HandleStatus(False, ProcessMessage.DATABASE_WRITE_ERROR)
+    async def __run(self, queue: "asyncio.Queue[Tuple[List[Message], asyncio.Future]]") -> None:
+        while True:
+            batch = await self.__collect(queue)
+            status = await self.__write([msg for messages, _ in batch for msg in messages])
+            ## one bad submission must not fail the others, write them
+            ## one by one when the group commit fails
+            if not status.success and len(batch) > 1:
+                statuses = [await self.__write(messages) for messages, _ in batch]
+            else:
+                statuses = [status] * len(batch)
+            for (messages, future), result in zip(batch, statuses):
+                if not future.done():
+                    future.set_result(result)
+                queue.task_done()
+            self.batches += 1
+            self.rows += sum(len(messages) for messages, _ in batch)